@@ -0,0 +1,200 @@
+"""Running statistics over every balance, kept up to date one ledger write at a time
+so nothing has to load and sum the whole economy to answer "how much SC is there".
+Balances are int cents (see money.py), so the running sums are exact."""
+import bisect
+
+class BalanceIndex:
+    """Every balance kept sorted highest first, plus the aggregates, updated as the
+    ledger changes instead of re-sorting or re-summing for every read. Keys are
+    (-balance, user_id) held in sorted blocks of BLOCK to 2 * BLOCK keys, so an
+    update is a couple of bisects and a short list insert, and reading a page only
+    walks block lengths up to the page and then the page itself.
+
+    Besides the total it keeps spread, the sum of |a - b| over every pair of
+    balances, which is all the gini coefficient needs: gini = spread / (n * total).
+    Keeping it up to date needs the count and sum of everything above a balance,
+    which comes from fenwick trees over the per-block counts and sums."""
+    BLOCK = 512
+
+    def __init__(self):
+        self.blocks = []  # sorted lists of (-balance, user_id)
+        self.maxes = []  # last key of each block, to bisect on
+        self.negs = []  # -balance of each key, alongside blocks, so sums run over plain ints
+        self.sums = []  # sum of the balances in each block
+        self.tree_count = [0]  # fenwick trees over len(block) and sums, 1 based
+        self.tree_sum = [0]
+        self.balances = {}  # user_id -> balance as indexed
+        self.total = 0
+        self.spread = 0
+
+    def reset(self, balances):
+        keys = sorted((-int(bal), str(uid)) for uid, bal in balances.items())
+        self.blocks = [keys[i:i + self.BLOCK] for i in range(0, len(keys), self.BLOCK)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.negs = [[neg for neg, _ in block] for block in self.blocks]
+        self.sums = [-sum(negs) for negs in self.negs]
+        self.balances = {uid: -neg for neg, uid in keys}
+        self.total = sum(self.sums)
+        # highest first, the k-th balance is above n - 1 - k others and below k
+        n = len(keys)
+        self.spread = sum(-neg * (n - 1 - 2 * k) for k, (neg, _) in enumerate(keys))
+        self._build_tree()
+
+    def _build_tree(self):
+        # O(blocks), only needed when blocks are added or dropped
+        n = len(self.blocks)
+        counts = [0] + [len(block) for block in self.blocks]
+        sums = [0] + self.sums
+        for k in range(1, n + 1):
+            parent = k + (k & -k)
+            if parent <= n:
+                counts[parent] += counts[k]
+                sums[parent] += sums[k]
+        self.tree_count, self.tree_sum = counts, sums
+
+    def _tree_add(self, i, count, amount):
+        k = i + 1
+        while k < len(self.tree_count):
+            self.tree_count[k] += count
+            self.tree_sum[k] += amount
+            k += k & -k
+
+    def _tree_prefix(self, i):
+        """(count, sum of balances) of blocks[:i]."""
+        count = total = 0
+        while i > 0:
+            count += self.tree_count[i]
+            total += self.tree_sum[i]
+            i -= i & -i
+        return count, total
+
+    def __len__(self):
+        return len(self.balances)
+
+    def update(self, user_id, balance):
+        user_id = str(user_id)
+        balance = int(balance)
+        old = self.balances.get(user_id)
+        if old is not None:
+            if old == balance:
+                return
+            self._remove((-old, user_id))
+            del self.balances[user_id]
+            self.total -= old
+            self.spread -= self._distance(old, (-old, user_id))
+        self.spread += self._distance(balance, (-balance, user_id))
+        self._insert((-balance, user_id))
+        self.balances[user_id] = balance
+        self.total += balance
+
+    def _before(self, key):
+        """(count, sum of balances) of the keys sorted before key."""
+        i = min(bisect.bisect_left(self.maxes, key), len(self.blocks) - 1)
+        j = bisect.bisect_left(self.blocks[i], key)
+        count, total = self._tree_prefix(i)
+        negs = self.negs[i]
+        # add up whichever side of j in the block is shorter
+        if j <= len(negs) // 2:
+            total -= sum(negs[:j])
+        else:
+            total += self.sums[i] + sum(negs[j:])
+        return count + j, total
+
+    def _distance(self, balance, key):
+        """Sum of |balance - b| over every balance currently indexed."""
+        if not self.blocks:
+            return 0
+        count, higher = self._before(key)
+        lower = self.total - higher
+        return (higher - balance * count) + (balance * (len(self.balances) - count) - lower)
+
+    def _insert(self, key):
+        if not self.blocks:
+            self.blocks.append([key])
+            self.negs.append([key[0]])
+            self.maxes.append(key)
+            self.sums.append(-key[0])
+            self._build_tree()
+            return
+        i = min(bisect.bisect_left(self.maxes, key), len(self.blocks) - 1)
+        block, negs = self.blocks[i], self.negs[i]
+        j = bisect.bisect_left(block, key)
+        block.insert(j, key)
+        negs.insert(j, key[0])
+        self.maxes[i] = block[-1]
+        self.sums[i] -= key[0]
+        self._tree_add(i, 1, -key[0])
+        if len(block) > 2 * self.BLOCK:
+            self.blocks[i:i + 1] = [block[:self.BLOCK], block[self.BLOCK:]]
+            self.negs[i:i + 1] = [negs[:self.BLOCK], negs[self.BLOCK:]]
+            self.maxes[i:i + 1] = [block[self.BLOCK - 1], block[-1]]
+            self.sums[i:i + 1] = [-sum(negs[:self.BLOCK]), -sum(negs[self.BLOCK:])]
+            self._build_tree()
+
+    def _remove(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        block = self.blocks[i]
+        j = bisect.bisect_left(block, key)
+        del block[j]
+        del self.negs[i][j]
+        if block:
+            self.maxes[i] = block[-1]
+            self.sums[i] += key[0]
+            self._tree_add(i, -1, key[0])
+        else:
+            del self.blocks[i]
+            del self.negs[i]
+            del self.maxes[i]
+            del self.sums[i]
+            self._build_tree()
+
+    def rank(self, user_id):
+        """1 based position of the user, or None if they have no balance."""
+        user_id = str(user_id)
+        if user_id not in self.balances:
+            return None
+        return self._before((-self.balances[user_id], user_id))[0] + 1
+
+    def page(self, offset, limit):
+        """[(user_id, balance)] for ranks offset + 1 .. offset + limit."""
+        out = []
+        for block in self.blocks:
+            if offset >= len(block):
+                offset -= len(block)
+                continue
+            out.extend(block[offset:offset + limit - len(out)])
+            offset = 0
+            if len(out) >= limit:
+                break
+        return [(uid, -neg) for neg, uid in out]
+
+    def quantile(self, q):
+        """Balance below which a fraction q of users sit (nearest rank, no interpolation)."""
+        if not self.balances:
+            return 0
+        n = len(self.balances)
+        position = n - 1 - round(q * (n - 1))  # blocks are highest first
+        return self.page(position, 1)[0][1]
+
+    def gini(self):
+        n = len(self.balances)
+        if n == 0 or self.total <= 0:
+            return None  # undefined once debts outweigh holdings
+        return self.spread / (n * self.total)
+
+    def stats(self):
+        n = len(self.balances)
+        return {
+            "users": n,
+            "supply": self.total,
+            "mean": round(self.total / n) if n else 0,
+            "gini": self.gini(),
+            "min": self.quantile(0.0),
+            "p10": self.quantile(0.1),
+            "p25": self.quantile(0.25),
+            "median": self.quantile(0.5),
+            "p75": self.quantile(0.75),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.quantile(1.0),
+        }
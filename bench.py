@@ -0,0 +1,523 @@
+"""Micro-benchmarks for the bot's hot paths, run offline.
+
+    python bench.py              # everything
+    python bench.py blackjack    # just the ones whose name contains "blackjack"
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS = {}
+GUILD = 1  # economies are per guild, the benchmarks use this one unless they say otherwise
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def import_bot(**config):
+    """Import main.py from inside a scratch directory with its own config.json, so
+    benchmarks never read or write the real ledger files."""
+    if "main" in sys.modules:
+        return sys.modules["main"]
+    workdir = tempfile.mkdtemp(prefix="shiftycoin-bench-")
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump({"token": "", **config}, f)
+    os.chdir(workdir)
+    import main
+    return main
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+@benchmark
+def blackjack_hands_per_second():
+    """Scalar BlackjackGame vs the numpy simulator, both hitting below 17."""
+    from blackjack import BlackjackGame, score_hand
+    import simulate
+
+    def scalar(n):
+        for _ in range(n):
+            game = BlackjackGame()
+            game.deal_initial()
+            while score_hand(game.player) < 17:
+                game.player_hit()
+            game.dealer_play()
+            game.settle()
+
+    n_scalar = 50_000
+    n_vector = 2_000_000
+    t_scalar, _ = timed(scalar, n_scalar)
+    t_vector, _ = timed(simulate.simulate, n_vector, [0], simulate.stand_on(17))
+    scalar_rate = n_scalar / t_scalar
+    vector_rate = n_vector / t_vector
+    print(f"  scalar BlackjackGame: {scalar_rate:>12,.0f} hands/s")
+    print(f"  numpy simulate:       {vector_rate:>12,.0f} hands/s ({vector_rate / scalar_rate:.1f}x)")
+
+
+@benchmark
+def blackjack_shoe_vs_fresh_deck():
+    """Allocation and speed per game, fresh deck per game vs a shared 6 deck shoe."""
+    import tracemalloc
+    from blackjack import BlackjackGame, Shoe
+
+    def play(n, shoe):
+        for _ in range(n):
+            game = BlackjackGame(shoe)
+            game.deal_initial()
+            while game.player.score < 17:
+                game.player_hit()
+            game.dealer_play()
+            game.evaluate()
+
+    n = 50_000
+    for label, shoe in (("fresh deck", None), ("6 deck shoe", Shoe(6, 0.75))):
+        # memory held per game while it's in ACTIVE_GAMES
+        tracemalloc.start()
+        games = [BlackjackGame(shoe) for _ in range(1000)]
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del games
+        elapsed, _ = timed(play, n, shoe)
+        print(f"  {label:<12} {n / elapsed:>10,.0f} games/s  {held / 1000:>6.0f} bytes allocated per game")
+
+
+@benchmark
+def blackjack_settlement():
+    """Cost of settling one finished game: the old evaluateSC/get_bet + whole-file
+    add_balance path vs game.settle() + one in-memory ledger write, 10k users."""
+    bot = import_bot()
+    from blackjack import BlackjackGame, Shoe
+
+    users = 10_000
+    legacy_file = os.path.join(os.getcwd(), "legacy_shiftycoin.json")
+    with open(legacy_file, "w") as f:
+        json.dump({str(uid): 100.0 for uid in range(users)}, f, indent=2)
+    bot.save_shiftycoin(GUILD, {str(uid): 100 * 100 for uid in range(users)})
+
+    bets = {}
+
+    def legacy_settle(game, uid):
+        # what bj_stand used to do: evaluateSC twice, each re-scoring both hands and
+        # calling get_bet([uid]) up to three times, then a full load/dump of the ledger
+        def get_bet(key):
+            return bets.get(str(key), 0.0)
+
+        def evaluate_sc():
+            p, d = game.player.score, game.dealer.score
+            w = 0 if p > 21 else 1 if d > 21 or p > d else 0 if p < d else 2
+            result = p / 10 if w == 1 else 0 if w == 2 else -(p / 10)
+            if get_bet([uid]) != 0 and w == 1:
+                result = get_bet([uid])
+            elif get_bet([uid]) != 0 and w == 0:
+                result = get_bet([uid]) * -1
+            elif get_bet([uid]) != 0 and w == 2:
+                result = 0
+            return result
+
+        if evaluate_sc() != 0:
+            change = evaluate_sc()
+            with open(legacy_file) as f:
+                data = json.load(f)
+            data[str(uid)] = data.get(str(uid), 0.0) + change
+            with open(legacy_file, "w") as f:
+                json.dump(data, f, indent=2)
+
+    def new_settle(game, uid):
+        settlement = game.settle()
+        if settlement.payout != 0:
+            bot.add_balance(GUILD, uid, settlement.payout)
+
+    shoe = Shoe(6, 0.75)
+
+    def run(settle, n):
+        for i in range(n):
+            uid = i % users
+            bets[str([uid])] = 10
+            game = BlackjackGame(shoe)
+            game.bet = 10 * 100
+            game.deal_initial()
+            game.dealer_play()
+            settle(game, uid)
+
+    n_legacy, n_new = 200, 100_000
+    t_legacy, _ = timed(run, legacy_settle, n_legacy)
+    t_new, _ = timed(run, new_settle, n_new)
+    print(f"  before: {t_legacy / n_legacy * 1e6:>10,.1f} us per settlement")
+    print(f"  after:  {t_new / n_new * 1e6:>10,.1f} us per settlement ({(t_legacy / n_legacy) / (t_new / n_new):,.0f}x)")
+
+
+@benchmark
+def loan_accrual():
+    """accrue_interest_all: the old reload-and-rewrite-per-user pass vs the single
+    pass engine, on loans that are a few months behind."""
+    import datetime
+    import random
+    bot = import_bot()
+
+    def make_loans(n):
+        rng = random.Random(1)
+        this_month = bot.first_of_month(bot._today_date())
+
+        def months_ago(k):
+            year, month = divmod(this_month.year * 12 + this_month.month - 1 - k, 12)
+            return datetime.date(year, month + 1, 1)
+
+        return {
+            str(uid): {
+                "balance": rng.randint(100, 500_000),
+                "active_count": rng.randint(1, 4),
+                "rate": bot.compute_rate_for_count(rng.randint(1, 4)),
+                "last_accrued": months_ago(rng.randint(1, 3)).isoformat(),
+            }
+            for uid in range(n)
+        }
+
+    legacy_file = os.path.join(os.getcwd(), "legacy_loans.json")
+
+    def legacy_accrue_all():
+        # the old shape: every due user reloads and rewrites the whole loans file
+        with open(legacy_file) as f:
+            loans = json.load(f)
+        today_first = bot.first_of_month(bot._today_date())
+        results = {}
+        for uid in loans:
+            with open(legacy_file) as f:
+                data = json.load(f)
+            rec = data[uid]
+            changed, months, interest = bot.accrue_record(rec, today_first)
+            if changed:
+                with open(legacy_file, "w") as f:
+                    json.dump(data, f, indent=2)
+            results[uid] = {"months": months, "interest": interest}
+        return results
+
+    n_legacy, n_new = 1_000, 50_000
+    with open(legacy_file, "w") as f:
+        json.dump(make_loans(n_legacy), f, indent=2)
+    t_legacy, legacy_results = timed(legacy_accrue_all)
+
+    bot.save_loans(GUILD, make_loans(n_legacy))
+    same = bot.accrue_interest_all(GUILD) == legacy_results
+    bot.save_loans(GUILD, make_loans(n_new))
+    t_new, _ = timed(bot.accrue_interest_all, GUILD)
+    print(f"  before: {n_legacy:>6} loans in {t_legacy:8.3f}s ({n_legacy / t_legacy:>10,.0f} loans/s)")
+    print(f"  after:  {n_new:>6} loans in {t_new:8.3f}s ({n_new / t_new:>10,.0f} loans/s), same results: {same}")
+
+
+@benchmark
+def economy_stats():
+    """!sc stats: full recompute over every balance vs the running aggregates in
+    BalanceIndex, after a stream of random ledger writes, 100k users."""
+    import random
+    from aggregates import BalanceIndex
+
+    def recompute(balances):
+        values = sorted(balances.values())
+        n, total = len(values), sum(values)
+        # sum of |a - b| over pairs, from the sorted values
+        spread = sum(v * (2 * k - n + 1) for k, v in enumerate(values))
+        at = lambda q: values[round(q * (n - 1))]
+        return {"users": n, "supply": total, "mean": round(total / n), "gini": spread / (n * total),
+                "min": at(0.0), "p10": at(0.1), "p25": at(0.25), "median": at(0.5), "p75": at(0.75),
+                "p90": at(0.9), "p99": at(0.99), "max": at(1.0)}
+
+    rng = random.Random(17)
+    n_users, n_writes = 100_000, 20_000
+    balances = {str(uid): rng.randrange(0, 100_000) for uid in range(n_users)}
+    index = BalanceIndex()
+    index.reset(balances)
+    t_writes = 0.0
+    for _ in range(n_writes):
+        uid = str(rng.randrange(n_users * 11 // 10))  # some new users too
+        balances[uid] = rng.randrange(0, 100_000)
+        start = time.perf_counter()
+        index.update(uid, balances[uid])
+        t_writes += time.perf_counter() - start
+
+    t_full, expected = timed(recompute, balances)
+    t_stats, stats = timed(index.stats)
+    assert stats.keys() == expected.keys(), sorted(stats.keys() ^ expected.keys())
+    wrong = {key: (stats[key], value) for key, value in expected.items()
+             if (abs(stats[key] - value) >= 1e-12 if key == "gini" else stats[key] != value)}
+    assert not wrong, f"index.stats() doesn't match a full recompute: {wrong}"
+    print(f"  full recompute:     {t_full * 1e3:9.3f} ms")
+    print(f"  index.stats():      {t_stats * 1e3:9.3f} ms, matches recompute on all {len(expected)} keys")
+    print(f"  index.update():     {t_writes / n_writes * 1e6:9.3f} us per ledger write")
+
+
+@benchmark
+def redistribution():
+    """!sc redistribute on 100k users: the old sort-everything, build-a-new-dict,
+    replace-the-ledger pass vs the two streaming passes, as the longest single
+    stretch the event loop is blocked for and peak extra memory."""
+    import random
+    import tracemalloc
+    bot = import_bot()
+
+    rng = random.Random(19)
+    balances = {str(rng.randrange(10**18)): rng.randrange(0, 100_000) for _ in range(100_000)}
+
+    def legacy():
+        shiftycoin = bot.load_shiftycoin(GUILD)
+        total = sum(shiftycoin.values())
+        users = sorted(shiftycoin.keys())
+        share, remainder = divmod(total, len(users))
+        bot.save_shiftycoin(GUILD, {uid: share + (1 if idx < remainder else 0) for idx, uid in enumerate(users)})
+
+    def streaming():
+        # what RedistributionJob does, minus the awaits: time each chunk on its own
+        longest, mark = timed(bot._walk_start, GUILD)
+        after, users, total = "", 0, 0
+        while after is not None:
+            t, (after, n, cents) = timed(bot._sum_chunk, GUILD, after, mark)
+            longest, users, total = max(longest, t), users + n, total + cents
+        share, remainder = divmod(total, users)
+        after, seen = "", 0
+        while after is not None:
+            t, (after, n) = timed(bot._level_chunk, GUILD, after, mark, share, remainder, seen)
+            longest, seen = max(longest, t), seen + n
+        bot._walk_end(GUILD)
+        return longest
+
+    # in the bot ledger flushes go out on the storage thread, keep them out of the timings
+    flush_batch, bot.storage.LEDGER_FLUSH_BATCH = bot.storage.LEDGER_FLUSH_BATCH, float("inf")
+    ledger = bot.ECONOMIES[GUILD].ledger
+    results = {}
+    for label, fn in (("before", legacy), ("after", streaming)):
+        bot.save_shiftycoin(GUILD, dict(balances))
+        ledger.flush()
+        elapsed, longest = timed(fn)
+        results[label] = ledger.all()
+        # again under tracemalloc for the memory, it slows everything down too much to time
+        bot.save_shiftycoin(GUILD, dict(balances))
+        ledger.flush()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        ledger.flush()
+        longest = elapsed if longest is None else longest
+        print(f"  {label:<7} total {elapsed:7.3f}s, longest block {longest * 1e3:9.1f} ms, peak {peak / 1e6:7.1f} MB")
+    bot.storage.LEDGER_FLUSH_BATCH = flush_batch
+    print(f"  same balances: {results['before'] == results['after']}")
+
+@benchmark
+def guild_partitions():
+    """100k users as one shared economy vs split over 50 guilds of 2k: what a
+    redistribution, a snapshot compaction and a page of the leaderboard cost
+    in one guild."""
+    import random
+    bot = import_bot()
+
+    rng = random.Random(23)
+    n_users, n_guilds = 100_000, 50
+    world = {str(rng.randrange(10**17, 10**18)): rng.randrange(0, 100_000) for _ in range(n_users)}
+    shared_guild = 10**6  # stands in for the old single economy
+    bot.save_shiftycoin(shared_guild, world)
+    partitions = {guild: {} for guild in range(GUILD + 100, GUILD + 100 + n_guilds)}
+    for i, (uid, bal) in enumerate(world.items()):
+        partitions[GUILD + 100 + i % n_guilds][uid] = bal
+    for guild, balances in partitions.items():
+        bot.save_shiftycoin(guild, balances)
+    bot.ECONOMIES.compact()
+
+    for label, guild in (("shared", shared_guild), ("per guild", GUILD + 100)):
+        ledger = bot.ECONOMIES[guild].ledger
+        t_redistribute, users = timed(bot.mass_redistribute_shiftycoin, guild)
+        t_compact, _ = timed(ledger.compact)
+        t_page, _ = timed(bot._leaderboard, guild, 0, 20)
+        print(f"  {label:<9}: {users:>7,} users, redistribute {t_redistribute * 1e3:8.1f} ms, "
+              f"compact {t_compact * 1e3:7.1f} ms, leaderboard page {t_page * 1e6:6.1f} us")
+
+
+@benchmark
+def metrics_overhead():
+    """What the instrumentation costs: one METRICS.timer() on its own, and
+    store.add_balance (an in-memory ledger write) with and without it, 10k users."""
+    import asyncio
+    import random
+    bot = import_bot()
+    users = [str(random.randrange(10**17, 10**18)) for _ in range(10_000)]
+    bot.ECONOMIES[GUILD].ledger.replace({uid: random.randrange(0, 10**6) for uid in users})
+    metrics = bot.METRICS
+
+    n = 200_000
+    start = time.perf_counter()
+    for _ in range(n):
+        with metrics.timer("bench"):
+            pass
+    per_timer = (time.perf_counter() - start) / n
+
+    async def writes(n):
+        for i in range(n):
+            await bot.store.add_balance(GUILD, users[i % len(users)], 1)
+
+    async def bare(self, fn, *args):
+        return fn(*args)  # AsyncStorage.run on the json backend, minus the timer
+
+    n = 100_000
+    original, bot.AsyncStorage.run = bot.AsyncStorage.run, bare
+    try:
+        t_bare, _ = timed(asyncio.run, writes(n))
+    finally:
+        bot.AsyncStorage.run = original
+    t_timed, _ = timed(asyncio.run, writes(n))
+    print(f"  METRICS.timer():           {per_timer * 1e6:>8.2f} us")
+    print(f"  add_balance uninstrumented: {t_bare / n * 1e6:>7.2f} us")
+    print(f"  add_balance instrumented:   {t_timed / n * 1e6:>7.2f} us")
+    hist = next(h for (name, _), h in metrics.histograms.items() if name == "storage")
+    print(f"  recorded {hist.count:,} add_balance calls, p99 <= {hist.quantile(0.99) * 1e6:.0f} us")
+
+
+@benchmark
+def profiler_overhead():
+    """store.add_balance with the sampling profiler off and on (5ms and 1ms samples),
+    10k users, and how long taking one sample of the event loop thread takes."""
+    import asyncio
+    import random
+    import threading
+    bot = import_bot()
+    users = [str(random.randrange(10**17, 10**18)) for _ in range(10_000)]
+    bot.ECONOMIES[GUILD].ledger.replace({uid: random.randrange(0, 10**6) for uid in users})
+
+    async def writes(n):
+        for i in range(n):
+            await bot.store.add_balance(GUILD, users[i % len(users)], 1)
+
+    n = 100_000
+    asyncio.run(writes(n))  # warm up, the first pass through the index is slower
+    t_off, _ = timed(asyncio.run, writes(n))
+    print(f"  off:          {t_off / n * 1e6:>7.2f} us per add_balance")
+    for interval in (0.005, 0.001):
+        bot.PROFILER.interval = interval
+        bot.PROFILER.start({threading.get_ident(): "event loop"}, 600)
+        t_on, _ = timed(asyncio.run, writes(n))
+        bot.PROFILER.stop()
+        while bot.PROFILER.running():
+            time.sleep(0.01)
+        print(f"  on, {interval * 1000:g}ms:    {t_on / n * 1e6:>7.2f} us per add_balance ({t_on / t_off - 1:+.1%}), "
+              f"{bot.PROFILER.ticks} samples")
+    frame = sys._current_frames()[threading.get_ident()]
+    start = time.perf_counter()
+    for _ in range(10_000):
+        bot.PROFILER._record("bench", frame)
+    print(f"  one sample:   {(time.perf_counter() - start) / 10_000 * 1e6:>7.2f} us")
+
+
+def _fake_shard(workdir, seed, n_ops, guilds, users, results):
+    """One shard process with a stand-in gateway: the same transfer/award/loan calls
+    the commands and the reaction queue make, spread over a few guilds and fired
+    concurrently at the ledger service."""
+    import asyncio
+    import random
+    os.environ["SHIFTYCOIN_ROLE"] = "shard"
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as bot
+
+    rng = random.Random(seed)
+    totals = {"minted": dict.fromkeys(guilds, 0), "loaned": dict.fromkeys(guilds, 0), "ops": 0, "refused": 0}
+
+    async def one(i):
+        guild = rng.choice(guilds)
+        uid, other = rng.sample(users, 2)
+        amount = rng.randrange(1, 5000)
+        kind = rng.random()
+        try:
+            if kind < 0.5:
+                await bot.transfer(guild, uid, other, amount)
+            elif kind < 0.8:
+                delta = rng.choice((10, -20)) * 100  # reaction reward / penalty
+                await bot.store.add_balance(guild, uid, delta)
+                totals["minted"][guild] += delta
+            elif kind < 0.9:
+                await bot.store.take_loan(guild, uid, amount)
+                totals["minted"][guild] += amount
+                totals["loaned"][guild] += amount
+            else:
+                _, repaid, _ = await bot.store.repay_loan_from_balance(guild, uid, amount)
+                totals["minted"][guild] -= repaid
+                totals["loaned"][guild] -= repaid
+        except ValueError:
+            totals["refused"] += 1
+        totals["ops"] += 1
+
+    async def run():
+        for start in range(0, n_ops, 200):
+            await asyncio.gather(*(one(i) for i in range(start, min(n_ops, start + 200))))
+
+    asyncio.run(run())
+    results.put(totals)
+
+
+@benchmark
+def sharded_ledger():
+    """A ledger service process and 4 fake shard processes doing 5k mixed operations
+    each on 50 shared accounts in 2 guilds, the first one starting out with the old
+    single economy's balances: throughput, and whether every cent in each guild adds
+    up afterwards."""
+    import multiprocessing
+    import signal
+    import subprocess
+
+    workdir = tempfile.mkdtemp(prefix="shiftycoin-shards-")
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump({"token": "", "ledger_socket": os.path.join(workdir, "ledger.sock"), "legacy_guild": GUILD}, f)
+    guilds = [GUILD, GUILD + 1]
+    users = list(range(1000, 1050))
+    with open(os.path.join(workdir, "shiftycoin.json"), "w") as f:
+        json.dump({str(uid): 100.0 for uid in users}, f)  # SC, converted to cents and moved into GUILD on startup
+    seeded = {GUILD: len(users) * 100 * 100, GUILD + 1: 0}
+
+    env = dict(os.environ, SHIFTYCOIN_ROLE="service")
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    service = subprocess.Popen([sys.executable, main_py], cwd=workdir, env=env, stdout=subprocess.DEVNULL)
+    while not os.path.exists(os.path.join(workdir, "ledger.sock")):
+        time.sleep(0.05)
+
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    n_shards, n_ops = 4, 5_000
+    shards = [ctx.Process(target=_fake_shard, args=(workdir, seed, n_ops, guilds, users, results)) for seed in range(n_shards)]
+    start = time.perf_counter()
+    for proc in shards:
+        proc.start()
+    totals = [results.get() for _ in shards]
+    elapsed = time.perf_counter() - start
+    for proc in shards:
+        proc.join()
+    service.send_signal(signal.SIGINT)
+    service.wait()
+
+    def guild_file(guild, name):
+        with open(os.path.join(workdir, "guilds", str(guild), name)) as f:
+            return json.load(f)
+
+    ops = sum(t["ops"] for t in totals)
+    print(f"  {ops} ops from {n_shards} shard processes in {elapsed:.2f}s ({ops / elapsed:,.0f} ops/s), "
+          f"{sum(t['refused'] for t in totals)} refused")
+    for guild in guilds:
+        minted = sum(t["minted"][guild] for t in totals)
+        loaned = sum(t["loaned"][guild] for t in totals)
+        balances, loans = guild_file(guild, "shiftycoin.json"), guild_file(guild, "loans.json")
+        print(f"  guild {guild}: balances add up: {sum(balances.values()) == seeded[guild] + minted}, "
+              f"loans add up: {sum(rec['balance'] for rec in loans.values()) == loaned}")
+
+
+def main(argv):
+    selected = [name for name in BENCHMARKS if not argv or any(arg in name for arg in argv)]
+    for name in selected:
+        print(f"{name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,189 @@
+"""Blackjack rules shared by the bot and the offline tools (simulate.py, bench.py)."""
+import random
+import collections
+
+from money import to_cents
+
+# deck, scoring
+RANKS = ["A", "2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K"]
+SUITS = ["♠", "♥", "♦", "♣"]
+
+# cards are small ints, rank index * 4 + suit index, so a deck is just 52 bytes.
+# everything about a card is looked up in these tables, strings only get built for display
+CARD_NAMES = tuple(f"{r}{s}" for r in RANKS for s in SUITS)
+HARD_VALUES = bytes(1 if r == "A" else 10 if r in ("J", "Q", "K") else int(r) for r in RANKS for s in SUITS)  # aces as 1
+ACE_CARDS = range(0, len(SUITS))  # rank index 0
+FULL_DECK = bytes(range(len(CARD_NAMES)))
+
+def new_deck(shuffle=True):
+    deck = bytearray(FULL_DECK)
+    if shuffle:
+        random.shuffle(deck)
+    return deck
+
+def card_value(card):
+    if card in ACE_CARDS:
+        return 11
+    return HARD_VALUES[card]
+
+def card_str(card):
+    return CARD_NAMES[card]
+
+class Hand:
+    """Cards in a hand plus a running hard total and ace count, so scoring a hand
+    never re-walks it."""
+    __slots__ = ("cards", "hard", "aces")
+
+    def __init__(self, cards=()):
+        self.cards = bytearray()
+        self.hard = 0
+        self.aces = 0
+        for card in cards:
+            self.append(card)
+
+    def append(self, card):
+        self.cards.append(card)
+        self.hard += HARD_VALUES[card]
+        if card in ACE_CARDS:
+            self.aces += 1
+
+    @property
+    def score(self):
+        # one ace counted as 11 if that doesn't bust, same as reducing them one by one
+        if self.aces and self.hard + 10 <= 21:
+            return self.hard + 10
+        return self.hard
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __iter__(self):
+        return iter(self.cards)
+
+    def __getitem__(self, index):
+        return self.cards[index]
+
+def score_hand(cards):
+    # Return best score <=21 if possible, else minimal over 21
+    if isinstance(cards, Hand):
+        return cards.score
+    return Hand(cards).score
+
+def hand_str(cards, hide_first=False):
+    if hide_first and cards:
+        return "?? " + " ".join(CARD_NAMES[c] for c in cards[1:])
+    return " ".join(CARD_NAMES[c] for c in cards)
+
+class Shoe:
+    """decks * 52 cards shuffled together once and dealt front to back, so a draw is
+    just an index bump. Once `penetration` of the shoe has been dealt the next game
+    reshuffles it in place; running completely dry mid hand reshuffles right away."""
+    __slots__ = ("cards", "pos", "cut", "shuffles")
+
+    def __init__(self, decks=1, penetration=1.0):
+        self.cards = bytearray(FULL_DECK * decks)
+        self.cut = max(1, int(len(self.cards) * penetration))
+        self.shuffles = 0
+        self.shuffle()
+
+    def shuffle(self):
+        random.shuffle(self.cards)
+        self.pos = 0
+        self.shuffles += 1
+
+    def begin_hand(self):
+        if self.pos >= self.cut:
+            self.shuffle()
+
+    def draw(self):
+        if self.pos >= len(self.cards):
+            self.shuffle()
+        card = self.cards[self.pos]
+        self.pos += 1
+        return card
+
+    def remaining(self):
+        return len(self.cards) - self.pos
+
+# what a finished game paid out, balance is filled in once it hits the ledger
+Settlement = collections.namedtuple("Settlement", ["result", "player_total", "dealer_total", "payout", "balance"])
+
+# game state management
+class BlackjackGame:
+    def __init__(self, shoe=None):
+        # no shoe means a fresh single deck for just this game, like it always was
+        self.shoe = shoe if shoe is not None else Shoe()
+        self.shoe.begin_hand()
+        self.player = Hand()
+        self.dealer = Hand()
+        self.finished = False
+        self.result = None  # "win", "lose", "push"
+        self.bet = 0  # cents
+        self.settlement = None
+
+    def deal_initial(self):
+        self.player.append(self.shoe.draw())
+        self.dealer.append(self.shoe.draw())
+        self.player.append(self.shoe.draw())
+        self.dealer.append(self.shoe.draw())
+
+    def player_hit(self):
+        self.player.append(self.shoe.draw())
+        return self.player[-1]
+
+    def dealer_play(self):
+        # Dealer reveals and hits until >=17
+        while self.dealer.score < 17:
+            self.dealer.append(self.shoe.draw())
+    
+    def snapshot(self):
+        """Compact, json friendly copy of the game's hands. The shoe isn't part of it,
+        a restored game just deals on from whatever shoe it is handed."""
+        return {
+            "player": self.player.cards.hex(),
+            "dealer": self.dealer.cards.hex(),
+            "finished": self.finished,
+            "bet_cents": self.bet,
+        }
+
+    @classmethod
+    def from_snapshot(cls, data, shoe=None):
+        game = cls(shoe)
+        game.player = Hand(bytes.fromhex(data["player"]))
+        game.dealer = Hand(bytes.fromhex(data["dealer"]))
+        # games saved before amounts were cents have "bet" in whole SC
+        game.bet = data["bet_cents"] if "bet_cents" in data else to_cents(data.get("bet", 0))
+        if data.get("finished"):
+            game.settle()
+        return game
+
+    def settle(self):
+        """Score both hands once, finish the game and work out the payout. The result
+        is kept on the game so calling this again is free. Payouts are in cents: a bet
+        pays +/- the bet, no bet pays +/- the player's total / 10 SC (total * 10 cents),
+        a push pays nothing."""
+        if self.settlement is not None:
+            return self.settlement
+        p = self.player.score
+        d = self.dealer.score
+        if p > 21:
+            result = "lose"
+        elif d > 21 or p > d:
+            result = "win"
+        elif p < d:
+            result = "lose"
+        else:
+            result = "push"
+        if result == "push":
+            payout = 0
+        elif self.bet:
+            payout = self.bet if result == "win" else -self.bet
+        else:
+            payout = p * 10 if result == "win" else -p * 10
+        self.result = result
+        self.finished = True
+        self.settlement = Settlement(result, p, d, payout, None)
+        return self.settlement
+
+    def evaluate(self):
+        return self.settle().result
@@ -0,0 +1,73 @@
+"""Runs the bot sharded over several processes on one machine.
+
+    python cluster.py             # shard_count / shard_groups from config.json
+    python cluster.py 8 4         # 8 shards split over 4 processes
+
+One process runs main.py as the ledger service (the only one that reads or writes
+the ledger and loan files), then one main.py per group of shards connects to the
+gateway for just those shards and to the service over ledger_socket.
+With metrics_port set the service serves its metrics there and each shard group on
+the ports after it. Ctrl-C stops everything, the service last so it gets every
+shard's final writes.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def spawn(role, shard_count, shards=(), metrics_port=None):
+    env = dict(os.environ, SHIFTYCOIN_ROLE=role, SHIFTYCOIN_SHARD_COUNT=str(shard_count),
+               SHIFTYCOIN_SHARDS=",".join(map(str, shards)), SHIFTYCOIN_METRICS_PORT=str(metrics_port or 0))
+    # own session so a Ctrl-C only reaches this script, which then stops them in order
+    return subprocess.Popen([sys.executable, os.path.join(HERE, "main.py")], env=env, start_new_session=True)
+
+
+def wait_for_socket(path, service, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if service.poll() is not None or time.monotonic() > deadline:
+            raise SystemExit("ledger service didn't come up")
+        time.sleep(0.1)
+
+
+def stop(procs):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+    for proc in procs:
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main(argv):
+    with open("config.json") as f:
+        config = json.load(f)
+    shard_count = int(argv[0]) if argv else config.get("shard_count", 1)
+    groups = int(argv[1]) if len(argv) > 1 else config.get("shard_groups", 1)
+    socket_path = config.get("ledger_socket", "ledger.sock")
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    # metrics_port for the service, the ports after it for each shard group
+    port = config.get("metrics_port")
+    service = spawn("service", shard_count, metrics_port=port)
+    wait_for_socket(socket_path, service)
+    shards = [spawn("shard", shard_count, range(shard_count)[g::groups], port and port + 1 + g) for g in range(groups)]
+    try:
+        while service.poll() is None and all(p.poll() is None for p in shards):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    stop(shards)
+    stop([service])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
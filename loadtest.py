@@ -0,0 +1,470 @@
+"""Offline load tests for the command handlers. Replays mixed workloads against the
+real `sc`, `loan` and `bj` handlers and the reaction listener in main.py, with fake
+discord objects standing in for the gateway: thousands of users, reaction storms,
+concurrent transfers and blackjack sessions. Reports ops/sec, p50/p99 latency per
+command and peak memory, and compares them with loadtest_baseline.json.
+
+    python loadtest.py                       # every workload, compared with the baseline
+    python loadtest.py transfers blackjack   # just these
+    python loadtest.py --storage sqlite      # against the sqlite backend
+    python loadtest.py --scale 0.2           # smaller runs
+    python loadtest.py --save                # record these results as the new baseline
+
+Handlers are called through their command callbacks with the arguments already
+converted (a member object, amounts in cents), so discord.py's argument parsing is
+the only part of a command not measured. Every workload runs in its own process in
+a scratch directory, so each starts from a fresh ledger and gets its own peak memory.
+Baselines are only comparable on the machine they were recorded on, record one with
+--save before comparing. Exits 1 when something regressed past --tolerance (ops/s,
+memory) or --latency-tolerance (p99s), or a workload's sanity check failed.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(HERE, "loadtest_baseline.json")
+WORKLOADS = {}
+
+
+def workload(fn):
+    WORKLOADS[fn.__name__] = fn
+    return fn
+
+
+# fake discord objects, just the attributes the handlers touch
+
+class FakePermissions:
+    def __init__(self, administrator=False, manage_guild=False):
+        self.administrator = administrator
+        self.manage_guild = manage_guild
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+
+
+class FakeMessage:
+    def __init__(self, message_id, channel, author, content="", view=None):
+        self.id = message_id
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.view = view
+        self.reactions = []
+
+    async def edit(self, content=None, view=None, **kwargs):
+        if content is not None:
+            self.content = content
+        if view is not None:
+            self.view = view
+        return self
+
+
+class FakeReaction:
+    def __init__(self, emoji, count=0):
+        self.emoji = emoji
+        self.count = count
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.messages = {}  # messages people react to, for fetch_message
+        self.sent = 0
+
+    async def send(self, content=None, view=None, files=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(0, self, None, content or "", view)
+
+    async def fetch_message(self, message_id):
+        return self.messages[message_id]
+
+
+class FakeMember:
+    def __init__(self, user_id, inbox, bot=False):
+        self.id = user_id
+        self.name = self.display_name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.bot = bot
+        self.guild_permissions = FakePermissions()
+        self.inbox = inbox  # (member, view) for every DM with buttons (payment requests), shared
+        self.dms = 0
+
+    async def send(self, content=None, view=None, **kwargs):
+        self.dms += 1
+        if view is not None:
+            self.inbox.append((self, view))
+        return FakeMessage(0, None, None, content or "", view)
+
+
+class FakeContext:
+    def __init__(self, author, channel):
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.message = FakeMessage(0, channel, author)
+
+    async def send(self, content=None, view=None, files=None, **kwargs):
+        return await self.channel.send(content, view=view, files=files)
+
+
+class FakeResponse:
+    async def send_message(self, content=None, ephemeral=False, **kwargs):
+        pass
+
+    async def edit_message(self, content=None, view=None, **kwargs):
+        pass
+
+
+class FakeInteraction:
+    def __init__(self, user):
+        self.user = user
+        self.response = FakeResponse()
+
+
+class FakePayload:
+    """What on_raw_reaction_add/remove get."""
+    def __init__(self, emoji, member, message):
+        self.emoji = emoji
+        self.member = member
+        self.user_id = member.id
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.guild_id = message.channel.guild.id
+
+
+class World:
+    """Users, channels and the recorder for one workload, wired into the bot so its
+    user/channel lookups land on the fakes instead of the API."""
+
+    def __init__(self, bot, n_users, n_channels=20, balance=1000, seed=1):
+        self.bot = bot
+        self.rng = random.Random(seed)
+        self.guild = FakeGuild(1)
+        self.inbox = []
+        self.users = [FakeMember(10**17 + i, self.inbox) for i in range(n_users)]
+        self.members = {m.id: m for m in self.users}
+        self.channels = [FakeChannel(2 * 10**17 + i, self.guild) for i in range(n_channels)]
+        self.by_channel_id = {c.id: c for c in self.channels}
+        self.latencies = {}
+        self.checks = {}
+        self.balance = balance * bot.CENTS
+        bot.bot.get_user = self.members.get
+        bot.bot.get_channel = self.by_channel_id.get
+
+    async def seed(self):
+        await self.bot.store.run(self.bot.save_shiftycoin, self.guild.id, {str(m.id): self.balance for m in self.users})
+
+    def ctx(self, user=None):
+        return FakeContext(user or self.rng.choice(self.users), self.rng.choice(self.channels))
+
+    async def call(self, name, coro):
+        start = time.perf_counter()
+        await coro
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    async def supply(self):
+        return (await self.bot.store.stats(self.guild.id))["supply"]
+
+
+async def sessions(count, fn):
+    """count concurrent sessions of fn(i), each yielding between its commands."""
+    await asyncio.gather(*(fn(i) for i in range(count)))
+
+
+# workloads
+
+@workload
+async def transfers(bot, world, scale):
+    """!sc send between random users with some !sc bal and payment requests paid by button."""
+    supply = await world.supply()
+    rng = world.rng
+
+    async def session(i):
+        for _ in range(int(100 * scale)):
+            ctx = world.ctx()
+            roll = rng.random()
+            if roll < 0.85:
+                await world.call("sc send", bot.send.callback(ctx, rng.choice(world.users), rng.randrange(1, 200 * bot.CENTS)))
+            elif roll < 0.95:
+                await world.call("sc bal", bot.balance.callback(ctx))
+            elif world.inbox and roll < 0.975:
+                payer, view = world.inbox.pop(rng.randrange(len(world.inbox)))
+                await world.call("button pay", view.pay.callback(FakeInteraction(payer)))
+            else:
+                await world.call("sc request", bot.request_sc.callback(ctx, rng.choice(world.users), rng.randrange(1, 50 * bot.CENTS)))
+            await asyncio.sleep(0)
+
+    await sessions(200, session)
+    world.checks["supply unchanged"] = await world.supply() == supply
+
+
+@workload
+async def reactions(bot, world, scale):
+    """A reaction storm: mostly ⭐, some 💀 and removals, 80% of it on 30 hot messages,
+    settled by the reaction queue as it would be every REACTION_FLUSH_INTERVAL."""
+    rng = world.rng
+    supply = await world.supply()
+    ids = itertools.count(3 * 10**17)
+    messages = []
+    for _ in range(3000):
+        channel = rng.choice(world.channels)
+        message = FakeMessage(next(ids), channel, rng.choice(world.users[:1000]))
+        message.reactions = [FakeReaction(bot.REWARD_EMOTE), FakeReaction(bot.PENALTY_EMOTE)]
+        channel.messages[message.id] = message
+        messages.append(message)
+    hot = messages[:30]
+    done = asyncio.Event()
+
+    async def flusher():
+        while not done.is_set():
+            await asyncio.sleep(0.05)
+            await world.call("reaction flush", bot.REACTION_QUEUE.flush())
+
+    async def gateway(i):
+        for _ in range(int(600 * scale)):
+            message = rng.choice(hot) if rng.random() < 0.8 else rng.choice(messages)
+            reaction = message.reactions[0] if rng.random() < 0.85 else message.reactions[1]
+            reaction.count = max(0, reaction.count + (1 if rng.random() < 0.9 or not reaction.count else -1))
+            payload = FakePayload(reaction.emoji, rng.choice(world.users), message)
+            await world.call("raw reaction", bot._on_raw_reaction_event(payload))
+            await asyncio.sleep(0)
+
+    task = asyncio.create_task(flusher())
+    await sessions(100, gateway)
+    done.set()
+    await task
+    await world.call("reaction flush", bot.REACTION_QUEUE.flush())
+    expected = sum((m.reactions[0].count * 10 - m.reactions[1].count * 20) * bot.CENTS for m in messages)
+    world.checks["payouts match reaction counts"] = await world.supply() - supply == expected
+
+
+@workload
+async def blackjack(bot, world, scale):
+    """Blackjack sessions: start (mostly with a bet), look at the hand now and then,
+    hit below 17, stand."""
+    rng = world.rng
+    players = world.users[:1000]
+
+    async def session(i):
+        player = players[i % len(players)]
+        for _ in range(int(25 * scale)):
+            ctx = world.ctx(player)
+            bet = rng.randrange(1, 50) * bot.CENTS if rng.random() < 0.9 else 0
+            await world.call("bj start", bot.bj_start.callback(ctx, bet))
+            while True:
+                game = bot.ACTIVE_GAMES.get(player.id)
+                if game is None or game.finished:
+                    break
+                await asyncio.sleep(0)
+                if rng.random() < 0.3:
+                    await world.call("bj hand", bot.bj_hand.callback(ctx))
+                if game.player.score < 17:
+                    await world.call("bj hit", bot.bj_hit.callback(ctx))
+                else:
+                    await world.call("bj stand", bot.bj_stand.callback(ctx))
+            await asyncio.sleep(0)
+
+    await sessions(200, session)
+    world.checks["no games left open"] = not any(not g.finished for g in bot.ACTIVE_GAMES.games.values())
+
+
+@workload
+async def loans(bot, world, scale):
+    """!loan take / repay / info / accrue from a thousand borrowers."""
+    rng = world.rng
+    borrowers = world.users[:1000]
+
+    async def session(i):
+        for _ in range(int(50 * scale)):
+            ctx = world.ctx(rng.choice(borrowers))
+            roll = rng.random()
+            if roll < 0.4:
+                await world.call("loan take", bot.sc_loan_take.callback(ctx, rng.randrange(1, 500) * bot.CENTS))
+            elif roll < 0.8:
+                await world.call("loan repay", bot.sc_loan_repay.callback(ctx, rng.randrange(1, 500) * bot.CENTS))
+            elif roll < 0.95:
+                await world.call("loan info", bot.sc_loan_info.callback(ctx, None))
+            else:
+                await world.call("loan accrue", bot.sc_loan_accrue.callback(ctx))
+            await asyncio.sleep(0)
+
+    await sessions(100, session)
+
+
+@workload
+async def mixed(bot, world, scale):
+    """All of the above at once at a third of the size, plus people checking the
+    leaderboard and economy stats."""
+    rng = world.rng
+
+    async def lookers(i):
+        for _ in range(int(20 * scale)):
+            ctx = world.ctx()
+            if rng.random() < 0.5:
+                await world.call("sc globalbal", bot.globalbal.callback(ctx, rng.randrange(1, 50)))
+            else:
+                await world.call("sc stats", bot.sc_stats.callback(ctx))
+            await asyncio.sleep(0.001)
+
+    part = scale / 3
+    await asyncio.gather(transfers(bot, world, part), reactions(bot, world, part), blackjack(bot, world, part),
+                         loans(bot, world, part), sessions(20, lookers))
+    world.checks = {}  # the parts' supply checks don't hold with everything else moving money too
+
+
+# running
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_child(name, scale):
+    """Runs one workload in this (scratch) process and returns its results."""
+    sys.path.insert(0, HERE)
+    import main as bot
+    import_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    world = World(bot, 5000)
+
+    async def run():
+        bot.ECONOMIES.start()
+        bot.DM_OUTBOX.start()
+        await world.seed()
+        start = time.perf_counter()
+        await WORKLOADS[name](bot, world, scale)
+        return time.perf_counter() - start
+
+    seconds = asyncio.run(run())
+    ops = sum(map(len, world.latencies.values()))
+    latency = {}
+    for command, values in sorted(world.latencies.items()):
+        values.sort()
+        latency[command] = {"count": len(values), "p50_ms": percentile(values, 0.5) * 1000,
+                            "p99_ms": percentile(values, 0.99) * 1000}
+    return {
+        "ops": ops,
+        "seconds": seconds,
+        "ops_per_sec": ops / seconds,
+        "latency": latency,
+        "import_rss_mb": import_rss / 1024,  # ru_maxrss is KiB on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "checks": world.checks,
+    }
+
+
+def run_workload(name, storage, scale):
+    workdir = tempfile.mkdtemp(prefix=f"shiftycoin-load-{name}-")
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        # DMs and reaction settling as fast as the handlers can go, limits are not what's measured
+        json.dump({"token": "", "storage": storage, "dm_rate": 1e9, "dm_user_interval": 0,
+                   "reaction_flush_interval": 3600}, f)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name, "--scale", str(scale)],
+                          cwd=workdir, capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stdout + proc.stderr)
+        raise SystemExit(f"{name} failed")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def best_of(results):
+    """One result out of several runs of a workload: the best throughput, latencies and
+    memory any run got (machine noise only ever makes a run slower), checks that held
+    in every run."""
+    best = dict(max(results, key=lambda r: r["ops_per_sec"]))
+    best["peak_rss_mb"] = min(r["peak_rss_mb"] for r in results)
+    best["latency"] = {
+        command: {"count": lat["count"],
+                  "p50_ms": min(r["latency"][command]["p50_ms"] for r in results if command in r["latency"]),
+                  "p99_ms": min(r["latency"][command]["p99_ms"] for r in results if command in r["latency"])}
+        for command, lat in best["latency"].items()
+    }
+    best["checks"] = {check: all(r["checks"].get(check, True) for r in results) for check in best["checks"]}
+    return best
+
+
+def compare(key, result, base, tolerance, latency_tolerance):
+    """Lines describing regressions of result against base, empty if none."""
+    problems = []
+    if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+        problems.append(f"{key}: {result['ops_per_sec']:,.0f} ops/s, was {base['ops_per_sec']:,.0f}")
+    if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+        problems.append(f"{key}: peak {result['peak_rss_mb']:.0f} MB, was {base['peak_rss_mb']:.0f} MB")
+    for command, now in result["latency"].items():
+        was = base["latency"].get(command)
+        # with a couple hundred samples p99 is just the slowest few, and sub-millisecond
+        # differences are mostly scheduling noise
+        if was and now["count"] >= 200 and now["p99_ms"] > max(was["p99_ms"] * (1 + latency_tolerance), was["p99_ms"] + 1):
+            problems.append(f"{key}: {command} p99 {now['p99_ms']:.2f}ms, was {was['p99_ms']:.2f}ms")
+    for check, ok in result["checks"].items():
+        if not ok:
+            problems.append(f"{key}: check failed: {check}")
+    return problems
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="offline load tests for the command handlers")
+    parser.add_argument("workloads", nargs="*", help=f"any of {', '.join(WORKLOADS)} (default all)")
+    parser.add_argument("--storage", default="json", choices=("json", "sqlite"))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the number of operations")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per workload, the best one counts")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed drop in ops/s or growth in memory before it counts as a regression")
+    # p99s on sqlite are mostly how long a commit's fsync took, which swings a lot between runs
+    parser.add_argument("--latency-tolerance", type=float, default=1.0, help="same for p99 latencies, which move more between runs")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.scale)))
+        return 0
+
+    names = args.workloads or list(WORKLOADS)
+    for name in names:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name}")
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    problems = []
+    for name in names:
+        key = f"{name}/{args.storage}" + (f"@{args.scale:g}" if args.scale != 1 else "")
+        result = best_of([run_workload(name, args.storage, args.scale) for _ in range(max(1, args.repeat))])
+        print(f"{key}: {' '.join(WORKLOADS[name].__doc__.split())}")
+        print(f"  {result['ops']:,} ops in {result['seconds']:.2f}s = {result['ops_per_sec']:,.0f} ops/s (best of {args.repeat}), "
+              f"peak {result['peak_rss_mb']:.0f} MB ({result['import_rss_mb']:.0f} MB after import)")
+        for command, lat in result["latency"].items():
+            print(f"  {command:<15} {lat['count']:>7,}  p50 {lat['p50_ms']:7.3f}ms  p99 {lat['p99_ms']:7.3f}ms")
+        for check, ok in result["checks"].items():
+            print(f"  {check}: {'ok' if ok else 'FAILED'}")
+        if key in baseline and not args.save:
+            problems.extend(compare(key, result, baseline[key], args.tolerance, args.latency_tolerance))
+        baseline[key] = result
+
+    if args.save:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"saved as the baseline in {os.path.basename(BASELINE_FILE)}")
+        return 0
+    if problems:
+        print("\nregressions against the baseline:")
+        print("\n".join(f"  {line}" for line in problems))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
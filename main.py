@@ -1,10 +1,25 @@
 import os
-import random
 import asyncio
 import discord
 import json
 from discord.ext import commands
 import datetime
+from aggregates import BalanceIndex
+from blackjack import BlackjackGame, Shoe, hand_str, card_str
+from loans import BASE_LOAN_RATE, accrue_record, compute_rate_for_count, first_of_month, months_between
+from metrics import Metrics
+from money import CENTS, to_cents, sc_str
+from profiler import SamplingProfiler
+import storage
+from storage import ECONOMIES, STORAGE_POOL, legacy_pending, migrate_legacy, write_snapshot
+import sqlite3
+import weakref
+import contextlib
+import traceback
+import time
+import collections
+import inspect
+import threading
 
 
 # config
@@ -14,351 +29,801 @@ PREFIX = "!"
 INTENTS = discord.Intents.default()
 INTENTS.message_content = True
 
-# deck, scoring
-RANKS = ["A", "2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K"]
-SUITS = ["♠", "♥", "♦", "♣"]
+# "standalone" is the whole bot in this one process. a sharded deployment (see cluster.py)
+# runs one "service" process that owns the ledger and loan files, and "shard" processes
+# for the gateway that reach the ledger through the service over LEDGER_SOCKET
+ROLE = os.getenv("SHIFTYCOIN_ROLE", "standalone")
+LEDGER_SOCKET = config.get("ledger_socket", "ledger.sock")
+SHARD_COUNT = int(os.getenv("SHIFTYCOIN_SHARD_COUNT", 0)) or config.get("shard_count")  # None lets discord pick
+SHARD_IDS = [int(i) for i in os.getenv("SHIFTYCOIN_SHARDS", "").split(",") if i]  # this process's shards
+
+# latency/error/io metrics for `!sc metrics`, and as prometheus text on
+# http://METRICS_HOST:METRICS_PORT/metrics when a port is set (cluster.py gives each process its own)
+METRICS_HOST = config.get("metrics_host", "127.0.0.1")
+METRICS_PORT = int(os.getenv("SHIFTYCOIN_METRICS_PORT", 0)) or config.get("metrics_port")  # None is no endpoint
+LOOP_LAG_INTERVAL = config.get("loop_lag_interval", 0.25)  # seconds between event loop lag samples
+METRICS = Metrics()
 
 # reaction rewards
 REWARD_EMOTE = "⭐"  # emote that gives shiftycoin
 PENALTY_EMOTE = "💀"  # emote that removes shiftycoin
 REACTIONS_PER_SC = 1  # number of reactions needed per shiftycoin
+REACTION_FLUSH_INTERVAL = config.get("reaction_flush_interval", 2.0)  # seconds reactions are batched before paying out
+REACTION_STATE_FILE = config.get("reaction_state_file", "reactions.db")  # what has already been paid out per message
+REACTION_CACHE_SIZE = config.get("reaction_cache_size", 10000)  # messages kept in memory
+REACTION_CACHE_AGE = config.get("reaction_cache_age", 86400)  # seconds before an idle message is dropped from memory
 
 # track reactions per message to avoid duplicate processing
 PROCESSED_REACTIONS = {}
 
-def new_deck(shuffle=True):
-    deck = [f"{r}{s}" for r in RANKS for s in SUITS]
-    if shuffle:
-        random.shuffle(deck)
-    return deck
-
-def card_value(card):
-    rank = card[:-1]  # drop suit
-    if rank in ("J", "Q", "K"):
-        return 10
-    if rank == "A":
-        return 11
-    return int(rank)
-
-def score_hand(cards):
-    # Return best score <=21 if possible, else minimal over 21
-    total = 0
-    aces = 0
-    for c in cards:
-        v = card_value(c)
-        total += v
-        if c[:-1] == "A":
-            aces += 1
-    # reduce Aces from 11 to 1 as needed
-    while total > 21 and aces:
-        total -= 10
-        aces -= 1
-    return total
-
-def hand_str(cards, hide_first=False):
-    if hide_first and cards:
-        return "?? " + " ".join(cards[1:])
-    return " ".join(cards)
-
-# game state management
-class BlackjackGame:
-    def __init__(self):
-        self.deck = new_deck()
-        self.player = []
-        self.dealer = []
-        self.finished = False
-        self.result = None  # "win", "lose", "push"
-        self.shiftycoinResult = 0
-
-    def deal_initial(self):
-        self.player.append(self.deck.pop())
-        self.dealer.append(self.deck.pop())
-        self.player.append(self.deck.pop())
-        self.dealer.append(self.deck.pop())
-
-    def player_hit(self):
-        self.player.append(self.deck.pop())
-        return self.player[-1]
-
-    def dealer_play(self):
-        # Dealer reveals and hits until >=17
-        while score_hand(self.dealer) < 17:
-            self.dealer.append(self.deck.pop())
-    
-    def evaluateSC(self, uid):
-        p = score_hand(self.player)
-        d = score_hand(self.dealer)
-        w = 0
-        if p > 21:
-            self.shiftycoinResult = (p / 10) * -1
-            w = 0
-        elif d > 21:
-            self.shiftycoinResult = p / 10
-            w = 1
-        elif p > d:
-            self.shiftycoinResult = p / 10
-            w = 1
-        elif p < d:
-            self.shiftycoinResult = (p / 10) * -1
-            w = 0
-        else:
-            self.shiftycoinResult = 0
-            w = 2
-        #print (w, "w")
-        #print (uid, "uid")
-        #print (get_bet([uid]), "bet")
-        
-        if self.finished == True :
-            if get_bet([uid]) != 0 and w == 1 :
-                self.shiftycoinResult = get_bet([uid])
-                #print (self.shiftycoinResult, "win w bet")
-            elif get_bet([uid]) != 0 and w == 0 :
-                self.shiftycoinResult = get_bet([uid]) * -1
-                #print (self.shiftycoinResult, "lose w bet")
-            elif get_bet([uid]) != 0 and w == 2 :
-                self.shiftycoinResult = 0
-                #print (self.shiftycoinResult, "push w bet")
-            return self.shiftycoinResult
-        else :
-            return 0
-
-    def evaluate(self):
-        p = score_hand(self.player)
-        d = score_hand(self.dealer)
-        if p > 21:
-            self.result = "lose"
-        elif d > 21:
-            self.result = "win"
-        elif p > d:
-            self.result = "win"
-        elif p < d:
-            self.result = "lose"
-        else:
-            self.result = "push"
-        self.finished = True
-        return self.result
-
 # shiftycoin management
-SHIFTYCOIN_FILE = "shiftycoin.json"
-LOANS_FILE = "loans.json"
-
-def load_shiftycoin():
-    if os.path.exists(SHIFTYCOIN_FILE):
-        with open(SHIFTYCOIN_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_shiftycoin(data):
-    with open(SHIFTYCOIN_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
-
-def get_balance(user_id):
-    shiftycoin = load_shiftycoin()
-    return shiftycoin.get(str(user_id), 0.0)
-
-def add_balance(user_id, amount):
-    shiftycoin = load_shiftycoin()
-    user_id = str(user_id)
-    shiftycoin[user_id] = shiftycoin.get(user_id, 0.0) + amount
-    save_shiftycoin(shiftycoin)
-    return shiftycoin[user_id]
-
-# the great wealth redistributor 
-def mass_redistribute_shiftycoin():
-    shiftycoin = load_shiftycoin()
-    if not shiftycoin:
-        return {}
-
-    # cents because floating point precision is bad
-    total_cents = sum(int(round(float(v) * 100)) for v in shiftycoin.values())
-    users = sorted(shiftycoin.keys())  # deterministic order for remainder distribution
-    n = len(users)
-    if n == 0:
-        return {}
-
-    share_cents = total_cents // n
-    remainder = total_cents % n
-
-    new_balances = {}
-    for idx, uid in enumerate(users):
-        cents = share_cents + (1 if idx < remainder else 0)
-        new_balances[uid] = round(cents / 100.0, 2)
-
-    save_shiftycoin(new_balances)
-    return new_balances
-
-# betting json logic for bj
-bet = {}
-def add_bet(user_id, amount):
-    user_id = str(user_id)
-    bet[user_id] = amount
-    #print (bet, "bet added")
-    return bet[user_id]
-
-def get_bet(user_id):
-    user_id = str(user_id)
-    return bet.get(user_id, 0.0)
-
-
-# loans logic
-BASE_LOAN_RATE = 0.02        # base monthly interest rate (2%)
-RATE_STEP_PER_LOAN = 0.005   # increase per active loan (0.5%)
-LOANS_FILE = globals().get("LOANS_FILE", "loans.json")
-
-def load_loans():
-    if os.path.exists(LOANS_FILE):
-        with open(LOANS_FILE, "r") as f:
-            try:
-                return json.load(f)
-            except Exception:
-                return {}
-    return {}
-
-def save_loans(data):
-    with open(LOANS_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+# balances and loans live in storage.py, set up from the same config.json. anything that
+# only reads goes through ECONOMIES.find, so looking at a guild without an economy
+# doesn't leave an empty one behind
+storage.configure(config, METRICS)
+
+def load_shiftycoin(guild_id):
+    # copy so callers can mutate it and hand it back to save_shiftycoin
+    eco = ECONOMIES.find(guild_id)
+    return eco.ledger.all() if eco else {}
+
+def save_shiftycoin(guild_id, data):
+    ECONOMIES[guild_id].ledger.replace(data)
+
+def get_balance(guild_id, user_id):
+    eco = ECONOMIES.find(guild_id)
+    return eco.ledger.get(user_id) if eco else 0
+
+def add_balance(guild_id, user_id, amount):
+    return ECONOMIES[guild_id].ledger.add(user_id, amount)
+
+# per-account locks for anything that reads a balance and writes it back, an account
+# being a user in one guild's economy. weak values so locks for idle accounts get
+# dropped instead of piling up
+_ACCOUNT_LOCKS = weakref.WeakValueDictionary()
+
+def _account_lock(guild_id, user_id):
+    key = (int(guild_id), str(user_id))
+    lock = _ACCOUNT_LOCKS.get(key)
+    if lock is None:
+        lock = _ACCOUNT_LOCKS[key] = asyncio.Lock()
+    return lock
+
+@contextlib.asynccontextmanager
+async def account_locks(guild_id, *user_ids):
+    # always taken in sorted order so two transfers going opposite ways can't deadlock
+    locks = [_account_lock(guild_id, uid) for uid in sorted({str(uid) for uid in user_ids})]
+    async with contextlib.AsyncExitStack() as stack:
+        for lock in locks:
+            await stack.enter_async_context(lock)
+        yield
+
+async def transfer(guild_id, src, dst, amount):
+    """Move amount from src to dst in one guild's economy as one read-modify-write under both
+    accounts' locks. Returns (new_src_balance, new_dst_balance), raises ValueError if src can't cover it."""
+    if amount <= 0:
+        raise ValueError("Amount must be positive.")
+    async with account_locks(guild_id, src, dst):
+        return await store.run(_move_balance, guild_id, src, dst, amount)
+
+def _move_balance(guild_id, src, dst, amount):
+    src_bal = get_balance(guild_id, src)
+    if src_bal < amount:
+        raise ValueError("Insufficient balance.")
+    ledger = ECONOMIES[guild_id].ledger
+    ledger.set(str(src), src_bal - amount)
+    dst_bal = ledger.get(dst) + amount
+    ledger.set(str(dst), dst_bal)
+    return ledger.get(src), dst_bal
+
+# the great wealth redistributor
+# streams over the ledger in user id order instead of building a second copy of it:
+# one pass to add everything up, one to hand out the shares. both walk the accounts
+# that existed when the walk started, an account opened in between would otherwise
+# get a share of money that was never counted
+REDISTRIBUTE_CHUNK = config.get("redistribute_chunk", 1000)  # balances read/written per step
+
+def _walk_start(guild_id):
+    eco = ECONOMIES.find(guild_id)
+    return eco.ledger.walk_start() if eco else 0
+
+def _walk_end(guild_id):
+    eco = ECONOMIES.find(guild_id)
+    if eco:
+        eco.ledger.walk_end()
+
+def _sum_chunk(guild_id, after, mark):
+    """(next after, users, cents) for the walk's next chunk, next after is None once it's done."""
+    eco = ECONOMIES.find(guild_id)
+    if eco is None:
+        return None, 0, 0
+    rows, after = eco.ledger.chunk_after(after, mark, REDISTRIBUTE_CHUNK)
+    return after, len(rows), sum(bal for _, bal in rows)
+
+def _level_chunk(guild_id, after, mark, share, remainder, seen):
+    """Give the walk's next chunk of users their share, the first `remainder` users
+    overall (seen counts the ones before this chunk) get one cent more. Returns
+    (next after, users levelled)."""
+    ledger = ECONOMIES[guild_id].ledger
+    rows, after = ledger.chunk_after(after, mark, REDISTRIBUTE_CHUNK)
+    ledger.set_many({uid: share + (1 if seen + i < remainder else 0) for i, (uid, _) in enumerate(rows)})
+    return after, len(rows)
+
+def mass_redistribute_shiftycoin(guild_id):
+    """Level every balance in the guild's economy in one go, returns how many users
+    were levelled. The bot runs the same passes as a RedistributionJob instead."""
+    mark = _walk_start(guild_id)
+    try:
+        after, users, total = "", 0, 0
+        while after is not None:
+            after, n, cents = _sum_chunk(guild_id, after, mark)
+            users += n
+            total += cents
+        if not users:
+            return 0
+        share, remainder = divmod(total, users)
+        after, seen = "", 0
+        while after is not None:
+            after, n = _level_chunk(guild_id, after, mark, share, remainder, seen)
+            seen += n
+        return seen
+    finally:
+        _walk_end(guild_id)
+
+# loans logic, rates and the interest math are in loans.py
+def load_loans(guild_id):
+    # copy so callers can mutate it and hand it back to save_loans
+    eco = ECONOMIES.find(guild_id)
+    return eco.loans.all() if eco else {}
+
+def save_loans(guild_id, data):
+    ECONOMIES[guild_id].loans.replace(data)
 
 def _today_date():
     return datetime.date.today()
 
-def _first_of_month(dt: datetime.date):
-    return datetime.date(dt.year, dt.month, 1)
-
-def _months_between(d1: datetime.date, d2: datetime.date):
-    # number of full month boundaries from d1 (inclusive) to d2 (exclusive)
-    return (d2.year - d1.year) * 12 + (d2.month - d1.month)
-
-def get_loan_record(user_id):
-    loans = load_loans()
-    return loans.get(str(user_id), {"balance": 0.0, "active_count": 0, "rate": BASE_LOAN_RATE, "last_accrued": None})
+def _stored_loan_record(guild_id, user_id):
+    eco = ECONOMIES.find(guild_id)
+    rec = eco.loans.get(str(user_id)) if eco else None
+    if rec is None:
+        return {"balance": 0, "active_count": 0, "rate": BASE_LOAN_RATE, "last_accrued": None}
+    return dict(rec)
+
+def get_loan_record(guild_id, user_id):
+    """The loan as it stands today: interest for any months since last_accrued is
+    worked out from the stored balance, rate and last_accrued on the fly. Reading
+    never writes, the record only changes on disk when its balance does."""
+    rec = _stored_loan_record(guild_id, user_id)
+    accrue_record(rec, first_of_month(_today_date()))
+    return rec
 
-def set_loan_record(user_id, record):
-    loans = load_loans()
-    loans[str(user_id)] = record
-    save_loans(loans)
+def _loan_info(guild_id, user_id):
+    """(record as it stands today, last_accrued as stored, interest owed since then) for
+    !loan info. The record's own last_accrued has already moved on to this month."""
+    rec = _stored_loan_record(guild_id, user_id)
+    last = rec.get("last_accrued")
+    _, _, owed = accrue_record(rec, first_of_month(_today_date()))
+    return rec, last, owed
 
-def compute_rate_for_count(count):
-    if count <= 0:
-        return BASE_LOAN_RATE
-    return round(BASE_LOAN_RATE + RATE_STEP_PER_LOAN * (count - 1), 6)
+def set_loan_record(guild_id, user_id, record):
+    ECONOMIES[guild_id].loans.set(str(user_id), dict(record))
 
-def accrue_interest_for_user(user_id):
+def accrue_interest_for_user(guild_id, user_id):
     """Apply monthly interest for any months passed since last_accrued.
-    Returns (applied_months, interest_amount_applied) or (0, 0.0)."""
-    rec = get_loan_record(user_id)
-    balance = float(rec.get("balance", 0.0))
-    if balance <= 0.0:
-        # nothing to do but ensure last_accrued is up to date
-        rec["last_accrued"] = _first_of_month(_today_date()).isoformat()
-        set_loan_record(user_id, rec)
-        return 0, 0.0
-
-    last_iso = rec.get("last_accrued")
-    if last_iso:
-        try:
-            last_date = datetime.date.fromisoformat(last_iso)
-        except Exception:
-            last_date = _first_of_month(_today_date())
-    else:
-        # if never accrued, set it to the month the loan was created (approx)
-        last_date = _first_of_month(_today_date())
-
-    today_first = _first_of_month(_today_date())
-    months = _months_between(last_date, today_first)
-    if months <= 0:
-        return 0, 0.0
-
-    rate = float(rec.get("rate", compute_rate_for_count(rec.get("active_count", 0))))
-    interest_total = 0.0
-    # apply compound monthly interest for each month passed
-    for _ in range(months):
-        interest = round(balance * rate, 2)
-        balance = round(balance + interest, 2)
-        interest_total = round(interest_total + interest, 2)
-
-    rec["balance"] = round(balance, 2)
-    rec["last_accrued"] = today_first.isoformat()
-    rec["rate"] = rate
-    set_loan_record(user_id, rec)
-    return months, interest_total
-
-def take_loan_for_user(user_id, amount):
-    """Create/increase a loan. Returns updated record."""
+    Returns (applied_months, interest_amount_applied) or (0, 0)."""
+    rec = _stored_loan_record(guild_id, user_id)
+    _, months, interest = accrue_record(rec, first_of_month(_today_date()))
+    # only write when interest actually moved the balance
+    if months > 0:
+        set_loan_record(guild_id, user_id, rec)
+    return months, interest
+
+def take_loan_for_user(guild_id, user_id, amount):
+    """Create/increase a loan of amount cents. Returns updated record."""
     if amount <= 0:
         raise ValueError("Loan amount must be positive.")
-    rec = get_loan_record(user_id)
-    # apply any pending interest before taking a new loan
-    accrue_interest_for_user(user_id)
-    rec = get_loan_record(user_id)  # reload after accrual
+    # pending interest is already folded into the record we read
+    rec = get_loan_record(guild_id, user_id)
     rec["active_count"] = rec.get("active_count", 0) + 1
     rec["rate"] = compute_rate_for_count(rec["active_count"])
-    rec["balance"] = round(float(rec.get("balance", 0.0)) + round(amount, 2), 2)
+    rec["balance"] = rec.get("balance", 0) + amount
     # set last_accrued to current month start so interest won't be applied until next month
-    rec["last_accrued"] = _first_of_month(_today_date()).isoformat()
-    set_loan_record(user_id, rec)
+    rec["last_accrued"] = first_of_month(_today_date()).isoformat()
+    set_loan_record(guild_id, user_id, rec)
     # deposit loan amount to user's shiftycoin balance
-    add_balance(user_id, amount)
+    add_balance(guild_id, user_id, amount)
     return rec
 
-def repay_loan_for_user(user_id, amount):
+def repay_loan_for_user(guild_id, user_id, amount):
     """Repay part or all of a loan. Returns (new_record, repaid_amount, overpayment_returned)."""
     if amount <= 0:
         raise ValueError("Repay amount must be positive.")
-    rec = get_loan_record(user_id)
-    # apply pending interest before repayment
-    accrue_interest_for_user(user_id)
-    rec = get_loan_record(user_id)
-    balance = float(rec.get("balance", 0.0))
+    # pending interest is already folded into the record we read
+    rec = get_loan_record(guild_id, user_id)
+    balance = rec.get("balance", 0)
     if balance <= 0:
-        return rec, 0.0, round(amount, 2)  # nothing owed, return all
+        return rec, 0, amount  # nothing owed, return all
 
-    repay = round(amount, 2)
+    repay = amount
     if repay >= balance:
-        over = round(repay - balance, 2)
+        over = repay - balance
         repaid = balance
-        rec["balance"] = 0.0
+        rec["balance"] = 0
         # reduce active_count by 1 when fully paid off (if >0)
         if rec.get("active_count", 0) > 0:
             rec["active_count"] = max(0, rec["active_count"] - rec["active_count"])
         rec["rate"] = compute_rate_for_count(rec.get("active_count", 0))
-        set_loan_record(user_id, rec)
+        set_loan_record(guild_id, user_id, rec)
         # if overpayment, refund to shiftycoin balance
         if over > 0:
-            add_balance(user_id, over)
-        return rec, round(repaid, 2), over
+            add_balance(guild_id, user_id, over)
+        return rec, repaid, over
     else:
-        rec["balance"] = round(balance - repay, 2)
-        set_loan_record(user_id, rec)
-        return rec, repay, 0.0
+        rec["balance"] = balance - repay
+        set_loan_record(guild_id, user_id, rec)
+        return rec, repay, 0
 
-def accrue_interest_all():
-    loans = load_loans()
+def repay_loan_from_balance(guild_id, user_id, amount):
+    """Take amount out of the user's balance and put it toward their loan in one go,
+    so nothing can spend the balance in between. Returns what repay_loan_for_user does."""
+    if amount <= 0:
+        raise ValueError("Repay amount must be positive.")
+    # check first, repay_loan_for_user hands the whole amount back as "over" without refunding it
+    if get_loan_record(guild_id, user_id).get("balance", 0) <= 0:
+        raise ValueError("You don't have a loan to repay.")
+    if get_balance(guild_id, user_id) < amount:
+        raise ValueError("Insufficient Shiftycoin balance to repay that amount.")
+    add_balance(guild_id, user_id, -amount)
+    return repay_loan_for_user(guild_id, user_id, amount)
+
+def _accrue_users(guild_id, user_ids, today_first):
+    """Accrue the given users' loans in one guild against the current records and write
+    the changed ones back in one bulk write. Returns {uid: {"months", "interest"}}."""
+    eco = ECONOMIES.find(guild_id)
+    if eco is None:
+        return {}
+    loans = eco.loans
     results = {}
-    for uid, rec in loans.items():
-        months_before = 0
+    updates = {}
+    for uid in user_ids:
+        rec = loans.get(uid)
+        if rec is None:
+            continue
+        rec = dict(rec)
+        last_iso = rec.get("last_accrued")
         try:
-            last_iso = rec.get("last_accrued")
-            last_date = datetime.date.fromisoformat(last_iso) if last_iso else _first_of_month(_today_date())
+            last_date = datetime.date.fromisoformat(last_iso) if last_iso else today_first
         except Exception:
-            last_date = _first_of_month(_today_date())
-        months = _months_between(last_date, _first_of_month(_today_date()))
-        if months > 0:
-            months_applied, interest = accrue_interest_for_user(int(uid))
-            results[uid] = {"months": months_applied, "interest": interest}
+            last_date = today_first
+        if months_between(last_date, today_first) <= 0:
+            continue
+        changed, months_applied, interest = accrue_record(rec, today_first)
+        if changed:
+            updates[uid] = rec
+        results[uid] = {"months": months_applied, "interest": interest}
+    loans.set_many(updates)
     return results
 
+def _due_user_ids(guild_id, today_first):
+    eco = ECONOMIES.find(guild_id)
+    return list(eco.loans.due_for_accrual(today_first.isoformat())) if eco else []
+
+def accrue_interest_all(guild_id):
+    """Accrue every loan in the guild that's behind in one pass: one read of its loan
+    book, the interest worked out in memory, one bulk write at the end."""
+    today_first = first_of_month(_today_date())
+    return _accrue_users(guild_id, _due_user_ids(guild_id, today_first), today_first)
+
+def _guild_ids():
+    return ECONOMIES.guild_ids()
+
+if ROLE != "shard" and storage.LEGACY_GUILD is not None:
+    migrate_legacy(storage.LEGACY_GUILD)
+
+
+def _leaderboard(guild_id, offset, limit, user_id=None):
+    eco = ECONOMIES.find(guild_id)
+    if eco is None:
+        return [], 0, 0, None
+    index = eco.ledger.index
+    rank = index.rank(user_id) if user_id is not None else None
+    return index.page(offset, limit), len(index), index.total, rank
+
+def _economy_stats(guild_id):
+    eco = ECONOMIES.find(guild_id)
+    return (eco.ledger.index if eco else BalanceIndex()).stats()
+
+def _run_sqlite(fn, *args):
+    # on STORAGE_POOL. commits wait until the whole op is in the transaction
+    result = fn(*args)
+    if fn in ECONOMY_OPS:
+        ECONOMIES.commit_due(args[0])
+    return result
+
+class AsyncStorage:
+    """Awaitable versions of the storage helpers for use inside handlers. The json
+    backend is all in memory once a guild's economy is open, so calls run inline
+    (opening the economy and its flushes go to STORAGE_POOL), sqlite calls are handed
+    to STORAGE_POOL so queries never stall the gateway loop. Everything but run() takes
+    the guild id whose economy it's about, a guild that has none reads as empty."""
+
+    async def run(self, fn, *args):
+        with METRICS.timer("storage", op=fn.__name__):
+            if storage.STORAGE == "sqlite":
+                return await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, _run_sqlite, fn, *args)
+            if fn in ECONOMY_OPS and int(args[0]) not in ECONOMIES.open:
+                # opening reads the guild's snapshot and journal and sorts its balances,
+                # which for a big guild would hold up the gateway
+                await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, ECONOMIES.find, args[0])
+            return fn(*args)
+
+    async def get_balance(self, guild_id, user_id):
+        return await self.run(get_balance, guild_id, user_id)
+
+    async def add_balance(self, guild_id, user_id, amount):
+        return await self.run(add_balance, guild_id, user_id, amount)
+
+    async def leaderboard(self, guild_id, offset, limit, user_id=None):
+        # (page, total users, guild total, rank of user_id)
+        return await self.run(_leaderboard, guild_id, offset, limit, user_id)
+
+    async def stats(self, guild_id):
+        return await self.run(_economy_stats, guild_id)
+
+    async def get_loan_record(self, guild_id, user_id):
+        return await self.run(get_loan_record, guild_id, user_id)
+
+    async def loan_info(self, guild_id, user_id):
+        return await self.run(_loan_info, guild_id, user_id)
+
+    async def set_loan_record(self, guild_id, user_id, record):
+        return await self.run(set_loan_record, guild_id, user_id, record)
+
+    async def take_loan(self, guild_id, user_id, amount):
+        return await self.run(take_loan_for_user, guild_id, user_id, amount)
+
+    async def repay_loan(self, guild_id, user_id, amount):
+        return await self.run(repay_loan_for_user, guild_id, user_id, amount)
+
+    async def repay_loan_from_balance(self, guild_id, user_id, amount):
+        return await self.run(repay_loan_from_balance, guild_id, user_id, amount)
+
+    async def accrue_interest(self, guild_id, user_id):
+        return await self.run(accrue_interest_for_user, guild_id, user_id)
+
+    async def accrue_interest_all(self, guild_id):
+        # same as accrue_interest_all() but in ACCRUAL_CHUNK sized pieces with a yield
+        # to the event loop between them, records are re-read per chunk so loans
+        # taken or repaid in between aren't overwritten
+        today_first = first_of_month(_today_date())
+        user_ids = await self.run(_due_user_ids, guild_id, today_first)
+        results = {}
+        for i in range(0, len(user_ids), ACCRUAL_CHUNK):
+            results.update(await self.run(_accrue_users, guild_id, user_ids[i:i + ACCRUAL_CHUNK], today_first))
+            await asyncio.sleep(0)
+        return results
+
+    async def flush(self):
+        await ECONOMIES.flush_async()
+
+    async def service_metrics(self):
+        return None  # no ledger service, storage shows up in this process's own METRICS
+
+SERVICE_LINE_LIMIT = 2 ** 24  # longest request/reply line, big accrual results included
+
+class RemoteStorage(AsyncStorage):
+    """AsyncStorage for shard processes. Every call goes to the ledger service as one
+    {"id", "op", "args"} json line over LEDGER_SOCKET and the answer comes back as
+    {"id", "result"} or {"id", "error", "type"}; run(fn, ...) sends fn's name and the
+    service looks it up in SERVICE_OPS. Calls from one shard are pipelined over a
+    single connection, which is reopened on the next call if it drops."""
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.calls = {}  # request id -> future
+        self.next_id = 0
+        self._connecting = asyncio.Lock()
+
+    async def _connection(self):
+        async with self._connecting:
+            if self.writer is None or self.writer.is_closing():
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=SERVICE_LINE_LIMIT)
+                asyncio.create_task(self._read_loop(reader, self.writer))
+            return self.writer
+
+    async def _read_loop(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                reply = json.loads(line)
+                future = self.calls.pop(reply["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" not in reply:
+                    future.set_result(reply["result"])
+                elif reply["type"] == "ValueError":
+                    future.set_exception(ValueError(reply["error"]))
+                else:
+                    future.set_exception(RuntimeError(f"ledger service: {reply['type']}: {reply['error']}"))
+        finally:
+            writer.close()
+            # whatever was in flight on this connection is lost
+            for future in self.calls.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("lost the connection to the ledger service"))
+            self.calls.clear()
+
+    async def call(self, op, *args):
+        # timed here as the whole round trip, the service times the op itself
+        with METRICS.timer("storage", op=op):
+            writer = await self._connection()
+            self.next_id += 1
+            future = self.calls[self.next_id] = asyncio.get_running_loop().create_future()
+            writer.write(json.dumps({"id": self.next_id, "op": op, "args": args}).encode() + b"\n")
+            await writer.drain()
+            return await future
+
+    async def run(self, fn, *args):
+        return await self.call(fn.__name__, *args)
+
+    async def accrue_interest_all(self, guild_id):
+        return await self.call("accrue_interest_all", guild_id)
+
+    async def flush(self):
+        pass  # the service flushes its own stores
+
+    async def service_metrics(self):
+        return await self.call("metrics")
+
+class LedgerService:
+    """The ledger end of a sharded deployment: owns every guild's economy and answers
+    RemoteStorage calls from every shard. Each op is a plain storage function run
+    through the local AsyncStorage, so it is applied whole before the next one
+    starts, which is what keeps balances and loans consistent across shards."""
+
+    def __init__(self):
+        self.local = AsyncStorage()
+        self.clients = 0
+        self.requests = 0
+        self.errors = 0
+
+    async def _answer(self, request, writer):
+        self.requests += 1
+        try:
+            op = request["op"]
+            if op == "accrue_interest_all":
+                result = await self.local.accrue_interest_all(*request["args"])
+            elif op == "metrics":
+                result = METRICS.snapshot()
+            else:
+                result = await self.local.run(SERVICE_OPS[op], *request["args"])
+            reply = {"id": request["id"], "result": result}
+        except Exception as e:
+            self.errors += 1
+            reply = {"id": request["id"], "error": str(e), "type": type(e).__name__}
+        if not writer.is_closing():
+            writer.write(json.dumps(reply).encode() + b"\n")
+
+    async def handle(self, reader, writer):
+        self.clients += 1
+        try:
+            while line := await reader.readline():
+                # one task per request so a slow one (accrue_interest_all) doesn't hold up
+                # the rest, they still start in the order they arrived
+                asyncio.create_task(self._answer(json.loads(line), writer))
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    def stats(self):
+        return {"clients": self.clients, "requests": self.requests, "errors": self.errors}
+
+    async def serve(self):
+        METRICS.add_source("ledger_service", self.stats)
+        METRICS.start(METRICS_PORT, METRICS_HOST, LOOP_LAG_INTERVAL)
+        ECONOMIES.start()
+        INTEREST_SCHEDULER.start()
+        if storage.LEGACY_GUILD is None and legacy_pending():
+            print(f"the old economy in {storage.SHIFTYCOIN_FILE}/{storage.LOANS_FILE} belongs to no guild yet, set legacy_guild in config.json")
+        if os.path.exists(LEDGER_SOCKET):
+            os.remove(LEDGER_SOCKET)  # left over from a previous run
+        server = await asyncio.start_unix_server(self.handle, LEDGER_SOCKET, limit=SERVICE_LINE_LIMIT)
+        print(f"ledger service listening on {LEDGER_SOCKET}")
+        async with server:
+            await server.serve_forever()
+
+# what shards may run on the service, by name
+SERVICE_OPS = {fn.__name__: fn for fn in (
+    get_balance, add_balance, _move_balance, _leaderboard, _economy_stats,
+    get_loan_record, _loan_info, set_loan_record, take_loan_for_user, repay_loan_for_user, repay_loan_from_balance,
+    accrue_interest_for_user, _walk_start, _sum_chunk, _level_chunk, _walk_end,
+)}
+
+# storage functions that take a guild id first, AsyncStorage.run opens that guild's economy before running one
+ECONOMY_OPS = set(SERVICE_OPS.values()) | {
+    load_shiftycoin, save_shiftycoin, load_loans, save_loans, _due_user_ids, _accrue_users, migrate_legacy,
+}
+
+store = RemoteStorage(LEDGER_SOCKET) if ROLE == "shard" else AsyncStorage()
+if ROLE != "shard":
+    METRICS.add_source("economies", ECONOMIES.stats)
+
+# monthly interest runs by itself in the background
+ACCRUAL_STATE_FILE = "accrual_state.json"
+ACCRUAL_CHECK_INTERVAL = config.get("accrual_check_interval", 3600)  # seconds between "is a new month due" checks
+ACCRUAL_CHUNK = config.get("accrual_chunk", 500)  # loans accrued between yields to the event loop
+
+class InterestScheduler:
+    """Accrues every loan in every guild once per month without anyone running
+    `!loan accrue`. The month it last finished is kept in ACCRUAL_STATE_FILE, so a
+    restart doesn't run it again, and after downtime the first check catches up: every
+    record carries its own last_accrued, so all the months it missed are applied once."""
+
+    def __init__(self):
+        self.last_run = self._load()
+        self._task = None
+
+    def _load(self):
+        if not os.path.exists(ACCRUAL_STATE_FILE):
+            return None
+        with open(ACCRUAL_STATE_FILE, "r") as f:
+            try:
+                return datetime.date.fromisoformat(json.load(f)["last_run"])
+            except Exception:
+                return None
+
+    async def run_if_due(self):
+        this_month = first_of_month(_today_date())
+        if self.last_run is not None and self.last_run >= this_month:
+            return None
+        results = {}
+        for guild_id in await store.run(_guild_ids):
+            opened = guild_id not in ECONOMIES.open
+            results[guild_id] = await store.accrue_interest_all(guild_id)
+            if opened:
+                # one pass over every guild shouldn't leave the whole world in memory
+                await ECONOMIES.close(guild_id)
+        self.last_run = this_month
+        await asyncio.get_running_loop().run_in_executor(
+            STORAGE_POOL, write_snapshot, ACCRUAL_STATE_FILE, {"last_run": this_month.isoformat()}
+        )
+        loans = sum(map(len, results.values()))
+        print(f"accrued interest for {loans} loan(s) in {len(results)} guild(s) for {this_month.isoformat()}")
+        return results
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_if_due()
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(ACCRUAL_CHECK_INTERVAL)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+INTEREST_SCHEDULER = InterestScheduler()
+
+
+# games deal from shared multi-deck shoes instead of a fresh deck each
+SHOE_DECKS = config.get("shoe_decks", 6)
+SHOE_PENETRATION = config.get("shoe_penetration", 0.75)  # fraction dealt before the shoe is reshuffled
+SHOE_SCOPE = config.get("shoe_scope", "channel")  # "channel" or "guild"
+SHOES = {}
+
+def shoe_key(ctx):
+    return ctx.guild.id if SHOE_SCOPE == "guild" and ctx.guild else ctx.channel.id
+
+def get_shoe(key):
+    shoe = SHOES.get(key)
+    if shoe is None:
+        shoe = SHOES[key] = Shoe(SHOE_DECKS, SHOE_PENETRATION)
+    return shoe
+
+# blackjack sessions
+GAMES_FILE = "games.json" if ROLE != "shard" else f"games.shard{'-'.join(map(str, SHARD_IDS))}.json"  # one per process
+GAME_IDLE_TIMEOUT = config.get("game_idle_timeout", 1800)  # seconds before an untouched game is dropped
+GAME_SWEEP_INTERVAL = config.get("game_sweep_interval", 60)  # seconds between sweeps/saves
+
+class GameSessions:
+    """Blackjack games per user id. Finished games are swept out every
+    GAME_SWEEP_INTERVAL seconds and games nobody touched for GAME_IDLE_TIMEOUT
+    seconds are settled as a stand first (bets aren't held up front, so walking
+    away from a bad hand mustn't get anyone out of paying for it), and
+    the in-flight ones (hands, bet, shoe) are saved to GAMES_FILE at the same time
+    so a restart picks them back up. Games saved before economies were per guild go
+    to LEGACY_GUILD like the old balances do, without one they're kept as they are
+    until adopt() is told which guild they belong to."""
+
+    def __init__(self):
+        self.games = {}  # user id -> BlackjackGame
+        self.touched = {}  # user id -> time.time() of the last command
+        self.shoes = {}  # user id -> key of the shoe the game deals from
+        self.guilds = {}  # user id -> guild whose economy the game settles in
+        self.unplaced = {}  # user id -> saved game that doesn't know its guild yet
+        self.expired = 0  # settled as a stand for idling
+        self.evicted = 0  # dropped after finishing
+        self._sweeper = None
+
+    def __contains__(self, user_id):
+        return user_id in self.games
+
+    def __getitem__(self, user_id):
+        return self.games[user_id]
+
+    def get(self, user_id):
+        game = self.games.get(user_id)
+        if game is not None:
+            self.touched[user_id] = time.time()
+        return game
+
+    def start(self, user_id, game, key, guild_id):
+        self.games[user_id] = game
+        self.shoes[user_id] = key
+        self.guilds[user_id] = guild_id
+        self.touched[user_id] = time.time()
+
+    def pop(self, user_id, default=None):
+        self.touched.pop(user_id, None)
+        self.shoes.pop(user_id, None)
+        self.guilds.pop(user_id, None)
+        return self.games.pop(user_id, default)
+
+    def sweep(self):
+        """Drops finished games, returns [(user id, game)] for the idle ones, which
+        are left in place for the caller to settle."""
+        cutoff = time.time() - GAME_IDLE_TIMEOUT
+        idle = []
+        for uid in list(self.games):
+            if self.games[uid].finished:
+                self.pop(uid)
+                self.evicted += 1
+            elif self.touched[uid] < cutoff:
+                idle.append((uid, self.games[uid]))
+        return idle
+
+    async def settle_idle(self, idle):
+        for uid, game in idle:
+            if self.games.get(uid) is not game or game.finished:
+                continue  # played out or replaced while an earlier one was settling
+            try:
+                await settle_game(uid, game)
+            except Exception:
+                traceback.print_exc()
+                continue  # stays put and gets another go next sweep
+            self.pop(uid)
+            self.expired += 1
+
+    def snapshot(self):
+        data = {}
+        for uid, game in self.games.items():
+            if game.finished:
+                continue
+            entry = game.snapshot()
+            entry["shoe"] = self.shoes[uid]
+            entry["guild"] = self.guilds[uid]
+            entry["touched"] = self.touched[uid]
+            data[str(uid)] = entry
+        for uid, entry in self.unplaced.items():
+            data.setdefault(str(uid), entry)
+        return data
+
+    def load(self):
+        if not os.path.exists(GAMES_FILE):
+            return
+        with open(GAMES_FILE, "r") as f:
+            try:
+                data = json.load(f)
+            except Exception:
+                return
+        for uid_str, entry in data.items():
+            uid = int(uid_str)
+            if "guild" not in entry:
+                # saved before economies were per guild. no bet is held up front, so
+                # dropping it would let whoever was losing walk away without paying
+                if storage.LEGACY_GUILD is None:
+                    self.unplaced[uid] = entry
+                    continue
+                entry = dict(entry, guild=storage.LEGACY_GUILD)
+            self._restore(uid, entry)
+
+    def _restore(self, uid, entry):
+        game = BlackjackGame.from_snapshot(entry, get_shoe(entry["shoe"]))
+        self.start(uid, game, entry["shoe"], entry["guild"])
+        self.touched[uid] = entry.get("touched", time.time())
+
+    async def adopt(self, guild_id):
+        """Carry the games that don't know their guild on in guild_id, returns how many.
+        Anyone who has started another game since has the old one settled as a stand."""
+        adopted = 0
+        for uid in list(self.unplaced):
+            entry = dict(self.unplaced[uid], guild=guild_id)
+            current = self.games.get(uid)
+            if current is not None and not current.finished:
+                game = BlackjackGame.from_snapshot(entry, get_shoe(entry["shoe"]))
+                await settle_game(uid, game, guild_id)
+                self.expired += 1
+            else:
+                self._restore(uid, entry)
+            del self.unplaced[uid]
+            adopted += 1
+        return adopted
+
+    def stats(self):
+        return {"live": len(self.games), "expired": self.expired, "evicted": self.evicted}
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(GAME_SWEEP_INTERVAL)
+            await self.settle_idle(self.sweep())
+            await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, write_snapshot, GAMES_FILE, self.snapshot())
+
+    def start_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
 
 # track blackjack games per user (by user id)
-ACTIVE_GAMES = {}
+ACTIVE_GAMES = GameSessions()
+if ROLE != "service":
+    METRICS.add_source("games", ACTIVE_GAMES.stats)
+ACTIVE_GAMES.load()
 
 
 # bot
-bot = commands.Bot(command_prefix=PREFIX, intents=INTENTS, help_command=None)
+if ROLE == "shard":
+    bot = commands.AutoShardedBot(command_prefix=PREFIX, intents=INTENTS, help_command=None,
+                                  shard_ids=SHARD_IDS or None, shard_count=SHARD_COUNT)
+else:
+    bot = commands.Bot(command_prefix=PREFIX, intents=INTENTS, help_command=None)
+
+# every command goes through bot.invoke, argument conversion and checks included. it
+# swallows the command's exception (on_command_error gets it), ctx.command_failed says if there was one
+_invoke = bot.invoke
+
+async def _timed_invoke(ctx):
+    start = time.perf_counter()
+    try:
+        await _invoke(ctx)
+    finally:
+        if ctx.command is not None:
+            METRICS.observe("command", time.perf_counter() - start, ctx.command_failed, command=ctx.command.qualified_name)
+        if PROFILER.active and ctx.command is not sc_profile:
+            PROFILER.command_done()
+
+bot.invoke = _timed_invoke
+
+@bot.event
+async def on_command_error(ctx, error):
+    if isinstance(error, commands.NoPrivateMessage):
+        await ctx.send("Every server has its own Shiftycoin economy, use this in one.")
+        return
+    await commands.Bot.on_command_error(bot, ctx, error)  # what discord.py does without this handler
 
 @bot.event
+@METRICS.timed("event", event="on_ready")
 async def on_ready():
     print(f"Logged in as {bot.user} ({bot.user.id})")
     print("shiftycoin broker has entered the chatroom.")
+    METRICS.start(METRICS_PORT, METRICS_HOST, LOOP_LAG_INTERVAL)
+    if ROLE != "shard":
+        # in a sharded deployment the ledger service runs these
+        ECONOMIES.start()
+        INTEREST_SCHEDULER.start()
+    if ROLE == "standalone" and storage.LEGACY_GUILD is None and await store.run(legacy_pending):
+        # a bot in just one guild obviously had that guild's economy
+        if len(bot.guilds) == 1:
+            await store.run(migrate_legacy, bot.guilds[0].id)
+        else:
+            print(f"the old economy in {storage.SHIFTYCOIN_FILE}/{storage.LOANS_FILE} belongs to no guild yet, set legacy_guild in config.json")
+    if ACTIVE_GAMES.unplaced:
+        if ROLE == "standalone" and len(bot.guilds) == 1:
+            await ACTIVE_GAMES.adopt(bot.guilds[0].id)
+        else:
+            print(f"{len(ACTIVE_GAMES.unplaced)} game(s) in {GAMES_FILE} belong to no guild yet, set legacy_guild in config.json")
+    REACTION_QUEUE.start()
+    ACTIVE_GAMES.start_sweeper()
+    DM_OUTBOX.start()
     # status
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=config.get("status")))
 
@@ -404,15 +869,116 @@ async def on_reaction_remove(reaction, user):
 '''
 
 # new reaction system cuz the old one is messy and doesnt allow me to change the value of reactions
-APPLIED_REACTIONS = {}
-
-async def _sync_and_apply(message: discord.Message):
-    if message.author.bot:
-        return
-    mid = message.id
-    if mid not in APPLIED_REACTIONS:
-        APPLIED_REACTIONS[mid] = {"reward": 0, "penalty": 0}
+class AppliedReactions:
+    """Reward/penalty units already paid out for one message."""
+    __slots__ = ("reward", "penalty", "touched")
+
+    def __init__(self, reward=0, penalty=0):
+        self.reward = reward
+        self.penalty = penalty
+        self.touched = time.monotonic()
+
+class ReactionState:
+    """Bounded LRU of AppliedReactions keyed by message id. Entries older than
+    REACTION_CACHE_AGE seconds or past REACTION_CACHE_SIZE are dropped from memory,
+    but every settled entry is also written to REACTION_STATE_FILE, so a message
+    that fell out of the cache (or was reacted to before a restart) is read back
+    instead of paying out its reactions again. All disk work runs on STORAGE_POOL."""
 
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(REACTION_STATE_FILE, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS applied (message_id INTEGER PRIMARY KEY, reward INTEGER NOT NULL, penalty INTEGER NOT NULL)"
+            )
+        return self._conn
+
+    @METRICS.timed("file_read", file=REACTION_STATE_FILE)
+    def _load(self, message_ids):
+        found = {}
+        for i in range(0, len(message_ids), 500):
+            chunk = message_ids[i:i + 500]
+            rows = self._db().execute(
+                f"SELECT message_id, reward, penalty FROM applied WHERE message_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            for mid, reward, penalty in rows:
+                found[mid] = (reward, penalty)
+        return found
+
+    @METRICS.timed("file_write", file=REACTION_STATE_FILE)
+    def _save(self, rows):
+        with self._db() as conn:
+            conn.executemany("INSERT OR REPLACE INTO applied (message_id, reward, penalty) VALUES (?, ?, ?)", rows)
+        METRICS.count("sqlite_rows_written", len(rows), file=REACTION_STATE_FILE)
+
+    async def get_many(self, message_ids):
+        found = {}
+        missing = []
+        now = time.monotonic()
+        for mid in message_ids:
+            entry = self.entries.get(mid)
+            if entry is None:
+                missing.append(mid)
+                continue
+            self.hits += 1
+            self.entries.move_to_end(mid)
+            entry.touched = now
+            found[mid] = entry
+        if missing:
+            self.misses += len(missing)
+            stored = await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, self._load, missing)
+            for mid in missing:
+                entry = AppliedReactions(*stored.get(mid, (0, 0)))
+                self.entries[mid] = entry
+                found[mid] = entry
+        return found
+
+    def _dirty_rows(self):
+        rows = [(mid, self.entries[mid].reward, self.entries[mid].penalty) for mid in self.dirty if mid in self.entries]
+        self.dirty.clear()
+        return rows
+
+    async def persist(self):
+        rows = self._dirty_rows()
+        if rows:
+            await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, self._save, rows)
+        self._evict()
+
+    def persist_now(self):
+        # shutdown path, the loop is gone by then
+        rows = self._dirty_rows()
+        if rows:
+            self._save(rows)
+
+    def _evict(self):
+        cutoff = time.monotonic() - REACTION_CACHE_AGE
+        while self.entries:
+            mid, entry = next(iter(self.entries.items()))
+            if len(self.entries) <= REACTION_CACHE_SIZE and entry.touched >= cutoff:
+                break
+            del self.entries[mid]
+            self.evictions += 1
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+REACTION_STATE = ReactionState()
+if ROLE != "service":
+    METRICS.add_source("reactions", REACTION_STATE.stats)
+
+def _reaction_delta(message: discord.Message, applied: AppliedReactions):
+    """(reward units, penalty units, SC change) for the message's current reaction
+    counts against what applied says was paid out already. applied itself is left
+    alone, it only moves up to the new units once the change is in the ledger."""
     reward_count = 0
     penalty_count = 0
     for r in message.reactions:
@@ -425,68 +991,267 @@ async def _sync_and_apply(message: discord.Message):
     reward_units = reward_count // REACTIONS_PER_SC
     penalty_units = penalty_count // REACTIONS_PER_SC
 
-    prev_reward = APPLIED_REACTIONS[mid]["reward"]
-    prev_penalty = APPLIED_REACTIONS[mid]["penalty"]
+    prev_reward = applied.reward
+    prev_penalty = applied.penalty
 
     delta_reward = reward_units - prev_reward
     #print(delta_reward, "delta reward")
     delta_penalty = penalty_units - prev_penalty
     #print(delta_penalty, "delta penalty")
 
-    # apply reward delta (+10 per unit) and penalty delta (-20 per unit)
-    if delta_reward != 0:
-        add_balance(message.author.id, delta_reward * 10)
-    if delta_penalty != 0:
-        add_balance(message.author.id, delta_penalty * -20)
+    # reward delta is +10 SC per unit and penalty delta is -20 SC per unit
+    return reward_units, penalty_units, (delta_reward * 10 + delta_penalty * -20) * CENTS
 
-    APPLIED_REACTIONS[mid]["reward"] = reward_units
-    APPLIED_REACTIONS[mid]["penalty"] = penalty_units
+class ReactionQueue:
+    """Collects which messages got reward/penalty reactions and settles them every
+    REACTION_FLUSH_INTERVAL seconds, so a reaction storm on one message costs one
+    lookup and one balance write per author per window instead of one per event.
+    Messages still in the gateway cache already have up to date counts (discord.py
+    applies the raw events to them), only uncached ones get fetched."""
 
-async def _on_reaction_event(reaction, user):
-    if user.bot or reaction.message.author.bot:
+    def __init__(self):
+        self.pending = {}  # message id -> (guild id, channel id)
+        self._flusher = None
+
+    def touch(self, guild_id, channel_id, message_id):
+        self.pending[message_id] = (guild_id, channel_id)
+
+    async def _resolve(self, channel_id, message_id, cached):
+        msg = cached.get(message_id)
+        if msg is not None:
+            return msg
+        try:
+            channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+            return await channel.fetch_message(message_id)
+        except discord.HTTPException:
+            # deleted message or no access anymore, nothing to settle
+            return None
+
+    @METRICS.timed("event", event="reaction_flush")
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        cached = {m.id: m for m in bot.cached_messages}
+        messages, applied = await asyncio.gather(
+            asyncio.gather(*(self._resolve(cid, mid, cached) for mid, (_, cid) in batch.items())),
+            REACTION_STATE.get_many(list(batch)),
+        )
+        deltas = {}  # (guild id, author id) -> [SC change, [(message id, reward units, penalty units)]]
+        for msg in messages:
+            if msg is None or msg.author.bot:
+                continue
+            reward, penalty, delta = _reaction_delta(msg, applied[msg.id])
+            account = deltas.setdefault((batch[msg.id][0], msg.author.id), [0, []])
+            account[0] += delta
+            account[1].append((msg.id, reward, penalty))
+        for (guild_id, author_id), (delta, settled) in deltas.items():
+            if delta:
+                try:
+                    await store.add_balance(guild_id, author_id, delta)
+                except Exception:
+                    # nothing was paid for these (the ledger service dropped, say), they
+                    # go back in the queue and get worked out again next flush
+                    traceback.print_exc()
+                    for mid, _, _ in settled:
+                        self.pending.setdefault(mid, batch[mid])
+                    continue
+            for mid, reward, penalty in settled:
+                applied[mid].reward = reward
+                applied[mid].penalty = penalty
+                REACTION_STATE.dirty.add(mid)
+        await REACTION_STATE.persist()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(REACTION_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+REACTION_QUEUE = ReactionQueue()
+
+@METRICS.timed("event", event="raw_reaction")
+async def _on_raw_reaction_event(payload: discord.RawReactionActionEvent):
+    emoji_str = str(payload.emoji)
+    if emoji_str != REWARD_EMOTE and emoji_str != PENALTY_EMOTE:
         return
-    try:
-        # fetch fresh message to get accurate reaction counts which only half works but okay
-        msg = await reaction.message.channel.fetch_message(reaction.message.id)
-    except Exception:
-        msg = reaction.message
-    await _sync_and_apply(msg)
+    if payload.guild_id is None:
+        return  # DMs are no guild's economy
+    # removals don't carry a member, fall back to the user cache
+    user = payload.member or bot.get_user(payload.user_id)
+    if user is not None and user.bot:
+        return
+    REACTION_QUEUE.touch(payload.guild_id, payload.channel_id, payload.message_id)
+
+bot.add_listener(_on_raw_reaction_event, 'on_raw_reaction_add')
+bot.add_listener(_on_raw_reaction_event, 'on_raw_reaction_remove')
+
+# outgoing DMs (payment requests, payment notices) go through a queue so handlers never wait on them
+DM_WORKERS = config.get("dm_workers", 4)  # DMs in flight at once
+DM_RATE = config.get("dm_rate", 5.0)  # DMs per second across the bot
+DM_USER_INTERVAL = config.get("dm_user_interval", 1.0)  # seconds between DMs to the same user
+DM_MAX_RETRIES = config.get("dm_max_retries", 5)
+DM_RETRY_BASE = config.get("dm_retry_base", 1.0)  # seconds before the first retry, doubles every time
+
+class OutboundDM:
+    __slots__ = ("content", "view", "on_failed", "attempts", "sending")
+
+    def __init__(self, content, view=None, on_failed=None):
+        self.content = content
+        self.view = view
+        self.on_failed = on_failed  # async fn(exception), called if it can't be delivered
+        self.attempts = 0
+        self.sending = False
+
+class DMOutbox:
+    """DMs queued per user and sent by DM_WORKERS worker tasks. Each DM channel is
+    its own rate limit route on discord's side, so a user gets at most one DM per
+    DM_USER_INTERVAL seconds and the bot as a whole DM_RATE per second. Plain
+    notices queued for someone who is still waiting get merged into one message
+    (ones with buttons always go on their own). 429s and 5xx are retried with
+    exponential backoff, anything else (DMs closed, unknown user) goes to the
+    DM's on_failed."""
 
-bot.add_listener(_on_reaction_event, 'on_reaction_add')
-bot.add_listener(_on_reaction_event, 'on_reaction_remove')
+    def __init__(self):
+        self.pending = {}  # user id -> deque of OutboundDM
+        self.active = set()  # users scheduled or being sent to right now
+        self.next_at = {}  # user id -> time.monotonic() their next DM may go out
+        self.ready = asyncio.Queue()
+        self.tokens = DM_RATE
+        self.refilled = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self._workers = []
+
+    def send(self, user_id, content, view=None, on_failed=None):
+        queue = self.pending.setdefault(user_id, collections.deque())
+        last = queue[-1] if queue else None
+        if (view is None and last is not None and last.view is None and not last.sending
+                and len(last.content) + len(content) + 1 <= 2000):
+            last.content += "\n" + content
+            self.coalesced += 1
+        else:
+            queue.append(OutboundDM(content, view, on_failed))
+        if user_id not in self.active:
+            self.active.add(user_id)
+            self._schedule(user_id)
+
+    def _schedule(self, user_id):
+        wait = self.next_at.get(user_id, 0) - time.monotonic()
+        if wait > 0:
+            asyncio.get_running_loop().call_later(wait, self.ready.put_nowait, user_id)
+        else:
+            self.ready.put_nowait(user_id)
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(DM_RATE, self.tokens + (now - self.refilled) * DM_RATE)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / DM_RATE)
+
+    @METRICS.timed("event", event="dm_send")
+    async def _deliver(self, user_id):
+        queue = self.pending[user_id]
+        dm = queue[0]
+        dm.sending = True
+        await self._take_token()
+        try:
+            user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+            if dm.view is not None:
+                await user.send(dm.content, view=dm.view)
+            else:
+                await user.send(dm.content)
+        except discord.HTTPException as e:
+            if (e.status == 429 or e.status >= 500) and dm.attempts < DM_MAX_RETRIES:
+                dm.sending = False
+                self.retried += 1
+                self.next_at[user_id] = time.monotonic() + DM_RETRY_BASE * 2 ** dm.attempts
+                dm.attempts += 1
+                return
+            queue.popleft()
+            self.failed += 1
+            if dm.on_failed is not None:
+                try:
+                    await dm.on_failed(e)
+                except Exception:
+                    traceback.print_exc()
+        else:
+            queue.popleft()
+            self.sent += 1
+        self.next_at[user_id] = time.monotonic() + DM_USER_INTERVAL
 
+    async def _worker(self):
+        while True:
+            user_id = await self.ready.get()
+            try:
+                await self._deliver(user_id)
+            except Exception:
+                traceback.print_exc()
+                self.pending[user_id].popleft()  # don't retry something that blew up on our side
+            if self.pending[user_id]:
+                self._schedule(user_id)
+            else:
+                del self.pending[user_id]
+                self.active.discard(user_id)
+                if len(self.next_at) > 2 * len(self.active) + 1000:
+                    now = time.monotonic()
+                    self.next_at = {uid: t for uid, t in self.next_at.items() if t > now}
+
+    def stats(self):
+        return {"queued": sum(map(len, self.pending.values())), "sent": self.sent, "failed": self.failed,
+                "retried": self.retried, "coalesced": self.coalesced}
+
+    def start(self):
+        self._workers = [w for w in self._workers if not w.done()]
+        while len(self._workers) < DM_WORKERS:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+DM_OUTBOX = DMOutbox()
+if ROLE != "service":
+    METRICS.add_source("dm_outbox", DM_OUTBOX.stats)
+
+# economy and blackjack commands only make sense in a guild, the groups' check covers their subcommands
 @bot.group(name="sc", invoke_without_command=True)
+@commands.guild_only()
 async def sc(ctx):
     """Root command for shiftycoin. Use subcommands: balance, send, request."""
     await ctx.send("Shiftycoin commands: `!sc bal` `!sc send` `!sc request`")
 
 @sc.command(name="bal")
 async def balance(ctx):
-    bal = get_balance(ctx.author.id)
-    await ctx.send(f"{ctx.author.mention}, your balance: **{bal} SC**")
+    bal = await store.get_balance(ctx.guild.id, ctx.author.id)
+    await ctx.send(f"{ctx.author.mention}, your balance: **{sc_str(bal)} SC**")
 
 @sc.command(name="send")
-async def send(ctx, member: discord.Member, amount: float):
+async def send(ctx, member: discord.Member, amount: to_cents):
     if amount <= 0:
         await ctx.send("Amount must be positive.")
         return
-    sender_id = ctx.author.id
-    receiver_id = member.id
-    sender_bal = get_balance(sender_id)
-    if sender_bal < amount:
-        await ctx.send("Insufficient balance.")
+    try:
+        new_sender_bal, new_receiver_bal = await transfer(ctx.guild.id, ctx.author.id, member.id, amount)
+    except ValueError as e:
+        await ctx.send(str(e))
         return
-    add_balance(sender_id, -amount)
-    new_receiver_bal = add_balance(receiver_id, amount)
-    new_sender_bal = get_balance(sender_id)
     await ctx.send(
-        f"{ctx.author.mention} sent **{amount} SC** to {member.mention}.\n"
-        f"Your new balance: **{new_sender_bal} SC**\n"
-        f"{member.mention}'s new balance: **{new_receiver_bal} SC**"
+        f"{ctx.author.mention} sent **{sc_str(amount)} SC** to {member.mention}.\n"
+        f"Your new balance: **{sc_str(new_sender_bal)} SC**\n"
+        f"{member.mention}'s new balance: **{sc_str(new_receiver_bal)} SC**"
     )
 
 @sc.command(name="request")
-async def request_sc(ctx, member: discord.Member, amount: float):
+async def request_sc(ctx, member: discord.Member, amount: to_cents):
     if amount <= 0:
         await ctx.send("Amount must be positive.")
         return
@@ -494,17 +1259,17 @@ async def request_sc(ctx, member: discord.Member, amount: float):
         await ctx.send("Cannot request from a bot.")
         return
 
-    amount = round(amount, 2)
-
     class PayView(discord.ui.View):
-        def __init__(self, requester_id: int, payer_id: int, amount: float):
+        def __init__(self, guild_id: int, requester_id: int, payer_id: int, amount: int):
             super().__init__(timeout=None)
+            self.guild_id = guild_id  # the button lives in a DM, the money in the guild it was requested in
             self.requester_id = requester_id
             self.payer_id = payer_id
             self.amount = amount
             self.paid = False
 
         @discord.ui.button(label="Pay", style=discord.ButtonStyle.green)
+        @METRICS.timed("event", event="button pay")
         async def pay(self, interaction: discord.Interaction, button: discord.ui.Button):
             # only the intended payer can press
             if interaction.user.id != self.payer_id:
@@ -514,132 +1279,374 @@ async def request_sc(ctx, member: discord.Member, amount: float):
                 await interaction.response.send_message("This request has already been paid.", ephemeral=True)
                 return
 
-            payer_bal = get_balance(self.payer_id)
-            if payer_bal < self.amount:
+            # mark it paid before waiting on the locks so a double click can't pay twice
+            self.paid = True
+            try:
+                new_payer_bal, new_receiver_bal = await transfer(self.guild_id, self.payer_id, self.requester_id, self.amount)
+            except ValueError:
+                self.paid = False
                 await interaction.response.send_message("Insufficient balance to pay.", ephemeral=True)
                 return
 
-            # perform transfer
-            add_balance(self.payer_id, -self.amount)
-            new_receiver_bal = add_balance(self.requester_id, self.amount)
-            self.paid = True
-
             # disable the button and edit the original message
             button.disabled = True
             await interaction.response.edit_message(
-                content=f"You paid **{self.amount} SC** to <@{self.requester_id}>. Your new balance: **{get_balance(self.payer_id)} SC**",
+                content=f"You paid **{sc_str(self.amount)} SC** to <@{self.requester_id}> in {guild_name}. Your new balance: **{sc_str(new_payer_bal)} SC**",
                 view=self
             )
 
-            # notify requester (try DM, fallback to no-op)
-            requester = bot.get_user(self.requester_id)
-            if requester:
-                try:
-                    await requester.send(f"<@{self.payer_id}> paid you **{self.amount} SC**. Your new balance: **{new_receiver_bal} SC**")
-                except Exception:
-                    # ignore if requester can't be DMed
-                    pass
+            # notify requester, queued so the interaction doesn't wait on it. nothing to do if they can't be DMed
+            DM_OUTBOX.send(self.requester_id, f"<@{self.payer_id}> paid you **{sc_str(self.amount)} SC** in {guild_name}. Your new balance: **{sc_str(new_receiver_bal)} SC**")
 
+    guild_name = f"**{ctx.guild.name}**"
     dm_content = (
-        f"{ctx.author.mention} is requesting **{amount} SC** from you.\n"
+        f"{ctx.author.mention} is requesting **{sc_str(amount)} SC** from you in {guild_name}.\n"
         "Click the button below to pay them."
     )
-    view = PayView(ctx.author.id, member.id, amount)
+    view = PayView(ctx.guild.id, ctx.author.id, member.id, amount)
 
-    try:
-        await member.send(dm_content, view=view)
-    except discord.Forbidden:
-        await ctx.send(f"Could not DM {member.mention}. They may have DMs disabled.")
-        return
-    except Exception:
-        await ctx.send("Failed to send request DM.")
-        return
+    async def dm_failed(error):
+        if isinstance(error, discord.Forbidden):
+            await ctx.send(f"Could not DM {member.mention}. They may have DMs disabled.")
+        else:
+            await ctx.send("Failed to send request DM.")
+
+    DM_OUTBOX.send(member.id, dm_content, view=view, on_failed=dm_failed)
+    await ctx.send(f"Request sent to {member.mention} for **{sc_str(amount)} SC**. They will receive a DM with the request.")
+
+REDISTRIBUTE_PROGRESS_INTERVAL = config.get("redistribute_progress_interval", 5.0)  # seconds between progress edits
+
+class RedistributionJob:
+    """mass_redistribute_shiftycoin for one guild as a background task: both passes go a chunk at a
+    time through store.run with a yield to the event loop in between, and one status
+    message in the invoking channel is edited with progress. Only users the first
+    pass counted get levelled: an account opened while it runs keeps its balance,
+    as if it had been opened just after. A change to a counted balance is kept if
+    its user was already levelled and lost otherwise, same as if it had landed just
+    after or just before. Either way the supply ends up as what was counted plus
+    whatever landed after levelling, nothing is created out of thin air."""
+
+    def __init__(self, guild_id, channel):
+        self.guild_id = guild_id
+        self.channel = channel
+        self.stage = "adding up"
+        self.users = 0  # found in the first pass
+        self.levelled = 0
+        self.message = None
+        self.task = None
+        self._reported = 0.0
+
+    def progress(self):
+        if self.stage == "adding up":
+            return f"Redistribution: adding up balances, {self.users} users so far."
+        return f"Redistribution: levelling, {self.levelled}/{self.users} users done."
+
+    async def _report(self, text, force=False):
+        now = time.monotonic()
+        if not force and now - self._reported < REDISTRIBUTE_PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        try:
+            if self.message is None:
+                self.message = await self.channel.send(text)
+            else:
+                await self.message.edit(content=text)
+        except discord.HTTPException:
+            pass  # progress is best effort, the job carries on
+
+    async def run(self):
+        try:
+            mark = await store.run(_walk_start, self.guild_id)
+            after, total = "", 0
+            while after is not None:
+                after, n, cents = await store.run(_sum_chunk, self.guild_id, after, mark)
+                self.users += n
+                total += cents
+                await self._report(self.progress())
+                await asyncio.sleep(0)
+            if self.users == 0:
+                await self._report("there is no economy :(", force=True)
+                return
+            share, remainder = divmod(total, self.users)
+            self.stage = "levelling"
+            after = ""
+            while after is not None:
+                after, n = await store.run(_level_chunk, self.guild_id, after, mark, share, remainder, self.levelled)
+                self.levelled += n
+                await self._report(self.progress())
+                await asyncio.sleep(0)
+            await self._report(
+                f"The Great Redistribution has occurred. The playing field has been leveled for all {self.levelled} individuals. \n"
+                "**May the users of our Shiftycoin find renewed hope and opportunity in this new era of equality.**",
+                force=True,
+            )
+        except asyncio.CancelledError:
+            await self._report(f"Redistribution cancelled while {self.stage}: {self.levelled}/{self.users} users were levelled.", force=True)
+            raise
+        except Exception:
+            traceback.print_exc()
+            await self._report(f"Redistribution failed while {self.stage}: {self.levelled}/{self.users} users were levelled.", force=True)
+        finally:
+            # the json ledger holds on to the walk's ids until this
+            with contextlib.suppress(ConnectionError):
+                await store.run(_walk_end, self.guild_id)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
 
-    await ctx.send(f"Request sent to {member.mention} for **{amount} SC**. They will receive a DM with the request.")
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+# only one at a time per guild
+REDISTRIBUTIONS = {}  # guild id -> RedistributionJob
 
 @sc.command(name="redistribute")
-async def redistribute(ctx):
+async def redistribute(ctx, action: str = "start"):
+    """!sc redistribute [start|status|cancel], levels this guild's economy"""
     if not ctx.author.guild_permissions.administrator:
         await ctx.send("You do not have permission to use this command.")
         return
-    new_balances = mass_redistribute_shiftycoin()
-    if not new_balances:
-        await ctx.send("there is no economy :(")
-        return
-    await ctx.send(f"The Great Redistribution has occurred. The playing field has been leveled for all {len(new_balances)} individuals. \n"
-                   "**May the users of our Shiftycoin find renewed hope and opportunity in this new era of equality.**")
+    job = REDISTRIBUTIONS.get(ctx.guild.id)
+    job = job if job is not None and job.running() else None
+    if action == "status":
+        await ctx.send(job.progress() if job else "No redistribution is running.")
+    elif action == "cancel":
+        if job is None:
+            await ctx.send("No redistribution is running.")
+            return
+        job.task.cancel()
+    elif job is not None:
+        await ctx.send("A redistribution is already running. `!sc redistribute status` / `!sc redistribute cancel`")
+    else:
+        job = REDISTRIBUTIONS[ctx.guild.id] = RedistributionJob(ctx.guild.id, ctx.channel)
+        job.start()
+
+LEADERBOARD_PAGE_SIZE = config.get("leaderboard_page_size", 20)
+
+class LeaderboardView(discord.ui.View):
+    """Pages through a guild's ledger index a page at a time instead of posting every balance."""
+
+    def __init__(self, guild_id, page=0):
+        super().__init__(timeout=300)
+        self.guild_id = guild_id
+        self.page = page
+
+    async def render(self, user_id=None):
+        rows, users, total, rank = await store.leaderboard(self.guild_id, self.page * LEADERBOARD_PAGE_SIZE, LEADERBOARD_PAGE_SIZE, user_id)
+        pages = max(1, -(-users // LEADERBOARD_PAGE_SIZE))
+        start = self.page * LEADERBOARD_PAGE_SIZE
+        lines = [f"{start + i + 1}. <@{uid}>: **{sc_str(bal)} SC**" for i, (uid, bal) in enumerate(rows)]
+        text = "Shiftycoin balances:\n" + ("\n".join(lines) or "Nothing on this page.")
+        text += f"\n\nShiftycoin in this server: **{sc_str(total)} SC** | {users} users | page {self.page + 1}/{pages}"
+        if user_id is not None:
+            text += f"\n<@{user_id}> is ranked **#{rank}**." if rank else f"\n<@{user_id}> has no balance yet."
+        self.prev_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= pages - 1
+        return text
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    @METRICS.timed("event", event="button leaderboard")
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = max(0, self.page - 1)
+        await interaction.response.edit_message(content=await self.render(), view=self)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    @METRICS.timed("event", event="button leaderboard")
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await interaction.response.edit_message(content=await self.render(), view=self)
+
+    @discord.ui.button(label="My rank", style=discord.ButtonStyle.primary)
+    @METRICS.timed("event", event="button leaderboard")
+    async def my_rank(self, interaction: discord.Interaction, button: discord.ui.Button):
+        rank = (await store.leaderboard(self.guild_id, 0, 0, interaction.user.id))[3]
+        if rank:
+            self.page = (rank - 1) // LEADERBOARD_PAGE_SIZE
+        await interaction.response.edit_message(content=await self.render(interaction.user.id), view=self)
 
 @sc.command(name="globalbal")
-async def globalbal(ctx):
-    shiftycoin = load_shiftycoin()
-    def get_global_balance():
-        shiftycoin = load_shiftycoin()
-        total = sum(float(v) for v in shiftycoin.values())
-        return round(total, 2)
-    if not shiftycoin:
+async def globalbal(ctx, page: int = 1):
+    if not (await store.leaderboard(ctx.guild.id, 0, 0))[1]:
         await ctx.send("No balances recorded.")
         return
+    view = LeaderboardView(ctx.guild.id, max(0, page - 1))
+    await ctx.send(await view.render(), view=view)
+
+@sc.command(name="stats")
+async def sc_stats(ctx):
+    # read off the running aggregates in the guild's ledger index, nothing gets summed here
+    s = await store.stats(ctx.guild.id)
+    if not s["users"]:
+        await ctx.send("No balances recorded.")
+        return
+    gini = "n/a" if s["gini"] is None else f"{s['gini']:.3f}"
+    await ctx.send(
+        f"**{ctx.guild.name} Shiftycoin economy**\n"
+        f"Supply: **{sc_str(s['supply'])} SC** across {s['users']} users (mean {sc_str(s['mean'])} SC)\n"
+        f"Gini: **{gini}**\n"
+        f"Min {sc_str(s['min'])} | p10 {sc_str(s['p10'])} | p25 {sc_str(s['p25'])} | median {sc_str(s['median'])} | "
+        f"p75 {sc_str(s['p75'])} | p90 {sc_str(s['p90'])} | p99 {sc_str(s['p99'])} | max {sc_str(s['max'])}"
+    )
 
-    # sort by balance descending
-    items = sorted(shiftycoin.items(), key=lambda kv: -float(kv[1]))
-    lines = [f"<@{uid}>: **{float(bal):.2f} SC**" for uid, bal in items]
-
-    header = "Shiftycoin balances:\n"
-    # send in chunks to avoid hitting discord message length limit
-    chunk = header
+def _metrics_lines(snap):
+    """Readable summary of a METRICS.snapshot(), slowest things first."""
+    def ms(seconds):
+        return f"{seconds * 1000:.1f}ms"
+
+    def timing(t):
+        failed = f", {t['errors']} failed" if t["errors"] else ""
+        return f"{t['count']} calls{failed}, p50 {ms(t['p50'])} · p95 {ms(t['p95'])} · p99 {ms(t['p99'])} · max {ms(t['max'])}"
+
+    timings = sorted(snap["timings"], key=lambda t: -t["sum"])
+    lines = [f"Up {snap['uptime'] / 3600:.1f}h"]
+    for t in timings:
+        if t["name"] == "loop_lag":
+            lines[0] += f", event loop lag p99 {ms(t['p99'])} · max {ms(t['max'])}"
+    for name, title, label, limit in (("command", "Commands", "command", 8), ("event", "Listeners and background work", "event", 6),
+                                      ("storage", "Storage calls", "op", 6)):
+        rows = [t for t in timings if t["name"] == name][:limit]
+        if rows:
+            lines.append(f"**{title}**")
+            lines.extend(f"`{t['labels'][label]}` {timing(t)}" for t in rows)
+    files = {}
+    for c in snap["counters"]:
+        if "file" in c["labels"]:
+            files.setdefault(c["labels"]["file"], []).append(f"{c['name']} {c['value']:,} ({c['per_minute']:,.0f}/min)")
+    for t in timings:
+        if t["name"] in ("file_write", "file_read"):
+            files.setdefault(t["labels"]["file"], []).append(f"{t['name']} p99 {ms(t['p99'])} · max {ms(t['max'])}")
+    if files:
+        lines.append("**Files**")
+        lines.extend(f"`{path}` " + ", ".join(parts) for path, parts in sorted(files.items()))
+    for source, stats in snap["sources"].items():
+        lines.append(f"{source}: " + ", ".join(f"{k} {v}" for k, v in stats.items()))
+    return lines
+
+@sc.command(name="metrics")
+async def sc_metrics(ctx):
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("You do not have permission to use this command.")
+        return
+    lines = ["**This process**" if ROLE == "shard" else "**Shiftycoin metrics**"] + _metrics_lines(METRICS.snapshot())
+    service = await store.service_metrics()
+    if service is not None:
+        lines += ["", "**Ledger service**"] + _metrics_lines(service)
+    # discord caps a message at 2000 characters
+    message = ""
     for line in lines:
-        if len(chunk) + len(line) + 1 > 2000:
-            await ctx.send(chunk)
-            chunk = ""
-        chunk += line + "\n"
-    if chunk:
-        await ctx.send(chunk)
-    total = get_global_balance()
-    await ctx.send(f"Global Shiftycoin balance: **{total} SC**")
+        if len(message) + len(line) + 1 > 2000:
+            await ctx.send(message)
+            message = ""
+        message += line + "\n"
+    await ctx.send(message)
+
+# admin-only sampling profiler for the live process, see profiler.py
+PROFILE_INTERVAL = config.get("profile_interval", 0.005)  # seconds between samples while profiling
+PROFILE_MAX_SECONDS = config.get("profile_max_seconds", 300)  # longest a profile runs, in either mode
+PROFILE_DIR = config.get("profile_dir", "profiles")  # full reports and folded stacks end up here
+
+PROFILER = SamplingProfiler(
+    [__file__, inspect.getfile(BlackjackGame), inspect.getfile(BalanceIndex), inspect.getfile(to_cents),
+     inspect.getfile(storage.Ledger), inspect.getfile(accrue_record)], PROFILE_INTERVAL
+)
+PROFILE_REPORT = None  # task that posts the report once the profiler stops
+
+def _write_profile(stem, report, folded):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    paths = [os.path.join(PROFILE_DIR, stem + ".txt"), os.path.join(PROFILE_DIR, stem + ".folded")]
+    for path, text in zip(paths, (report, folded)):
+        with open(path, "w") as f:
+            f.write(text)
+    return paths
+
+async def _post_profile(channel):
+    while PROFILER.running():
+        await asyncio.sleep(0.5)
+    report, folded = PROFILER.report(), PROFILER.folded()
+    stem = "profile-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    paths = await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, _write_profile, stem, report, folded)
+    summary = report if len(report) <= 1900 else report[:1900].rsplit("\n", 1)[0] + "\n..."
+    try:
+        await channel.send(f"```\n{summary}\n```", files=[discord.File(path) for path in paths])
+    except discord.HTTPException:
+        await channel.send(f"```\n{summary}\n```\nFull report in `{paths[0]}` on the bot's host.")
+
+@sc.command(name="profile")
+async def sc_profile(ctx, amount: str = "30", unit: str = "seconds"):
+    """!sc profile [seconds] | !sc profile <n> commands | !sc profile stop"""
+    global PROFILE_REPORT
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("You do not have permission to use this command.")
+        return
+    if amount == "stop":
+        if not PROFILER.running():
+            await ctx.send("The profiler isn't running.")
+            return
+        PROFILER.stop()  # the report is posted where it was started
+        return
+    try:
+        n = int(amount)
+    except ValueError:
+        n = 0
+    if n <= 0:
+        await ctx.send("Usage: `!sc profile [seconds]`, `!sc profile <n> commands` or `!sc profile stop`")
+        return
+    if PROFILER.running():
+        await ctx.send("The profiler is already running. `!sc profile stop`")
+        return
+    commands_mode = unit.startswith("command")
+    threads = {
+        threading.get_ident(): "event loop",
+        await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, threading.get_ident): "storage",
+    }
+    names = {command.callback.__code__: f"!{command.qualified_name}" for command in bot.walk_commands()}
+    names[_timed_invoke.__code__] = "command dispatch"  # argument conversion and checks, before the callback runs
+    PROFILER.start(threads, PROFILE_MAX_SECONDS if commands_mode else min(n, PROFILE_MAX_SECONDS),
+                   n if commands_mode else None, names)
+    until = f"the next {n} commands (at most {PROFILE_MAX_SECONDS}s)" if commands_mode else f"{min(n, PROFILE_MAX_SECONDS)} seconds"
+    await ctx.send(f"Profiling for {until}. `!sc profile stop` ends it early.")
+    PROFILE_REPORT = asyncio.create_task(_post_profile(ctx.channel))
 
 # loan commands
 @bot.group(name="loan", invoke_without_command=True)
+@commands.guild_only()
 async def sc_loan(ctx):
     await ctx.send("Loan commands: `!loan take <amt>` `!loan repay <amt>` `!loan info` `!loan accrue`")
 
 @sc_loan.command(name="take")
-async def sc_loan_take(ctx, amount: float):
+async def sc_loan_take(ctx, amount: to_cents):
     uid = ctx.author.id
     try:
-        amount = round(amount, 2)
         if amount <= 0:
             await ctx.send("Amount must be positive.")
             return
-        if amount > 500.0:
+        if amount > 500 * CENTS:
             await ctx.send("Maximum single loan amount is 500 SC.")
             return
-        rec = take_loan_for_user(uid, amount)
+        rec = await store.take_loan(ctx.guild.id, uid, amount)
         await ctx.send(
-            f"{ctx.author.mention} took a loan of **{amount} SC**.\n"
-            f"Loan balance: **{rec['balance']} SC** | Monthly rate: **{rec['rate']*100:.2f}%** | Active loans: {rec['active_count']}"
+            f"{ctx.author.mention} took a loan of **{sc_str(amount)} SC**.\n"
+            f"Loan balance: **{sc_str(rec['balance'])} SC** | Monthly rate: **{rec['rate']*100:.2f}%** | Active loans: {rec['active_count']}"
         )
     except Exception as e:
         await ctx.send(f"Loan failed: {e}")
 
 @sc_loan.command(name="repay")
-async def sc_loan_repay(ctx, amount: float):
+async def sc_loan_repay(ctx, amount: to_cents):
     uid = ctx.author.id
     try:
-        amount = round(amount, 2)
         if amount <= 0:
             await ctx.send("Amount must be positive.")
             return
-        # ensure user has enough shiftycoin to repay (auto-withdraw)
-        bal = get_balance(uid)
-        if bal < amount:
-            await ctx.send("Insufficient Shiftycoin balance to repay that amount.")
+        # withdraws from the balance and repays as one storage call (auto-withdraw)
+        try:
+            rec, repaid, over = await store.repay_loan_from_balance(ctx.guild.id, uid, amount)
+        except ValueError as e:
+            await ctx.send(str(e))
             return
-        # withdraw from balance first
-        add_balance(uid, -amount)
-        rec, repaid, over = repay_loan_for_user(uid, amount)
-        msg = f"{ctx.author.mention} repaid **{repaid} SC** on their loan. New loan balance: **{rec['balance']} SC**."
+        msg = f"{ctx.author.mention} repaid **{sc_str(repaid)} SC** on their loan. New loan balance: **{sc_str(rec['balance'])} SC**."
         if over > 0:
-            msg += f" Overpayment of **{over} SC** was refunded to your balance."
+            msg += f" Overpayment of **{sc_str(over)} SC** was refunded to your balance."
         await ctx.send(msg)
     except Exception as e:
         await ctx.send(f"Repayment failed: {e}")
@@ -647,68 +1654,91 @@ async def sc_loan_repay(ctx, amount: float):
 @sc_loan.command(name="info")
 async def sc_loan_info(ctx, member: discord.Member=None):
     target = member or ctx.author
-    rec = get_loan_record(target.id)
-    # apply no accrual here, just show current stored state
-    last = rec.get("last_accrued") or "never"
+    # interest owed so far is included, nothing gets written
+    rec, last, owed = await store.loan_info(ctx.guild.id, target.id)
+    balance = f"Balance: **{sc_str(rec['balance'])} SC**"
+    if owed:
+        balance += f" (incl. {sc_str(owed)} SC interest owed since {last})"
     await ctx.send(
         f"{target.mention} loan info:\n"
-        f"Balance: **{rec['balance']} SC**\n"
+        f"{balance}\n"
         f"Monthly rate: **{rec.get('rate', BASE_LOAN_RATE)*100:.2f}%**\n"
         f"Active loans: {rec.get('active_count', 0)}\n"
-        f"Last interest applied: {last}"
+        f"Last interest applied: {last or 'never'}"
     )
 
 @sc_loan.command(name="accrue")
 async def sc_loan_accrue(ctx):
-    """Manually trigger accrual for the invoking user (or for all if user has manage_guild)."""
+    """Manually trigger accrual for the invoking user (or for everyone in the guild if user has manage_guild)."""
     uid = ctx.author.id
-    # if user has manage_guild permission, allow them to accrue all loans
+    # if user has manage_guild permission, allow them to accrue all of this guild's loans
     if ctx.author.guild_permissions.manage_guild:
-        results = accrue_interest_all()
+        results = await store.accrue_interest_all(ctx.guild.id)
         if not results:
             await ctx.send("No loans required accrual.")
             return
         msg_lines = ["Accrued interest for users:"]
         for uid_str, info in results.items():
-            msg_lines.append(f"<@{uid_str}>: +{info['interest']} SC over {info['months']} month(s)")
+            msg_lines.append(f"<@{uid_str}>: +{sc_str(info['interest'])} SC over {info['months']} month(s)")
         await ctx.send("\n".join(msg_lines))
         return
 
-    months, interest = accrue_interest_for_user(uid)
+    months, interest = await store.accrue_interest(ctx.guild.id, uid)
     if months == 0:
         await ctx.send("No interest to accrue for your loans at this time.")
     else:
-        new_rec = get_loan_record(uid)
-        await ctx.send(f"Accrued interest for {months} month(s): **{interest} SC**. New loan balance: **{new_rec['balance']} SC**")
+        new_rec = await store.get_loan_record(ctx.guild.id, uid)
+        await ctx.send(f"Accrued interest for {months} month(s): **{sc_str(interest)} SC**. New loan balance: **{sc_str(new_rec['balance'])} SC**")
 
 
 @bot.group(name="bj", invoke_without_command=True)
+@commands.guild_only()
 async def bj(ctx):
     """Root command for blackjack. Use subcommands: start, hit, stand, hand."""
     await ctx.send("Blackjack commands: `!bj start <custom bet (optional)>` `!bj hit` `!bj stand` `!bj hand`")
 
+async def settle_game(uid, game, guild_id=None):
+    """Let the dealer finish, settle the game once and post the payout to the ledger
+    of the guild it was started in (or guild_id, for one that isn't in ACTIVE_GAMES),
+    in a single write. Returns the game's Settlement with the new balance."""
+    game.dealer_play()
+    settlement = game.settle()
+    if settlement.payout != 0:
+        guild_id = ACTIVE_GAMES.guilds[uid] if guild_id is None else guild_id
+        settlement = settlement._replace(balance=await store.add_balance(guild_id, uid, settlement.payout))
+    game.settlement = settlement
+    return settlement
+
+def settlement_str(game, settlement):
+    text = f"Dealer: {hand_str(game.dealer)} (Total: {settlement.dealer_total})\nResult: {settlement.result.upper()}"
+    if settlement.payout != 0:
+        text += f"\nSC earned/lost: {sc_str(settlement.payout)}. New balance: {sc_str(settlement.balance)} SC"
+    return text
+
 @bj.command(name="start")
-async def bj_start(ctx, bet = 0):
+async def bj_start(ctx, bet: to_cents = 0):
     uid = ctx.author.id
     if bet < 0 :
         await ctx.send("Bet must be a positive number.")
         return
-    if get_balance(uid) < 0 :
+    bal = await store.get_balance(ctx.guild.id, uid)
+    if bal < 0 :
         await ctx.send("You do not have enough Shiftycoin to place a bet.")
         return
-    if get_balance(uid) < bet :
+    if bal < bet :
         await ctx.send("You do not have enough Shiftycoin to place a bet.")
         return
     if uid in ACTIVE_GAMES and not ACTIVE_GAMES[uid].finished:
         await ctx.send("You already have an active game. Use `!bj hit` or `!bj stand`.")
         return
-    game = BlackjackGame()
+    key = shoe_key(ctx)
+    game = BlackjackGame(get_shoe(key))
+    game.bet = bet
     game.deal_initial()
-    ACTIVE_GAMES[uid] = game
-    pscore = score_hand(game.player)
-    add_bet([uid], bet)
+    ACTIVE_GAMES.start(uid, game, key, ctx.guild.id)
+    pscore = game.player.score
     # Check natural blackjack
-    dealer_up = game.dealer[0]
+    dealer_up = card_str(game.dealer[0])
     desc = (
         f"Dealt. Your hand: {hand_str(game.player)} (Total: {pscore})\n"
         f"Dealer shows: {dealer_up}\n"
@@ -716,15 +1746,9 @@ async def bj_start(ctx, bet = 0):
     )
     # immediate blackjack check
     if pscore == 21:
-        game.dealer_play()
-        result = game.evaluate()
-        desc += f"\n\nBlackjack! Dealer: {hand_str(game.dealer)} (Total: {score_hand(game.dealer)})\nResult: {result.upper()}"
+        settlement = await settle_game(uid, game)
+        desc += f"\n\nBlackjack! {settlement_str(game, settlement)}"
     await ctx.send(desc)
-    if game.evaluateSC(uid) != 0:
-        scChange = game.evaluateSC(uid)
-        newBalance = add_balance(uid, scChange)
-        await ctx.send(f"SC earned/lost: {scChange}. New balance: {newBalance} SC")
-        
 
 @bj.command(name="hit")
 async def bj_hit(ctx):
@@ -734,35 +1758,17 @@ async def bj_hit(ctx):
         await ctx.send("No active game. Start one with `!bj start`.")
         return
     card = game.player_hit()
-    pscore = score_hand(game.player)
+    pscore = game.player.score
+    drew = f"You drew {card_str(card)}. Your hand: {hand_str(game.player)} (Total: {pscore})\n"
     if pscore > 21:
-        game.dealer_play()
-        game.evaluate()
-        await ctx.send(
-            f"You drew {card}. Your hand: {hand_str(game.player)} (Total: {pscore})\n"
-            f"You busted! Dealer: {hand_str(game.dealer)} (Total: {score_hand(game.dealer)})\nResult: LOSE"
-        )
-        if game.evaluateSC(uid) != 0:
-            scChange = game.evaluateSC(uid)
-            newBalance = add_balance(uid, scChange)
-            await ctx.send(f"SC earned/lost: {scChange}. New balance: {newBalance} SC")
+        settlement = await settle_game(uid, game)
+        await ctx.send(drew + f"You busted! {settlement_str(game, settlement)}")
     elif pscore == 21:
         # auto stand behavior
-        game.dealer_play()
-        result = game.evaluate()
-        await ctx.send(
-            f"You drew {card}. Your hand: {hand_str(game.player)} (Total: {pscore})\n"
-            f"Dealer: {hand_str(game.dealer)} (Total: {score_hand(game.dealer)})\nResult: {result.upper()}"
-        )
-        if game.evaluateSC(uid) != 0:
-            scChange = game.evaluateSC(uid)
-            newBalance = add_balance(uid, scChange)
-            await ctx.send(f"SC earned/lost: {scChange}. New balance: {newBalance} SC")
+        settlement = await settle_game(uid, game)
+        await ctx.send(drew + settlement_str(game, settlement))
     else:
-        await ctx.send(
-            f"You drew {card}. Your hand: {hand_str(game.player)} (Total: {pscore})\n"
-            "Use `!bj hit` or `!bj stand`."
-        )
+        await ctx.send(drew + "Use `!bj hit` or `!bj stand`.")
 
 @bj.command(name="stand")
 async def bj_stand(ctx):
@@ -771,17 +1777,11 @@ async def bj_stand(ctx):
     if not game or game.finished:
         await ctx.send("No active game. Start one with `!bj start`.")
         return
-    game.dealer_play()
-    result = game.evaluate()
+    settlement = await settle_game(uid, game)
     await ctx.send(
-        f"You stand. Your hand: {hand_str(game.player)} (Total: {score_hand(game.player)})\n"
-        f"Dealer: {hand_str(game.dealer)} (Total: {score_hand(game.dealer)})\n"
-        f"Result: {result.upper()}"
+        f"You stand. Your hand: {hand_str(game.player)} (Total: {settlement.player_total})\n"
+        + settlement_str(game, settlement)
     )
-    if game.evaluateSC(uid) != 0:
-        scChange = game.evaluateSC(uid)
-        newBalance = add_balance(uid, scChange)
-        await ctx.send(f"SC earned/lost: {scChange}. New balance: {newBalance} SC")
 
 @bj.command(name="hand")
 async def bj_hand(ctx):
@@ -791,8 +1791,8 @@ async def bj_hand(ctx):
         await ctx.send("No active game.")
         return
     await ctx.send(
-        f"Your hand: {hand_str(game.player)} (Total: {score_hand(game.player)})\n"
-        f"Dealer shows: {game.dealer[0]}"
+        f"Your hand: {hand_str(game.player)} (Total: {game.player.score})\n"
+        f"Dealer shows: {card_str(game.dealer[0])}"
     )
 '''
 @bj.command(name="stop")
@@ -826,4 +1826,21 @@ async def directory(ctx):
 
     )
 
-bot.run(TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    if ROLE == "service":
+        try:
+            asyncio.run(LedgerService().serve())
+        except KeyboardInterrupt:
+            pass
+    else:
+        bot.run(TOKEN)
+    # these only return once the process is shutting down. a flush the loop was waiting
+    # on when it closed can still be writing on STORAGE_POOL, let it finish first or it
+    # could append older values after the compaction below has truncated the journal
+    STORAGE_POOL.shutdown(wait=True)
+    # then fold everything into the snapshots
+    if ROLE != "shard":
+        ECONOMIES.compact()
+    if ROLE != "service":
+        REACTION_STATE.persist_now()
+        write_snapshot(GAMES_FILE, ACTIVE_GAMES.snapshot())
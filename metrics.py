@@ -0,0 +1,249 @@
+"""Where the time goes: latency histograms, call/error counts and byte counters for
+commands, listeners, storage calls and file writes, plus event loop lag. Read it
+with `!sc metrics` or scrape it in the prometheus text format from a small local
+http endpoint."""
+import asyncio
+import bisect
+import collections
+import functools
+import itertools
+import json
+import threading
+import time
+import traceback
+
+# upper bounds in seconds, 0.1ms doubling up to ~52s, anything slower lands in +Inf
+BUCKETS = [0.0001 * 2 ** k for k in range(20)]
+
+class Histogram:
+    """Call count, error count, total and max duration, and counts per BUCKETS bucket."""
+    __slots__ = ("buckets", "count", "errors", "sum", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, error=False):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q-th call falls in (the max for the last one)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+class _Timer:
+    # a plain class rather than contextlib.contextmanager, it is on every command and storage call
+    __slots__ = ("metrics", "key", "start")
+
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        self.metrics._observe(self.key, time.perf_counter() - self.start, kind is not None)
+        return False
+
+class Metrics:
+    """Histograms and counters keyed by (name, labels), with labels a tuple of
+    (key, value) pairs. Storage work records from STORAGE_POOL, so every update
+    takes a lock; they are a few dict operations each."""
+
+    def __init__(self, prefix="shiftycoin"):
+        self.prefix = prefix
+        self.started = time.time()
+        self.started_monotonic = time.monotonic()
+        self.histograms = {}
+        self.counters = {}
+        self.sources = {}  # name -> function returning a dict of numbers, e.g. DM_OUTBOX.stats
+        self.samples = collections.deque(maxlen=7)  # (monotonic, counters) every 10s, for per minute rates
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._server = None
+
+    def observe(self, name, seconds, error=False, **labels):
+        self._observe((name, tuple(labels.items())), seconds, error)
+
+    def _observe(self, key, seconds, error):
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(seconds, error)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def timer(self, name, **labels):
+        """with METRICS.timer("storage", op="get_balance"): ... records the time
+        spent inside, and an error if it raised."""
+        return _Timer(self, (name, tuple(labels.items())))
+
+    def timed(self, name, **labels):
+        """Decorator version of timer() for plain and async functions."""
+        def wrap(fn):
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def timed_fn(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return await fn(*args, **kwargs)
+            else:
+                @functools.wraps(fn)
+                def timed_fn(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return fn(*args, **kwargs)
+            return timed_fn
+        return wrap
+
+    def add_source(self, name, fn):
+        self.sources[name] = fn
+
+    def per_minute(self):
+        """{(name, labels): rate} for every counter over the last ~minute."""
+        with self._lock:
+            counters = dict(self.counters)
+        since, before = self.samples[0] if self.samples else (self.started_monotonic, {})
+        elapsed = max(time.monotonic() - since, 60.0)  # a fresh process shows its first minute, not a guess
+        return {key: (value - before.get(key, 0)) * 60 / elapsed for key, value in counters.items()}
+
+    async def _watch_loop(self, interval):
+        # a sleep that wakes up late means something held the loop for the difference
+        ticks = 0
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            self.observe("loop_lag", max(0.0, time.monotonic() - expected))
+            ticks += 1
+            if ticks * interval >= 10:
+                ticks = 0
+                with self._lock:
+                    self.samples.append((time.monotonic(), dict(self.counters)))
+
+    def snapshot(self):
+        """Everything as plain json-able data (what `!sc metrics` formats and the
+        ledger service hands to shards)."""
+        rates = self.per_minute()
+        with self._lock:
+            histograms = [(key, hist.count, hist.errors, hist.sum, hist.max, [hist.quantile(q) for q in (0.5, 0.95, 0.99)])
+                          for key, hist in self.histograms.items()]
+            counters = list(self.counters.items())
+        sources = {}
+        for name, fn in self.sources.items():
+            try:
+                sources[name] = fn()
+            except Exception:
+                traceback.print_exc()
+        return {
+            "uptime": time.time() - self.started,
+            "timings": [{"name": name, "labels": dict(labels), "count": count, "errors": errors, "sum": total,
+                         "max": worst, "p50": p50, "p95": p95, "p99": p99}
+                        for (name, labels), count, errors, total, worst, (p50, p95, p99) in histograms],
+            "counters": [{"name": name, "labels": dict(labels), "value": value, "per_minute": rates.get((name, labels), 0)}
+                         for (name, labels), value in counters],
+            "sources": sources,
+        }
+
+    def render(self):
+        """Prometheus text exposition format."""
+        def labelled(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        with self._lock:
+            histograms = sorted((key, list(hist.buckets), hist.count, hist.errors, hist.sum)
+                                for key, hist in self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines = [f"# TYPE {self.prefix}_uptime_seconds gauge", f"{self.prefix}_uptime_seconds {time.time() - self.started:.3f}"]
+        typed = set()
+        for name, group in itertools.groupby(histograms, key=lambda h: h[0][0]):
+            metric = f"{self.prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            errors_lines = [f"# TYPE {self.prefix}_{name}_errors_total counter"]
+            for (_, labels), buckets, count, errors, total in group:
+                seen = 0
+                for bound, n in zip(BUCKETS + ["+Inf"], buckets):
+                    seen += n
+                    le = bound if bound == "+Inf" else f"{bound:g}"
+                    lines.append(f"{metric}_bucket{labelled(labels, [('le', le)])} {seen}")
+                lines.append(f"{metric}_sum{labelled(labels)} {total:.6f}")
+                lines.append(f"{metric}_count{labelled(labels)} {count}")
+                errors_lines.append(f"{self.prefix}_{name}_errors_total{labelled(labels)} {errors}")
+            lines.extend(errors_lines)
+        for (name, labels), value in counters:
+            metric = f"{self.prefix}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{labelled(labels)} {value}")
+        for source, fn in sorted(self.sources.items()):
+            try:
+                stats = fn()
+            except Exception:
+                traceback.print_exc()
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"{self.prefix}_{source}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def _http(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # headers, nothing in them matters
+            parts = request.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else ""
+            if path in ("/", "/metrics"):
+                status, kind, body = "200 OK", "text/plain; version=0.0.4", self.render()
+            elif path == "/metrics.json":
+                status, kind, body = "200 OK", "application/json", json.dumps(self.snapshot())
+            else:
+                status, kind, body = "404 Not Found", "text/plain", "not found\n"
+            body = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {kind}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+    async def _serve(self, host, port):
+        try:
+            server = await asyncio.start_server(self._http, host, port)
+        except OSError:
+            traceback.print_exc()
+            return
+        print(f"metrics on http://{host}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+    def start(self, port=None, host="127.0.0.1", lag_interval=0.25):
+        # safe to call more than once, like the other start()s
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch_loop(lag_interval))
+        if port and (self._server is None or self._server.done()):
+            self._server = asyncio.create_task(self._serve(host, port))
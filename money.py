@@ -0,0 +1,23 @@
+"""Shiftycoin amounts are whole cents (ints) everywhere they are stored or added up.
+These are the only places SC turn into cents and back: parsing what people type and
+what old float files hold, and formatting for messages."""
+import decimal
+
+CENTS = 100  # cents per SC
+
+def to_cents(value):
+    """SC as typed ("12.5"), or an old float/int SC value, to int cents. Anything past
+    the second decimal is rounded half up. Works as a discord.py converter."""
+    try:
+        sc = decimal.Decimal(str(value).strip())
+    except decimal.InvalidOperation:
+        raise ValueError(f"{value!r} is not an amount of SC.")
+    if not sc.is_finite():
+        raise ValueError(f"{value!r} is not an amount of SC.")
+    return int((sc * CENTS).quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
+
+def sc_str(cents):
+    """int cents -> "12.50" for display."""
+    sign = "-" if cents < 0 else ""
+    whole, frac = divmod(abs(int(cents)), CENTS)
+    return f"{sign}{whole}.{frac:02d}"
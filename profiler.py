@@ -0,0 +1,154 @@
+"""Sampling profiler for the live bot, turned on by an admin for a while and off again.
+A background thread looks at the event loop thread's (and storage thread's) python
+stack every few ms and each sample is credited to the command or listener that was
+running, so nothing is hooked into the code being profiled and nothing runs at all
+while it is off."""
+import collections
+import os
+import sys
+import threading
+import time
+
+# innermost frames of a thread that is waiting for work: the event loop's selector,
+# an idle executor worker, a lock or condition wait
+IDLE = {("selectors.py", "select"), ("thread.py", "_worker"), ("threading.py", "wait")}
+
+def _where(code):
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """Samples the given threads every `interval` seconds. A sample's label is the
+    innermost frame on the stack that has a name in `names` (code object -> e.g.
+    "!sc send"), or else the outermost frame from one of `files` (the bot's own
+    modules), so time spent in discord.py or asyncio on behalf of a command is
+    still the command's. A thread with neither is "idle" when it is waiting for
+    work (IDLE), "other" otherwise (gateway parsing, heartbeats, ...)."""
+
+    def __init__(self, files, interval=0.005):
+        # co_filename is the path a module was loaded by, which is relative for `python main.py`
+        self.files = set(files) | {os.path.abspath(path) for path in files}
+        self.interval = interval
+        self.samples = collections.Counter()  # (thread, label, (code, ...) innermost first) -> count
+        self.ticks = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.commands = 0
+        self.commands_left = None  # counting down when stopping after N commands, None otherwise
+        self.active = False
+        self.threads = {}
+        self.names = {}
+        self._deadline = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def running(self):
+        return self.active or (self._thread is not None and self._thread.is_alive())
+
+    def start(self, threads, seconds, commands=None, names=None):
+        """threads is {thread ident: name}. Stops after `seconds`, or after `commands`
+        commands (see command_done) if that comes first."""
+        if self.running():
+            raise ValueError("The profiler is already running.")
+        self.samples = collections.Counter()
+        self.ticks = 0
+        self.commands = 0
+        self.names = names or {}
+        self.threads = dict(threads)
+        self.commands_left = commands
+        self.started = time.monotonic()
+        self._deadline = self.started + seconds
+        self._stop.clear()
+        self.active = True
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def command_done(self):
+        # the command hook only calls this while active, checking that is all it costs when off
+        self.commands += 1
+        if self.commands_left is not None:
+            self.commands_left -= 1
+            if self.commands_left <= 0:
+                self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval) and time.monotonic() < self._deadline:
+            frames = sys._current_frames()
+            for ident, name in self.threads.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._record(name, frame)
+            self.ticks += 1
+        self.elapsed = time.monotonic() - self.started
+        self.commands_left = None
+        self.active = False
+
+    def _record(self, thread, frame):
+        stack = []
+        named = outermost = None
+        while frame is not None:
+            code = frame.f_code
+            stack.append(code)
+            if named is None and code in self.names:
+                named = code
+            if code.co_filename in self.files and code.co_name != "<module>":  # main.py's module frame is under bot.run()
+                outermost = code
+            frame = frame.f_back
+        if named is not None:
+            label = self.names[named]
+        elif outermost is not None:
+            label = getattr(outermost, "co_qualname", outermost.co_name)
+        elif stack and (os.path.basename(stack[0].co_filename), stack[0].co_name) in IDLE:
+            label = "idle"
+        else:
+            label = "other"
+        self.samples[(thread, label, tuple(stack))] += 1
+
+    def report(self, top=15):
+        """Plain text report: where each thread's samples went, by label and by function."""
+        ms = self.interval * 1000
+        lines = [f"{self.elapsed:.1f}s, {self.ticks} samples every {ms:g}ms, {self.commands} commands ran"]
+        by_thread = collections.Counter()
+        by_label = collections.Counter()
+        self_time = collections.Counter()
+        inclusive = collections.Counter()
+        label_funcs = collections.defaultdict(collections.Counter)
+        for (thread, label, stack), n in self.samples.items():
+            by_thread[thread] += n
+            by_label[(thread, label)] += n
+            if label == "idle":
+                continue
+            self_time[stack[0]] += n
+            label_funcs[(thread, label)][stack[0]] += n
+            for code in set(stack):
+                if code.co_filename in self.files and code.co_name != "<module>":
+                    inclusive[code] += n
+
+        def pct(n):
+            return f"{100 * n / max(self.ticks, 1):5.1f}%"
+
+        for thread, total in by_thread.items():
+            busy = total - by_label[(thread, "idle")]
+            lines.append("")
+            lines.append(f"{thread} thread: busy {pct(busy)} of the time")
+            for (t, label), n in by_label.most_common():
+                if t == thread and label != "idle":
+                    hottest = ", ".join(f"{_where(code)} {pct(m).strip()}" for code, m in label_funcs[(t, label)].most_common(2))
+                    lines.append(f"  {pct(n)}  {label}  [{hottest}]")
+        lines.append("")
+        lines.append("hottest functions, own time (% of samples):")
+        lines.extend(f"  {pct(n)}  {_where(code)}" for code, n in self_time.most_common(top))
+        lines.append("")
+        lines.append("the bot's own functions, including what they call:")
+        lines.extend(f"  {pct(n)}  {_where(code)}" for code, n in inclusive.most_common(top))
+        return "\n".join(lines)
+
+    def folded(self):
+        """Samples in the folded stacks format flamegraph.pl and speedscope read."""
+        lines = []
+        for (thread, label, stack), n in sorted(self.samples.items(), key=lambda item: -item[1]):
+            frames = ";".join(_where(code).replace(";", ":") for code in reversed(stack))
+            lines.append(f"{thread};{label};{frames} {n}")
+        return "\n".join(lines) + "\n"
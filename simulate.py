@@ -0,0 +1,162 @@
+"""Monte Carlo blackjack simulator for tuning bets and payouts offline.
+
+Plays whole batches of hands at once with numpy, using the same rules as
+BlackjackGame: a freshly shuffled deck (or --decks shoe) per hand, aces reduced from 11 to 1
+like score_hand, a natural 21 or hitting to 21 ends the player's turn, the dealer
+draws below 17, and payouts follow BlackjackGame.settle (+/- the bet, or +/- total / 10
+when there is no bet).
+
+    python simulate.py --hands 1000000 --bets 0 10 50 --strategy basic
+"""
+import argparse
+import time
+
+import numpy as np
+
+from blackjack import HARD_VALUES
+
+# hard value of every card in a deck (aces count 1 here, the soft +10 is added on top)
+DECK_VALUES = np.frombuffer(HARD_VALUES, dtype=np.uint8).astype(np.int8)
+
+
+def _score(hard, soft):
+    # same result as score_hand: count one ace as 11 if that doesn't bust
+    return np.where(soft & (hard + 10 <= 21), hard + 10, hard)
+
+
+# strategies take (player score, player holds a usable ace, dealer up card value with aces as 11)
+# as arrays and return a boolean array of which hands hit
+def stand_on(threshold):
+    def strategy(score, soft, dealer_up):
+        return score < threshold
+    strategy.__name__ = f"stand_on_{threshold}"
+    return strategy
+
+
+def basic(score, soft, dealer_up):
+    # hit/stand only, the bot has no doubles or splits
+    weak_dealer = (dealer_up >= 2) & (dealer_up <= 6)
+    hard_hit = (score <= 11) | ((score == 12) & ~((dealer_up >= 4) & (dealer_up <= 6))) | ((score <= 16) & ~weak_dealer)
+    soft_hit = (score <= 17) | ((score == 18) & (dealer_up >= 9))
+    return np.where(soft, soft_hit, hard_hit) & (score < 21)
+
+
+STRATEGIES = {
+    "basic": basic,
+    "dealer": stand_on(17),
+    "stand12": stand_on(12),
+    "never": stand_on(0),
+}
+
+
+def play_batch(n, strategy, rng, decks=1):
+    """Play n hands and return (player totals, dealer totals, outcome) where outcome
+    is 1 for a win, -1 for a loss and 0 for a push. Each hand is dealt from a freshly
+    shuffled shoe of `decks` decks, i.e. the top of a shoe right after a reshuffle."""
+    decks = rng.permuted(np.tile(DECK_VALUES, (n, decks)), axis=1)
+    rows = np.arange(n)
+
+    # deal_initial order: player, dealer, player, dealer
+    p_hard = decks[:, 0].astype(np.int16) + decks[:, 2]
+    p_soft = (decks[:, 0] == 1) | (decks[:, 2] == 1)
+    d_hard = decks[:, 1].astype(np.int16) + decks[:, 3]
+    d_soft = (decks[:, 1] == 1) | (decks[:, 3] == 1)
+    dealer_up = np.where(decks[:, 1] == 1, 11, decks[:, 1])
+    pos = np.full(n, 4)
+
+    # player turn, a natural or a hit to 21 ends it just like bj_start / bj_hit do
+    p_score = _score(p_hard, p_soft)
+    active = p_score < 21
+    while active.any():
+        hits = active & strategy(p_score, p_soft & (p_hard + 10 <= 21), dealer_up)
+        if not hits.any():
+            break
+        idx = rows[hits]
+        card = decks[idx, pos[idx]]
+        p_hard[idx] += card
+        p_soft[idx] |= card == 1
+        pos[idx] += 1
+        p_score = _score(p_hard, p_soft)
+        active = hits & (p_score < 21)
+
+    # dealer only matters when the player didn't bust
+    d_score = _score(d_hard, d_soft)
+    drawing = (p_score <= 21) & (d_score < 17)
+    while drawing.any():
+        idx = rows[drawing]
+        card = decks[idx, pos[idx]]
+        d_hard[idx] += card
+        d_soft[idx] |= card == 1
+        pos[idx] += 1
+        d_score = _score(d_hard, d_soft)
+        drawing &= d_score < 17
+
+    outcome = np.where(
+        p_score > 21, -1,
+        np.where((d_score > 21) | (p_score > d_score), 1, np.where(p_score < d_score, -1, 0)),
+    )
+    return p_score, d_score, outcome
+
+
+def payouts(p_score, outcome, bet):
+    # BlackjackGame.settle: a bet pays +/- the bet, no bet pays +/- player total / 10
+    if bet:
+        return outcome * float(bet)
+    return outcome * (p_score / 10.0)
+
+
+def simulate(hands, bets, strategy, seed=None, batch=200_000, decks=1):
+    """Play `hands` hands and return {bet: stats} with EV and variance per hand."""
+    rng = np.random.default_rng(seed)
+    sums = {b: [0.0, 0.0] for b in bets}
+    counts = np.zeros(3, dtype=np.int64)  # loss, push, win
+    played = 0
+    while played < hands:
+        n = min(batch, hands - played)
+        p_score, _, outcome = play_batch(n, strategy, rng, decks)
+        counts += np.bincount(outcome + 1, minlength=3)
+        for b in bets:
+            pay = payouts(p_score, outcome, b)
+            sums[b][0] += pay.sum()
+            sums[b][1] += np.square(pay).sum()
+        played += n
+
+    results = {}
+    for b, (total, total_sq) in sums.items():
+        ev = total / hands
+        var = total_sq / hands - ev * ev
+        results[b] = {
+            "ev": ev,
+            "variance": var,
+            "stderr": (var / hands) ** 0.5,
+            "win": counts[2] / hands,
+            "push": counts[1] / hands,
+            "loss": counts[0] / hands,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hands", type=int, default=1_000_000)
+    parser.add_argument("--bets", type=float, nargs="+", default=[0, 10, 50, 100])
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="basic")
+    parser.add_argument("--decks", type=int, default=1, help="decks per shoe (the bot uses shoe_decks, default 6)")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = simulate(args.hands, args.bets, STRATEGIES[args.strategy], seed=args.seed, decks=args.decks)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.hands} hands, {args.decks} deck(s), strategy {args.strategy}, {args.hands / elapsed:,.0f} hands/s")
+    first = results[args.bets[0]]
+    print(f"win {first['win']:.4f}  push {first['push']:.4f}  loss {first['loss']:.4f}")
+    print(f"{'bet':>8} {'EV/hand':>10} {'variance':>12} {'stderr':>9}")
+    for b, r in results.items():
+        label = "none" if not b else f"{b:g}"
+        print(f"{label:>8} {r['ev']:>10.4f} {r['variance']:>12.4f} {r['stderr']:>9.4f}")
+
+
+if __name__ == "__main__":
+    main()
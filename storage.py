@@ -0,0 +1,675 @@
+"""Where balances and loans live. Every guild's economy is a ledger and a loan book,
+either json snapshots with an append-only journal or a sqlite database, under
+GUILDS_DIR/<guild id>/. Also the one-off migrations older files go through (floats
+to cents, json to sqlite, the single economy from before guilds had their own).
+main.py configures it from config.json and builds the bot's storage functions on top."""
+import asyncio
+import bisect
+import concurrent.futures
+import datetime
+import json
+import os
+import sqlite3
+import time
+import traceback
+
+from aggregates import BalanceIndex
+from loans import BASE_LOAN_RATE, accrue_record, compute_rate_for_count, first_of_month
+from metrics import Metrics
+from money import to_cents
+
+# the files from before economies were per guild. they hold one economy keyed by user id
+# that gets folded into LEGACY_GUILD's, or into the bot's only guild if that isn't set
+SHIFTYCOIN_FILE = "shiftycoin.json"
+LOANS_FILE = "loans.json"
+# json stores written before balances were cents hold floats of SC. they get
+# converted once (journal folded in) and MONEY_FORMAT_FILE records that it happened
+MONEY_FORMAT_FILE = "money_format.json"
+
+def configure(config, metrics=None):
+    """Settings from config.json. main.py calls this before anything gets opened, a
+    config without these keys gets the defaults (which is what importing this does)."""
+    global METRICS, GUILDS_DIR, LEGACY_GUILD, LEGACY_MARKER, LEDGER_FLUSH_INTERVAL, LEDGER_FLUSH_BATCH
+    global JOURNAL_COMPACT_EVERY, ECONOMY_IDLE_TIMEOUT, STORAGE, SQLITE_FILE
+    METRICS = metrics if metrics is not None else Metrics()
+    # every guild has its own economy: balances and loans live in GUILDS_DIR/<guild id>/ and
+    # are only loaded once something in that guild touches them
+    GUILDS_DIR = config.get("guilds_dir", "guilds")
+    LEGACY_GUILD = config.get("legacy_guild")
+    # the old single economy is folded into one guild's the first time the bot starts with
+    # per guild economies, LEGACY_MARKER records which guild got it
+    LEGACY_MARKER = os.path.join(GUILDS_DIR, "legacy.json")
+    # balances and loans are kept in memory, changes go to an append-only journal
+    # that gets fsynced once per tick and folded back into the json snapshot now and then
+    LEDGER_FLUSH_INTERVAL = config.get("ledger_flush_interval", 5.0)  # seconds between journal flushes
+    LEDGER_FLUSH_BATCH = config.get("ledger_flush_batch", 100)  # flush early after this many changes
+    JOURNAL_COMPACT_EVERY = config.get("journal_compact_every", 10000)  # journal lines before a new snapshot
+    ECONOMY_IDLE_TIMEOUT = config.get("economy_idle_timeout", 3600)  # seconds an unused economy stays in memory
+    # optional sqlite backend, turned on with "storage": "sqlite" in config.json.
+    # each guild gets GUILDS_DIR/<guild id>/shiftycoin.db, SQLITE_FILE is the old single database
+    STORAGE = config.get("storage", "json")
+    SQLITE_FILE = config.get("sqlite_file", "shiftycoin.db")
+
+configure({})
+
+def _file_label(path):
+    # metrics go by file name, not path, so every guild's shiftycoin.json adds up in one series
+    return os.path.basename(path)
+
+def _read_json_file(path):
+    if os.path.exists(path):
+        with open(path, 'r') as f, METRICS.timer("file_read", file=_file_label(path)):
+            data = json.load(f)
+            METRICS.count("file_read_bytes", f.tell(), file=_file_label(path))
+            return data
+    return {}
+
+def _read_loans_json(path):
+    try:
+        return _read_json_file(path)
+    except Exception:
+        return {}
+
+def _read_shiftycoin_file():
+    return _read_json_file(SHIFTYCOIN_FILE)
+
+def _read_loans_file():
+    return _read_loans_json(LOANS_FILE)
+
+# all disk and sqlite work runs on this one thread so writes stay ordered and the
+# sqlite connection is only ever used from one place
+STORAGE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+def write_snapshot(path, data):
+    # write next to the real file and swap it in so a crash never leaves half a file
+    tmp = path + ".tmp"
+    with METRICS.timer("file_write", file=_file_label(path)):
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+            METRICS.count("file_written_bytes", f.tell(), file=_file_label(path))
+        os.replace(tmp, path)
+
+class JournaledStore:
+    """Resident copy of a json file. Reads never touch the disk. Every write is
+    queued as a {"k": key, "v": value} line for <file>.journal, the queue is
+    appended and fsynced every LEDGER_FLUSH_INTERVAL seconds by Economies (or once
+    LEDGER_FLUSH_BATCH keys are waiting) and the journal is compacted into the
+    snapshot after JOURNAL_COMPACT_EVERY lines (or one line per key in the store,
+    whichever is more) and on shutdown. While the bot is
+    running the file work happens on STORAGE_POOL, never on the event loop."""
+
+    def __init__(self, path, reader):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.data = reader()
+        self.journal_lines = self._replay()
+        self.pending = {}  # key -> latest value not yet in the journal
+        self.needs_compact = False
+        self._write_lock = asyncio.Lock()
+        self._kicked = None
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path):
+            return 0
+        lines = 0
+        good = 0  # bytes up to the end of the last whole entry
+        with open(self.journal_path, 'rb') as f, METRICS.timer("file_read", file=_file_label(self.journal_path)):
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn write from a crash, even if what made it to disk parses
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # torn write from a crash, everything after it is garbage
+                self.data[entry["k"]] = entry["v"]
+                lines += 1
+                good += len(line)
+            size = os.fstat(f.fileno()).st_size
+            METRICS.count("file_read_bytes", size, file=_file_label(self.journal_path))
+        if good < size:
+            # cut the torn tail off, otherwise the next append lands on the end of it
+            # and every entry after that is behind a line that won't parse
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good)
+                f.flush()
+                os.fsync(f.fileno())
+        return lines
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def all(self):
+        return dict(self.data)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.pending[key] = value
+        if len(self.pending) >= LEDGER_FLUSH_BATCH:
+            self._kick()
+
+    def set_many(self, items):
+        for key, value in items.items():
+            self.data[key] = value
+            self.pending[key] = value
+        if len(self.pending) >= LEDGER_FLUSH_BATCH:
+            self._kick()
+
+    def replace(self, data):
+        # only journal what actually changed, removed keys are dropped at the next compaction
+        for key, value in data.items():
+            if self.data.get(key) != value:
+                self.pending[key] = value
+        if self.data.keys() - data.keys():
+            self.needs_compact = True
+        self.data = dict(data)
+        if self.needs_compact or len(self.pending) >= LEDGER_FLUSH_BATCH:
+            self._kick()
+
+    def _kick(self):
+        # flush in the background when the bot is running, inline otherwise (startup, shutdown)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self._kicked is None or self._kicked.done():
+            self._kicked = asyncio.create_task(self.flush_async())
+
+    def _append(self, batch):
+        chunk = "".join(json.dumps({"k": k, "v": v}) + "\n" for k, v in batch.items()).encode()
+        with open(self.journal_path, 'ab') as f, METRICS.timer("file_write", file=_file_label(self.journal_path)):
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        METRICS.count("file_written_bytes", len(chunk), file=_file_label(self.journal_path))
+        self.journal_lines += len(batch)
+
+    def _rewrite(self, snapshot):
+        write_snapshot(self.path, snapshot)
+        # the snapshot already has everything, a crash before this truncate just replays
+        # entries that set keys to the values they already have
+        open(self.journal_path, 'w').close()
+        self.journal_lines = 0
+
+    def _take_snapshot(self):
+        self.pending = {}
+        self.needs_compact = False
+        return dict(self.data)
+
+    def _compact_due(self):
+        # never more journal than snapshot, so rewriting every key (a redistribution)
+        # costs a compaction or two rather than one per JOURNAL_COMPACT_EVERY lines
+        return self.needs_compact or self.journal_lines >= max(JOURNAL_COMPACT_EVERY, len(self.data))
+
+    def flush(self):
+        batch, self.pending = self.pending, {}
+        if batch:
+            self._append(batch)
+        if self._compact_due():
+            self.compact()
+
+    def compact(self):
+        self._rewrite(self._take_snapshot())
+
+    async def flush_async(self):
+        # one write at a time per store; whatever piles up while a write is in
+        # flight goes out together with the next one
+        loop = asyncio.get_running_loop()
+        async with self._write_lock:
+            batch, self.pending = self.pending, {}
+            if batch:
+                await loop.run_in_executor(STORAGE_POOL, self._append, batch)
+            if self._compact_due():
+                await loop.run_in_executor(STORAGE_POOL, self._rewrite, self._take_snapshot())
+
+    async def compact_async(self):
+        async with self._write_lock:
+            await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, self._rewrite, self._take_snapshot())
+
+class Ledger(JournaledStore):
+    def __init__(self, path):
+        super().__init__(path, lambda: _read_json_file(path))
+        self.index = BalanceIndex()
+        self.index.reset(self.data)
+        self._order = None  # the ids a walk covers, in order, from walk_start until walk_end
+
+    def get(self, user_id):
+        return self.data.get(str(user_id), 0)
+
+    def set(self, user_id, balance):
+        super().set(str(user_id), balance)
+        self.index.update(user_id, balance)
+
+    def set_many(self, items):
+        super().set_many(items)
+        for user_id, balance in items.items():
+            self.index.update(user_id, balance)
+
+    def walk_start(self):
+        """Start walking the ledger in user id order (see chunk_after). Returns the mark
+        chunk_after wants, the json ledger keeps the sorted ids themselves instead:
+        they are taken once here and every pass of the walk goes over exactly those."""
+        self._order = sorted(self.data)
+        return len(self._order)
+
+    def chunk_after(self, after, mark, limit):
+        """([(user_id, balance)], next after) for up to limit of the walk's users after
+        `after` ("" for the first chunk). next after is None once this was the last one."""
+        if self._order is None:
+            raise ValueError("No walk over this ledger is going, it has to be started again.")
+        i = bisect.bisect_right(self._order, after)
+        rows = [(uid, self.data[uid]) for uid in self._order[i:i + limit] if uid in self.data]
+        return rows, (self._order[i + limit - 1] if i + limit < len(self._order) else None)
+
+    def walk_end(self):
+        self._order = None
+
+    def add(self, user_id, amount):
+        user_id = str(user_id)
+        balance = self.data.get(user_id, 0) + amount
+        self.set(user_id, balance)
+        return balance
+
+    def replace(self, data):
+        super().replace(data)
+        self.index.reset(self.data)
+
+class LoanBook(JournaledStore):
+    def __init__(self, path):
+        super().__init__(path, lambda: _read_loans_json(path))
+
+    def due_for_accrual(self, month_start):
+        # every loan, accrue_interest_all works out which ones are actually behind
+        return self.data
+
+# balances are int cents
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS balances (
+        user_id TEXT PRIMARY KEY,
+        balance INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS balances_by_balance ON balances (balance);
+    CREATE TABLE IF NOT EXISTS loans (
+        user_id TEXT PRIMARY KEY,
+        balance INTEGER NOT NULL,
+        active_count INTEGER NOT NULL,
+        rate REAL NOT NULL,
+        last_accrued TEXT
+    );
+    CREATE INDEX IF NOT EXISTS loans_by_last_accrued ON loans (last_accrued);
+"""
+
+def _open_sqlite(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SQLITE_SCHEMA)
+    if path == SQLITE_FILE:
+        _migrate_json_to_sqlite(conn)
+        _migrate_sqlite_to_cents(conn)
+    elif conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+        conn.execute("PRAGMA user_version = 2")  # a guild's database starts out in cents
+    return conn
+
+def _migrate_json_to_sqlite(conn):
+    # one shot: user_version goes to 2 once the json data (journal included) has been copied in.
+    # the json files are kept, in cents after _migrate_json_to_cents
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+        return
+    _migrate_json_to_cents()
+    balances = JournaledStore(SHIFTYCOIN_FILE, _read_shiftycoin_file).data
+    loans = JournaledStore(LOANS_FILE, _read_loans_file).data
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO balances (user_id, balance) VALUES (?, ?)",
+            ((uid, int(bal)) for uid, bal in balances.items()),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO loans (user_id, balance, active_count, rate, last_accrued) VALUES (?, ?, ?, ?, ?)",
+            ((uid, int(rec.get("balance", 0)), rec.get("active_count", 0), rec.get("rate", BASE_LOAN_RATE), rec.get("last_accrued"))
+             for uid, rec in loans.items()),
+        )
+        conn.execute("PRAGMA user_version = 2")
+
+def _migrate_sqlite_to_cents(conn):
+    # user_version 1 databases hold REAL SC, the tables get rebuilt with INTEGER cents
+    if conn.execute("PRAGMA user_version").fetchone()[0] != 1:
+        return
+    conn.executescript("""
+        BEGIN;
+        ALTER TABLE balances RENAME TO balances_sc;
+        ALTER TABLE loans RENAME TO loans_sc;
+        DROP INDEX balances_by_balance;
+        DROP INDEX loans_by_last_accrued;
+    """ + SQLITE_SCHEMA + """
+        INSERT INTO balances (user_id, balance)
+            SELECT user_id, CAST(ROUND(balance * 100) AS INTEGER) FROM balances_sc;
+        INSERT INTO loans (user_id, balance, active_count, rate, last_accrued)
+            SELECT user_id, CAST(ROUND(balance * 100) AS INTEGER), active_count, rate, last_accrued FROM loans_sc;
+        DROP TABLE balances_sc;
+        DROP TABLE loans_sc;
+        PRAGMA user_version = 2;
+        COMMIT;
+    """)
+
+def _migrate_json_to_cents():
+    if os.path.exists(MONEY_FORMAT_FILE):
+        return
+    for path, reader, convert in (
+        (SHIFTYCOIN_FILE, _read_shiftycoin_file, to_cents),
+        (LOANS_FILE, _read_loans_file, lambda rec: dict(rec, balance=to_cents(rec.get("balance", 0)))),
+    ):
+        if os.path.exists(path) or os.path.exists(path + ".journal"):
+            old = JournaledStore(path, reader)
+            old._rewrite({key: convert(value) for key, value in old.data.items()})
+    write_snapshot(MONEY_FORMAT_FILE, {"money": "cents"})
+
+class SqliteStore:
+    """Shared bits of the sqlite tables. Writes run inside one open transaction
+    that is committed by the flush loop, or straight after the op that brought it
+    to LEDGER_FLUSH_BATCH rows (Economies.commit_due), never partway through an op:
+    a transfer's debit and credit hit the disk together or not at all. Every call
+    is expected to come from STORAGE_POOL (see AsyncStorage)."""
+
+    def __init__(self, conn, path):
+        self.conn = conn
+        self.label = _file_label(path)
+        self.pending = 0
+
+    def _wrote(self, count=1):
+        # only counted, the op doing the writing may not be done yet
+        self.pending += count
+
+    def flush(self):
+        if not self.pending:
+            return
+        # sqlite doesn't say how many bytes a commit wrote, rows will have to do
+        with METRICS.timer("file_write", file=self.label):
+            self.conn.commit()
+        METRICS.count("sqlite_rows_written", self.pending, file=self.label)
+        self.pending = 0
+
+    def compact(self):
+        self.conn.commit()
+        self.pending = 0
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def flush_async(self):
+        await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, self.flush)
+
+class SqliteLedger(SqliteStore):
+    def __init__(self, conn, path):
+        super().__init__(conn, path)
+        self.index = BalanceIndex()
+        self.index.reset(self.all())
+
+    def get(self, user_id):
+        row = self.conn.execute("SELECT balance FROM balances WHERE user_id = ?", (str(user_id),)).fetchone()
+        return row[0] if row else 0
+
+    def set(self, user_id, balance):
+        self.conn.execute(
+            "INSERT INTO balances (user_id, balance) VALUES (?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET balance = excluded.balance",
+            (str(user_id), balance),
+        )
+        self.index.update(user_id, balance)
+        self._wrote()
+
+    def add(self, user_id, amount):
+        balance = self.get(user_id) + amount
+        self.set(user_id, balance)
+        return balance
+
+    def all(self):
+        return dict(self.conn.execute("SELECT user_id, balance FROM balances"))
+
+    def set_many(self, items):
+        self.conn.executemany(
+            "INSERT INTO balances (user_id, balance) VALUES (?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET balance = excluded.balance",
+            ((str(uid), bal) for uid, bal in items.items()),
+        )
+        for user_id, balance in items.items():
+            self.index.update(user_id, balance)
+        self._wrote(len(items) or 1)
+
+    def walk_start(self):
+        # upserts keep a row's rowid and new rows get a bigger one, so the accounts
+        # that exist right now are the ones at or below this
+        return self.conn.execute("SELECT max(rowid) FROM balances").fetchone()[0] or 0
+
+    def chunk_after(self, after, mark, limit):
+        # keyset paging on the primary key, never more than one chunk in memory
+        rows = self.conn.execute(
+            "SELECT user_id, balance FROM balances WHERE user_id > ? AND rowid <= ? ORDER BY user_id LIMIT ?",
+            (after, mark, limit),
+        ).fetchall()
+        return rows, (rows[-1][0] if len(rows) == limit else None)
+
+    def walk_end(self):
+        pass  # nothing held between chunks
+
+    def replace(self, data):
+        self.conn.execute("DELETE FROM balances")
+        self.conn.executemany("INSERT INTO balances (user_id, balance) VALUES (?, ?)", data.items())
+        self.index.reset(data)
+        self._wrote(len(data) or 1)
+
+class SqliteLoanBook(SqliteStore):
+    COLUMNS = ("balance", "active_count", "rate", "last_accrued")
+
+    def get(self, user_id, default=None):
+        row = self.conn.execute(
+            "SELECT balance, active_count, rate, last_accrued FROM loans WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else default
+
+    def set(self, user_id, rec):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO loans (user_id, balance, active_count, rate, last_accrued) VALUES (?, ?, ?, ?, ?)",
+            (str(user_id), rec.get("balance", 0), rec.get("active_count", 0), rec.get("rate", BASE_LOAN_RATE), rec.get("last_accrued")),
+        )
+        self._wrote()
+
+    def all(self):
+        rows = self.conn.execute("SELECT user_id, balance, active_count, rate, last_accrued FROM loans")
+        return {row[0]: dict(zip(self.COLUMNS, row[1:])) for row in rows}
+
+    def replace(self, data):
+        self.conn.execute("DELETE FROM loans")
+        for uid, rec in data.items():
+            self.set(uid, rec)
+
+    def set_many(self, items):
+        if not items:
+            return
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO loans (user_id, balance, active_count, rate, last_accrued) VALUES (?, ?, ?, ?, ?)",
+            ((str(uid), rec.get("balance", 0), rec.get("active_count", 0), rec.get("rate", BASE_LOAN_RATE), rec.get("last_accrued"))
+             for uid, rec in items.items()),
+        )
+        self._wrote(len(items) or 1)
+
+    def due_for_accrual(self, month_start):
+        # anything last accrued before this month, never-accrued loans are skipped like the json path does
+        rows = self.conn.execute(
+            "SELECT user_id, balance, active_count, rate, last_accrued FROM loans WHERE last_accrued < ?", (month_start,)
+        )
+        return {row[0]: dict(zip(self.COLUMNS, row[1:])) for row in rows}
+
+class Economy:
+    """One guild's ledger and loan book, in GUILDS_DIR/<guild id>/ with the configured backend."""
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.dir = os.path.join(GUILDS_DIR, str(guild_id))
+        os.makedirs(self.dir, exist_ok=True)
+        if STORAGE == "sqlite":
+            path = os.path.join(self.dir, "shiftycoin.db")
+            conn = _open_sqlite(path)
+            self.ledger = SqliteLedger(conn, path)
+            self.loans = SqliteLoanBook(conn, path)
+        else:
+            self.ledger = Ledger(os.path.join(self.dir, SHIFTYCOIN_FILE))
+            self.loans = LoanBook(os.path.join(self.dir, LOANS_FILE))
+
+class Economies:
+    """Economy per guild id. economies[guild_id] opens one for writing, creating it
+    if the guild has none yet, find() is for reads and never creates anything. One
+    nobody used for ECONOMY_IDLE_TIMEOUT seconds is written out in full and dropped
+    from memory again. One flush loop covers all of them, on the LEDGER_FLUSH_INTERVAL
+    schedule each store would have kept by itself."""
+
+    def __init__(self):
+        self.open = {}
+        self.used = {}  # guild id -> time.monotonic() of the last time it was asked for
+        self.closed = 0
+        self._flusher = None
+
+    def __getitem__(self, guild_id):
+        guild_id = int(guild_id)
+        eco = self.open.get(guild_id)
+        if eco is None:
+            eco = self.open[guild_id] = Economy(guild_id)
+        self.used[guild_id] = time.monotonic()
+        return eco
+
+    def find(self, guild_id):
+        """The guild's economy if it has one, open or on disk, otherwise None: a guild
+        without one reads as empty."""
+        guild_id = int(guild_id)
+        if guild_id in self.open or os.path.isdir(os.path.join(GUILDS_DIR, str(guild_id))):
+            return self[guild_id]
+        return None
+
+    def commit_due(self, guild_id):
+        # sqlite only, called between ops. json stores flush early by themselves, in a
+        # task that can't run until the op that queued the writes has returned
+        eco = self.open.get(int(guild_id))
+        if eco is not None and eco.ledger.pending + eco.loans.pending >= LEDGER_FLUSH_BATCH:
+            eco.ledger.flush()
+            eco.loans.flush()
+
+    def guild_ids(self):
+        # every guild with an economy on disk, not just the open ones
+        on_disk = {int(name) for name in os.listdir(GUILDS_DIR) if name.isdigit()} if os.path.isdir(GUILDS_DIR) else set()
+        return sorted(on_disk | set(self.open))
+
+    async def flush_async(self):
+        # list() first, with sqlite economies get opened on STORAGE_POOL while this runs
+        for eco in list(self.open.values()):
+            await eco.ledger.flush_async()
+            await eco.loans.flush_async()
+
+    async def close(self, guild_id):
+        """Write the guild's economy out in full and stop holding it in memory, it's
+        opened again from disk the next time it's needed. Stays open if something used
+        it while it was being written out."""
+        guild_id = int(guild_id)
+        eco = self.open.get(guild_id)
+        if eco is None:
+            return
+        if STORAGE == "sqlite":
+            # every op runs on STORAGE_POOL, nothing can use it in between
+            await asyncio.get_running_loop().run_in_executor(STORAGE_POOL, self._close_sqlite, guild_id)
+            return
+        started = time.monotonic()
+        await eco.ledger.compact_async()
+        await eco.loans.compact_async()
+        if self.open.get(guild_id) is eco and self.used[guild_id] < started and not eco.ledger.pending and not eco.loans.pending:
+            del self.open[guild_id]
+            del self.used[guild_id]
+            self.closed += 1
+
+    def _close_sqlite(self, guild_id):
+        eco = self.open.pop(guild_id, None)
+        if eco is not None:
+            self.used.pop(guild_id, None)
+            eco.ledger.compact()
+            eco.ledger.conn.close()
+            self.closed += 1
+
+    async def close_idle(self):
+        cutoff = time.monotonic() - ECONOMY_IDLE_TIMEOUT
+        for guild_id in [guild_id for guild_id, used in list(self.used.items()) if used < cutoff]:
+            await self.close(guild_id)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(LEDGER_FLUSH_INTERVAL)
+            try:
+                await self.flush_async()
+                await self.close_idle()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    def compact(self):
+        for eco in self.open.values():
+            eco.ledger.compact()
+            eco.loans.compact()
+
+    def stats(self):
+        return {"open": len(self.open), "closed": self.closed, "users": sum(len(eco.ledger.index) for eco in list(self.open.values()))}
+
+# only the ledger service opens these in a sharded deployment
+ECONOMIES = Economies()
+
+def legacy_pending():
+    if os.path.exists(LEGACY_MARKER):
+        return False
+    paths = [SHIFTYCOIN_FILE, SHIFTYCOIN_FILE + ".journal", LOANS_FILE, LOANS_FILE + ".journal"]
+    if STORAGE == "sqlite":
+        paths.append(SQLITE_FILE)
+    return any(os.path.exists(path) for path in paths)
+
+def _read_legacy():
+    """(balances, loans) of the old economy, brought up to date by the migrations it
+    would have gone through at startup before (floats to cents, json to sqlite)."""
+    if STORAGE == "sqlite":
+        conn = _open_sqlite(SQLITE_FILE)
+        try:
+            return SqliteLedger(conn, SQLITE_FILE).all(), SqliteLoanBook(conn, SQLITE_FILE).all()
+        finally:
+            conn.close()
+    _migrate_json_to_cents()
+    return JournaledStore(SHIFTYCOIN_FILE, _read_shiftycoin_file).data, JournaledStore(LOANS_FILE, _read_loans_file).data
+
+def migrate_legacy(guild_id):
+    """Fold the old economy into guild_id's, once. Balances are added to whatever the
+    user already has in the guild and a loan is merged into the one they already have
+    there, so it's safe even if the guild got going first. The old files stay where
+    they are rather than being deleted, but reading them puts them through the cents
+    conversion first if they never had it, which rewrites them in place. Returns how
+    many balances moved."""
+    if not legacy_pending():
+        return 0
+    balances, loans = _read_legacy()
+    eco = ECONOMIES[guild_id]
+    eco.ledger.set_many({uid: eco.ledger.get(uid) + bal for uid, bal in balances.items()})
+    today_first = first_of_month(datetime.date.today())
+    merged = {}
+    for uid, rec in loans.items():
+        rec = dict(rec)
+        mine = eco.loans.get(uid)
+        if mine is not None:
+            mine = dict(mine)
+            accrue_record(rec, today_first)
+            accrue_record(mine, today_first)
+            rec["balance"] = rec.get("balance", 0) + mine.get("balance", 0)
+            rec["active_count"] = rec.get("active_count", 0) + mine.get("active_count", 0)
+            rec["rate"] = compute_rate_for_count(rec["active_count"])
+        merged[uid] = rec
+    eco.loans.set_many(merged)
+    # on disk before the marker says it happened
+    eco.ledger.compact()
+    eco.loans.compact()
+    write_snapshot(LEGACY_MARKER, {"guild": int(guild_id), "balances": len(balances), "loans": len(loans)})
+    print(f"moved the old economy ({len(balances)} balance(s), {len(loans)} loan(s)) into guild {guild_id}")
+    return len(balances)
@@ -0,0 +1,85 @@
+"""BalanceIndex against a brute force recompute after random ledger writes.
+
+    python -m pytest test_aggregates.py     (or just python test_aggregates.py)
+"""
+import random
+
+from aggregates import BalanceIndex
+
+
+def brute_force(balances):
+    order = sorted(((-bal, uid) for uid, bal in balances.items()))
+    values = sorted(balances.values())
+    n, total = len(values), sum(values)
+    at = lambda q: values[round(q * (n - 1))] if n else 0
+    spread = sum(v * (2 * k - n + 1) for k, v in enumerate(values))
+    stats = {"users": n, "supply": total, "mean": round(total / n) if n else 0,
+             "gini": spread / (n * total) if n and total > 0 else None,
+             "min": at(0.0), "p10": at(0.1), "p25": at(0.25), "median": at(0.5), "p75": at(0.75),
+             "p90": at(0.9), "p99": at(0.99), "max": at(1.0)}
+    return [(uid, -neg) for neg, uid in order], stats
+
+
+def check(index, balances):
+    ranked, stats = brute_force(balances)
+    got = index.stats()
+    gini = got.pop("gini"), stats.pop("gini")
+    assert got == stats
+    assert gini[0] == gini[1] is None or abs(gini[0] - gini[1]) < 1e-9
+    assert index.page(0, len(ranked) + 5) == ranked
+    for offset in (0, 1, 3, len(ranked) // 2, max(0, len(ranked) - 2)):
+        assert index.page(offset, 7) == ranked[offset:offset + 7]
+    for position, (uid, _) in enumerate(ranked):
+        assert index.rank(uid) == position + 1
+    assert index.rank("nobody") is None
+
+
+def run(seed, block=4, users=60, writes=1500):
+    rng = random.Random(seed)
+    index = BalanceIndex()
+    index.BLOCK = block  # tiny blocks so inserts split them and removals empty them
+    balances = {str(uid): rng.randrange(-500, 5000) for uid in range(rng.randrange(users))}
+    index.reset(balances)
+    check(index, balances)
+    for i in range(writes):
+        uid = str(rng.randrange(users))
+        # a few big ties so equal balances get ordered by user id
+        balances[uid] = rng.choice((0, 100, rng.randrange(-500, 5000)))
+        index.update(uid, balances[uid])
+        if i % 50 == 0:
+            check(index, balances)
+    check(index, balances)
+
+
+def test_matches_brute_force():
+    for seed in range(20):
+        run(seed)
+
+
+def test_grow_and_shrink_through_block_splits():
+    rng = random.Random(99)
+    index = BalanceIndex()
+    index.BLOCK = 2
+    balances = {}
+    for uid in map(str, range(200)):
+        balances[uid] = rng.randrange(10_000)
+        index.update(uid, balances[uid])
+    check(index, balances)
+    # everyone piles onto the same few balances, blocks drain and get dropped
+    for uid in list(balances):
+        balances[uid] = rng.choice((1, 2))
+        index.update(uid, balances[uid])
+    check(index, balances)
+
+
+def test_empty():
+    index = BalanceIndex()
+    index.reset({})
+    check(index, {})
+
+
+if __name__ == "__main__":
+    test_matches_brute_force()
+    test_grow_and_shrink_through_block_splits()
+    test_empty()
+    print("ok")
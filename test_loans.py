@@ -0,0 +1,46 @@
+"""Monthly interest rounding, pinned on the half cent cases.
+
+    python -m pytest test_loans.py     (or just python test_loans.py)
+"""
+import datetime
+
+from loans import accrue_record, compound, compute_rate_for_count
+
+
+def test_half_cents_round_up():
+    # (balance, rate) -> interest, each one exactly half a cent over
+    for balance, rate, interest in (
+        (125, 0.02, 3),   # 1.25 SC at 2%, was 0.03 SC before cents
+        (50, 0.03, 2),    # 0.50 SC at 3%
+        (25, 0.02, 1),    # round() would make this 0
+        (20, compute_rate_for_count(2), 1),  # 2.5%
+        (1, 0.5, 1),
+    ):
+        assert compound(balance, rate, 1) == (balance + interest, interest)
+
+
+def test_rounds_to_the_nearest_cent_otherwise():
+    assert compound(1000, 0.02, 1) == (1020, 20)
+    assert compound(1024, 0.02, 1) == (1044, 20)  # 20.48
+    assert compound(1049, 0.02, 1) == (1070, 21)  # 20.98
+    assert compound(1000, 0.02, 0) == (1000, 0)
+
+
+def test_rounds_every_month():
+    # 125 -> 128 (2.5 up) -> 131 (2.56 up), not 125 * 1.02 ** 2
+    assert compound(125, 0.02, 2) == (131, 6)
+
+
+def test_accrue_record_catches_up_missed_months():
+    rec = {"balance": 125, "active_count": 1, "rate": 0.02, "last_accrued": "2024-11-01"}
+    assert accrue_record(rec, datetime.date(2025, 1, 1)) == (True, 2, 6)
+    assert rec == {"balance": 131, "active_count": 1, "rate": 0.02, "last_accrued": "2025-01-01"}
+    assert accrue_record(rec, datetime.date(2025, 1, 1)) == (False, 0, 0)
+
+
+if __name__ == "__main__":
+    test_half_cents_round_up()
+    test_rounds_to_the_nearest_cent_otherwise()
+    test_rounds_every_month()
+    test_accrue_record_catches_up_missed_months()
+    print("ok")
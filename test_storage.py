@@ -0,0 +1,188 @@
+"""The storage engine against files on disk: journal replay after a crash, when sqlite commits,
+the one-off migrations to cents, guilds without an economy, and folding the old single
+economy into a guild's.
+
+    python -m pytest test_storage.py     (or just python test_storage.py)
+"""
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import storage
+from loans import compute_rate_for_count, first_of_month
+
+
+@contextlib.contextmanager
+def scratch(**config):
+    """Run in an empty directory with the given config and no economies open."""
+    cwd, economies = os.getcwd(), storage.ECONOMIES
+    workdir = tempfile.mkdtemp(prefix="shiftycoin-test-")
+    os.chdir(workdir)
+    storage.configure(config)
+    storage.ECONOMIES = storage.Economies()
+    try:
+        yield workdir
+    finally:
+        for eco in storage.ECONOMIES.open.values():
+            if isinstance(eco.ledger, storage.SqliteStore):
+                eco.ledger.conn.close()
+        storage.ECONOMIES = economies
+        storage.configure({})
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def write_lines(path, *lines, end=""):
+    with open(path, "w") as f:
+        f.write("".join(json.dumps(line) + "\n" for line in lines) + end)
+
+
+def test_torn_journal_tail_is_cut_before_the_next_append():
+    for torn in ('{"k": "c", "v": 3', '{"k": "c", "v": 3}'):  # half a line, and a whole one missing its newline
+        with scratch():
+            write_lines("x.json.journal", {"k": "a", "v": 1}, {"k": "b", "v": 2}, end=torn)
+            store = storage.JournaledStore("x.json", dict)
+            assert store.data == {"a": 1, "b": 2}
+            assert store.journal_lines == 2
+            store.set("c", 300)
+            store.flush()
+            assert storage.JournaledStore("x.json", dict).data == {"a": 1, "b": 2, "c": 300}
+
+
+def test_json_floats_to_cents_snapshot_and_journal():
+    with scratch():
+        write_lines(storage.SHIFTYCOIN_FILE + ".journal", {"k": "2", "v": 0.15}, {"k": "3", "v": 7})
+        with open(storage.SHIFTYCOIN_FILE, "w") as f:
+            json.dump({"1": 12.5, "2": 0.1}, f)
+        with open(storage.LOANS_FILE, "w") as f:
+            json.dump({"1": {"balance": 2.25, "active_count": 1, "rate": 0.02, "last_accrued": "2024-01-01"}}, f)
+        storage._migrate_json_to_cents()
+        balances = storage.JournaledStore(storage.SHIFTYCOIN_FILE, storage._read_shiftycoin_file)
+        assert balances.data == {"1": 1250, "2": 15, "3": 700}
+        assert balances.journal_lines == 0  # folded into the snapshot
+        loans = storage.JournaledStore(storage.LOANS_FILE, storage._read_loans_file).data
+        assert loans == {"1": {"balance": 225, "active_count": 1, "rate": 0.02, "last_accrued": "2024-01-01"}}
+        # only ever once, cents must not get multiplied again
+        storage._migrate_json_to_cents()
+        assert storage._read_shiftycoin_file() == {"1": 1250, "2": 15, "3": 700}
+
+
+def test_sqlite_floats_to_cents():
+    with scratch(storage="sqlite"):
+        conn = sqlite3.connect(storage.SQLITE_FILE)
+        conn.executescript("""
+            CREATE TABLE balances (user_id TEXT PRIMARY KEY, balance REAL NOT NULL);
+            CREATE INDEX balances_by_balance ON balances (balance);
+            CREATE TABLE loans (user_id TEXT PRIMARY KEY, balance REAL NOT NULL, active_count INTEGER NOT NULL,
+                                rate REAL NOT NULL, last_accrued TEXT);
+            CREATE INDEX loans_by_last_accrued ON loans (last_accrued);
+            INSERT INTO balances VALUES ('1', 12.5), ('2', 0.1);
+            INSERT INTO loans VALUES ('1', 2.25, 1, 0.02, '2024-01-01');
+            PRAGMA user_version = 1;
+        """)
+        conn.close()
+        conn = storage._open_sqlite(storage.SQLITE_FILE)
+        assert storage.SqliteLedger(conn, storage.SQLITE_FILE).all() == {"1": 1250, "2": 10}
+        assert storage.SqliteLoanBook(conn, storage.SQLITE_FILE).get("1")["balance"] == 225
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 2
+        conn.close()
+
+
+def test_sqlite_commits_between_ops_only():
+    with scratch(storage="sqlite", ledger_flush_batch=2):
+        ledger = storage.ECONOMIES[1].ledger
+        # a transfer that goes past the batch size halfway through
+        ledger.set("1", 700)
+        ledger.set("2", 300)
+        peek = sqlite3.connect(os.path.join(storage.GUILDS_DIR, "1", "shiftycoin.db"))
+        assert peek.execute("SELECT count(*) FROM balances").fetchone()[0] == 0
+        storage.ECONOMIES.commit_due(1)
+        assert dict(peek.execute("SELECT user_id, balance FROM balances")) == {"1": 700, "2": 300}
+        peek.close()
+
+
+def reads_and_closing(backend):
+    with scratch(storage=backend):
+        assert storage.ECONOMIES.find(3) is None
+        assert not os.path.exists(os.path.join(storage.GUILDS_DIR, "3"))
+        storage.ECONOMIES[3].ledger.set("1", 250)
+        asyncio.run(storage.ECONOMIES.close(3))
+        assert 3 not in storage.ECONOMIES.open
+        assert storage.ECONOMIES.closed == 1
+        assert storage.ECONOMIES.find(3).ledger.get("1") == 250
+
+
+def test_reads_and_closing_json():
+    reads_and_closing("json")
+
+
+def test_reads_and_closing_sqlite():
+    reads_and_closing("sqlite")
+
+
+def legacy_merge(backend):
+    this_month = first_of_month(datetime.date.today())
+    last_month = first_of_month(this_month - datetime.timedelta(days=1))
+    with scratch(storage=backend):
+        # the guild got going before the old economy was folded in
+        eco = storage.ECONOMIES[7]
+        eco.ledger.set_many({"1": 500, "2": 100})
+        eco.loans.set("1", {"balance": 1000, "active_count": 1, "rate": 0.02, "last_accrued": this_month.isoformat()})
+        eco.ledger.compact()
+        eco.loans.compact()
+        # the old files, still in float SC
+        with open(storage.SHIFTYCOIN_FILE, "w") as f:
+            json.dump({"1": 2.0, "3": 1.5}, f)
+        with open(storage.LOANS_FILE, "w") as f:
+            json.dump({
+                "1": {"balance": 4.0, "active_count": 2, "rate": 0.025, "last_accrued": last_month.isoformat()},
+                "3": {"balance": 3.0, "active_count": 1, "rate": 0.02, "last_accrued": this_month.isoformat()},
+            }, f)
+
+        assert storage.legacy_pending()
+        assert storage.migrate_legacy(7) == 2
+        assert not storage.legacy_pending()
+        assert storage.migrate_legacy(7) == 0  # once only
+
+        # what's on disk, through a fresh set of economies
+        for eco in storage.ECONOMIES.open.values():
+            if isinstance(eco.ledger, storage.SqliteStore):
+                eco.ledger.conn.close()
+        storage.ECONOMIES = storage.Economies()
+        eco = storage.ECONOMIES[7]
+        assert eco.ledger.all() == {"1": 700, "2": 100, "3": 150}
+        assert eco.ledger.index.total == 950
+        loans = eco.loans.all()
+        # the old loan gets the month of interest it was behind on (400 at 2.5%) before the two add up
+        assert loans["1"]["balance"] == 1410
+        assert loans["1"]["active_count"] == 3
+        assert loans["1"]["rate"] == compute_rate_for_count(3)
+        assert loans["1"]["last_accrued"] == this_month.isoformat()
+        assert loans["3"]["balance"] == 300
+        with open(storage.LEGACY_MARKER) as f:
+            assert json.load(f) == {"guild": 7, "balances": 2, "loans": 2}
+
+
+def test_legacy_merge_json():
+    legacy_merge("json")
+
+
+def test_legacy_merge_sqlite():
+    legacy_merge("sqlite")
+
+
+if __name__ == "__main__":
+    test_torn_journal_tail_is_cut_before_the_next_append()
+    test_json_floats_to_cents_snapshot_and_journal()
+    test_sqlite_floats_to_cents()
+    test_sqlite_commits_between_ops_only()
+    test_reads_and_closing_json()
+    test_reads_and_closing_sqlite()
+    test_legacy_merge_json()
+    test_legacy_merge_sqlite()
+    print("ok")